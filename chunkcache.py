@@ -0,0 +1,133 @@
+from collections import OrderedDict
+import logging
+
+log = logging.getLogger(__name__)
+
+__author__ = 'Rio'
+
+
+class ChunkCache(object):
+    """
+    Holds chunk data by chunk position, ordered from least to most recently used. When more than maxChunks entries
+    or more than maxBytes bytes are held, the least recently used entries are evicted until the cache fits again. A
+    limit of zero means no limit.
+
+    sizeFunc(value) returns the number of bytes an entry uses. canEvict(key, value) returns False for entries that
+    must stay loaded, such as chunks still in use by a client; they are moved to the most recently used end and
+    skipped. onEvict(key, value) is called for each evicted entry and returns True if it wrote the entry somewhere
+    else, such as a dirty chunk being saved to the work folder.
+
+    get() is a use of the entry: it counts a hit or a miss and makes the entry the most recently used. Tests with
+    `in` and iteration do neither. An entry's size is measured when it is stored; call resize() when it changes.
+    """
+
+    def __init__(self, maxChunks=400, maxBytes=0, sizeFunc=None, canEvict=None, onEvict=None):
+        self.maxChunks = maxChunks
+        self.maxBytes = maxBytes
+        self.sizeFunc = sizeFunc or (lambda value: 0)
+        self.canEvict = canEvict or (lambda key, value: True)
+        self.onEvict = onEvict or (lambda key, value: False)
+
+        self._entries = OrderedDict()  # key -> (value, size), least recently used first
+        self._byteCount = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+
+    def __repr__(self):
+        return "ChunkCache({0} chunks, {1} bytes, {2} hits, {3} misses, {4} evictions, {5} spills)".format(
+            len(self), self.byteCount, self.hits, self.misses, self.evictions, self.spills)
+
+    @property
+    def byteCount(self):
+        return self._byteCount
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def iterkeys(self):
+        return self._entries.iterkeys()
+
+    def itervalues(self):
+        for value, size in self._entries.itervalues():
+            yield value
+
+    def iteritems(self):
+        for key, (value, size) in self._entries.iteritems():
+            yield key, value
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._entries[key] = entry
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        self.pop(key, None)
+        size = self.sizeFunc(value)
+        self._entries[key] = value, size
+        self._byteCount += size
+        self._evict()
+
+    def resize(self, key, value):
+        """ Measures the entry again after its value grew or shrank, and evicts other entries if the cache is now
+        over its limits. The entry becomes the most recently used. Does nothing if value is not the entry for key. """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] is not value:
+            return
+
+        del self._entries[key]
+        size = self.sizeFunc(value)
+        self._entries[key] = value, size
+        self._byteCount += size - entry[1]
+        self._evict(keep=key)
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+
+        self._byteCount -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self._entries.clear()
+        self._byteCount = 0
+
+    def _overLimit(self):
+        return ((self.maxChunks and len(self._entries) > self.maxChunks)
+                or (self.maxBytes and self._byteCount > self.maxBytes))
+
+    def _evict(self, keep=None):
+        # each entry is looked at once at most, so a cache full of entries that can't be evicted is left over its
+        # limit rather than scanned forever
+        remaining = len(self._entries)
+        while remaining and self._overLimit():
+            remaining -= 1
+            key = next(iter(self._entries))
+            value, size = self._entries[key]
+            if key == keep or not self.canEvict(key, value):
+                del self._entries[key]
+                self._entries[key] = value, size
+                continue
+
+            # the entry stays in the cache until onEvict returns, so nothing is lost if writing it out fails
+            spilled = self.onEvict(key, value)
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._byteCount -= entry[1]
+            self.evictions += 1
+            if spilled:
+                self.spills += 1
@@ -0,0 +1,119 @@
+from numpy import flatnonzero, frombuffer, unpackbits
+from regionfile import regionChunkPositions
+
+__author__ = 'Rio'
+
+
+class ChunkPositionSet(object):
+    """
+    A set of (cx, cz) chunk positions, stored as one 1024-bit bitmap per region file instead of as a set of
+    tuples. A full region costs 128 bytes rather than more than 100 bytes per chunk.
+
+    Iteration is in region order, sorted by (rx, rz), and within each region in the order of the region file's
+    offset table. regions() and chunksInRegion() visit one region at a time.
+
+    bounds is kept up to date as positions are added. It is only recomputed from the bitmaps after a position on
+    its edge is removed, and then only once, the next time it is asked for.
+    """
+
+    def __init__(self, positions=()):
+        # (rx, rz) -> bytearray(128). The bit for offset table index i is bit 7 - (i & 7) of byte i >> 3, the order
+        # numpy's unpackbits uses.
+        self._regions = {}
+        self._count = 0
+        self._bounds = None  # (mincx, mincz, maxcx, maxcz)
+        self._boundsStale = False
+        self.update(positions)
+
+    def __repr__(self):
+        return "ChunkPositionSet({0} chunks in {1} regions)".format(self._count, len(self._regions))
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, (cx, cz)):
+        bits = self._regions.get((cx >> 5, cz >> 5))
+        if bits is None:
+            return False
+        i = (cx & 0x1f) + ((cz & 0x1f) << 5)
+        return bool(bits[i >> 3] & (0x80 >> (i & 7)))
+
+    def add(self, (cx, cz)):
+        key = cx >> 5, cz >> 5
+        bits = self._regions.get(key)
+        if bits is None:
+            bits = self._regions[key] = bytearray(128)
+
+        i = (cx & 0x1f) + ((cz & 0x1f) << 5)
+        mask = 0x80 >> (i & 7)
+        if bits[i >> 3] & mask:
+            return
+
+        bits[i >> 3] |= mask
+        self._count += 1
+        if self._bounds is None and not self._boundsStale:
+            self._bounds = cx, cz, cx, cz
+        elif self._bounds is not None:
+            mincx, mincz, maxcx, maxcz = self._bounds
+            self._bounds = min(mincx, cx), min(mincz, cz), max(maxcx, cx), max(maxcz, cz)
+
+    def discard(self, (cx, cz)):
+        key = cx >> 5, cz >> 5
+        bits = self._regions.get(key)
+        if bits is None:
+            return
+
+        i = (cx & 0x1f) + ((cz & 0x1f) << 5)
+        mask = 0x80 >> (i & 7)
+        if not bits[i >> 3] & mask:
+            return
+
+        bits[i >> 3] &= ~mask
+        self._count -= 1
+        if not any(bits):
+            del self._regions[key]
+
+        if self._bounds is not None and (cx in (self._bounds[0], self._bounds[2]) or
+                                         cz in (self._bounds[1], self._bounds[3])):
+            self._bounds = None
+            self._boundsStale = True
+
+    def update(self, positions):
+        for cPos in positions:
+            self.add(cPos)
+
+    def regions(self):
+        """ Returns the (rx, rz) coordinates of the regions holding any of the chunks, sorted. """
+        return sorted(self._regions)
+
+    def chunksInRegion(self, (rx, rz)):
+        """ Returns a list of the chunks in one region, in offset table order. """
+        bits = self._regions.get((rx, rz))
+        if bits is None:
+            return []
+        return regionChunkPositions((rx, rz), flatnonzero(unpackbits(frombuffer(bits, 'uint8'))))
+
+    def __iter__(self):
+        for key in self.regions():
+            for cPos in self.chunksInRegion(key):
+                yield cPos
+
+    @property
+    def bounds(self):
+        """ Returns (mincx, mincz, maxcx, maxcz) for the chunks in the set, or None if it is empty. """
+        if self._boundsStale:
+            self._boundsStale = False
+            self._bounds = None
+            for key in self._regions:
+                positions = self.chunksInRegion(key)
+                cxs = [cx for cx, cz in positions]
+                czs = [cz for cx, cz in positions]
+                regionBounds = min(cxs), min(czs), max(cxs), max(czs)
+                if self._bounds is None:
+                    self._bounds = regionBounds
+                else:
+                    self._bounds = (min(self._bounds[0], regionBounds[0]), min(self._bounds[1], regionBounds[1]),
+                                    max(self._bounds[2], regionBounds[2]), max(self._bounds[3], regionBounds[3]))
+
+        return self._bounds
+
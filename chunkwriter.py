@@ -0,0 +1,90 @@
+from Queue import Queue
+import logging
+import sys
+import threading
+
+log = logging.getLogger(__name__)
+
+__author__ = 'Rio'
+
+
+class ChunkWriter(object):
+    """
+    Runs chunk saves on a pool of background threads. An AnvilWorldFolder with a chunkWriter queues the compression
+    and writing of each saved chunk here, so the caller can go on working while zlib, which releases the GIL,
+    compresses it. The folder makes sure only one thread writes to each region file at a time.
+
+    At most maxPending saves are queued; submit() blocks until there is room, so a caller that saves faster than
+    the disk can keep up is slowed down instead of holding every chunk in memory.
+
+    flush() waits for every queued save to finish. If a save failed, the error is raised by the next call to
+    submit() or flush().
+    """
+
+    def __init__(self, workers=2, maxPending=64):
+        assert workers > 0 and maxPending > 0
+        self.workers = workers
+        self.maxPending = maxPending
+        self._queue = Queue(maxPending)
+        self._threads = []
+        self._error = None
+
+    def __repr__(self):
+        return "ChunkWriter({0} workers, {1}/{2} pending)".format(len(self._threads), self.pendingCount,
+                                                                 self.maxPending)
+
+    @property
+    def pendingCount(self):
+        return self._queue.unfinished_tasks
+
+    def submit(self, func, *args):
+        """ Calls func(*args) on a worker thread. Blocks while maxPending calls are already waiting. """
+        self._raiseError()
+        if not self._threads:
+            self._startWorkers()
+        self._queue.put((func, args))
+
+    def flush(self):
+        """ Waits for all submitted calls to finish. """
+        if self._threads:
+            self._queue.join()
+        self._raiseError()
+
+    def close(self):
+        """ Waits for all submitted calls to finish and stops the worker threads. """
+        try:
+            self.flush()
+        finally:
+            for t in self._threads:
+                self._queue.put(None)
+            for t in self._threads:
+                t.join()
+            self._threads = []
+
+    def _startWorkers(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name="ChunkWriter-%d" % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                func, args = item
+                func(*args)
+            except Exception:
+                log.exception("Background chunk save failed")
+                if self._error is None:
+                    self._error = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _raiseError(self):
+        if self._error is not None:
+            exc_info, self._error = self._error, None
+            raise exc_info[0], exc_info[1], exc_info[2]
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+__author__ = 'Rio'
+
+
+class FileHandlePool(object):
+    """
+    Keeps up to maxOpen files open for reuse, closing the least recently used one when another file is needed.
+    MCRegionFile and PocketChunksFile use one of these in place of holdFileOpen, which keeps every file open, or
+    reopening the file on every access.
+
+    hits, misses and evictions count what happened on each call to open(). A file is used by one thread at a time;
+    open() blocks while another thread is inside an open() block for the same path. Different files are used by
+    different threads at once. A file that is in use is never closed to make room for another one, so more than
+    maxOpen files may be open while that many are in use.
+    """
+
+    def __init__(self, maxOpen=64, mode="rb+"):
+        assert maxOpen > 0
+        self.maxOpen = maxOpen
+        self.mode = mode
+        self._files = OrderedDict()
+        self._lock = threading.RLock()  # guards _files, _pathLocks and _users; held only while handing out a file
+        self._pathLocks = {}  # path -> RLock held while the file is in use
+        self._users = {}  # path -> number of open() blocks using the file
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return "FileHandlePool({0}/{1} open, {2} hits, {3} misses, {4} evictions)".format(
+            len(self._files), self.maxOpen, self.hits, self.misses, self.evictions)
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def _pathLock(self, path):
+        with self._lock:
+            pathLock = self._pathLocks.get(path)
+            if pathLock is None:
+                pathLock = self._pathLocks[path] = threading.RLock()
+            return pathLock
+
+    def _checkOut(self, path):
+        with self._lock:
+            f = self._files.pop(path, None)
+            if f is None:
+                self.misses += 1
+                f = file(path, self.mode)
+            else:
+                self.hits += 1
+
+            self._files[path] = f  # most recently used files are at the end
+            self._users[path] = self._users.get(path, 0) + 1
+            self._closeIdleFiles()
+            return f
+
+    def _checkIn(self, path):
+        with self._lock:
+            self._users[path] -= 1
+            if not self._users[path]:
+                del self._users[path]
+            self._closeIdleFiles()
+
+    def _closeIdleFiles(self):
+        # closes the least recently used files that no thread is using until no more than maxOpen are open
+        idle = [p for p in self._files if p not in self._users]
+        while len(self._files) > self.maxOpen and idle:
+            oldPath = idle.pop(0)
+            log.debug("Closing %s to make room for other files", oldPath)
+            self._files.pop(oldPath).close()
+            self.evictions += 1
+
+    @contextmanager
+    def open(self, path):
+        """
+        Use as a context manager in place of file(path, "rb+"). The file is left open when the block exits; any
+        buffered writes are flushed so other readers of the file, such as a memory map, see them.
+        """
+        with self._pathLock(path):
+            f = self._checkOut(path)
+            try:
+                yield f
+            finally:
+                try:
+                    f.flush()
+                finally:
+                    self._checkIn(path)
+
+    def release(self, path):
+        """ Closes the file if it is open, waiting for any thread using it. Call this before deleting or renaming
+        the file. """
+        with self._pathLock(path):
+            with self._lock:
+                f = self._files.pop(path, None)
+                if f is not None:
+                    f.close()
+
+    def closeAll(self):
+        with self._lock:
+            for f in self._files.itervalues():
+                f.close()
+            self._files.clear()
@@ -4,16 +4,20 @@ Created on Jul 22, 2011
 @author: Rio
 '''
 
+from collections import defaultdict, deque
 import copy
 from datetime import datetime
 import itertools
 from logging import getLogger
 from math import floor
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import random
 import shutil
 import struct
+import threading
 import time
 import traceback
 import weakref
@@ -22,14 +26,20 @@ import sys
 
 import blockrotation
 from box import BoundingBox
+from chunkcache import ChunkCache
+from chunkpositions import ChunkPositionSet
+from chunkwriter import ChunkWriter
 from entity import Entity, TileEntity
 from faces import FaceXDecreasing, FaceXIncreasing, FaceZDecreasing, FaceZIncreasing
-from level import LightedChunk, EntityLevel, computeChunkHeightMap, MCLevel, ChunkBase
+from filepool import FileHandlePool
+from level import LightedChunk, EntityLevel, computeChunkHeightMap, getSlices, MCLevel, ChunkBase
 from materials import alphaMaterials
 from mclevelbase import ChunkMalformed, ChunkNotPresent, exhaust, PlayerNotFound
 import nbt
-from numpy import array, clip, maximum, zeros
-from regionfile import MCRegionFile
+from nibblearray import NibbleArray
+from numpy import (append, array, asarray, broadcast_arrays, clip, concatenate, flatnonzero, frombuffer, lexsort,
+                   maximum, minimum, newaxis, packbits, repeat, unique, unpackbits, where, zeros)
+from regionfile import MCRegionFile, regionChunkPositions
 
 log = getLogger(__name__)
 
@@ -81,6 +91,13 @@ def packNibbleArray(unpackedData):
     packedData[..., 1] |= packedData[..., 0]
     return array(packedData[:, :, :, 1])
 
+def _sectionNibbles(arr, y):
+    # returns the nibbles of the section starting at y as they are stored in a section tag
+    if isinstance(arr, NibbleArray):
+        return arr.packed[y:y + 16]
+    section = arr[..., y:y + 16].swapaxes(0, 2)
+    return (section[..., 1::2] << 4) | (section[..., 0::2] & 0xf)
+
 def sanitizeBlocks(chunk):
     # change grass to dirt where needed so Minecraft doesn't flip out and die
     grass = chunk.Blocks == chunk.materials.Grass.ID
@@ -98,6 +115,27 @@ def sanitizeBlocks(chunk):
         chunk.Blocks[:, :, 1:][badsnow] = chunk.materials.Air.ID
 
 
+def _sectionRuns(sectionYs):
+    # yields (miny, maxy) block ranges covering runs of consecutive section Ys
+    run = None
+    for sy in sorted(sectionYs):
+        if run and run[1] == sy:
+            run[1] = sy + 1
+            continue
+        if run:
+            yield run[0] << 4, run[1] << 4
+        run = [sy, sy + 1]
+    if run:
+        yield run[0] << 4, run[1] << 4
+
+
+class _ChunkSlice(object):
+    # the blocks of a chunk from miny up to maxy, for sanitizing only the sections about to be saved
+    def __init__(self, chunk, miny, maxy):
+        self.materials = chunk.materials
+        self.Blocks = chunk.Blocks[..., miny:maxy]
+
+
 class AnvilChunkData(object):
     """ This is the chunk data backing an AnvilChunk. Chunk data is retained by the MCInfdevOldLevel until its
     AnvilChunk is no longer used, then it is either cached in memory, discarded, or written to disk according to
@@ -106,18 +144,26 @@ class AnvilChunkData(object):
     AnvilChunks are stored in a WeakValueDictionary so we can find out when they are no longer used by clients. The
     AnvilChunkData for an unused chunk may safely be discarded or written out to disk. The client should probably
      not keep references to a whole lot of chunks or else it will run out of memory.
+
+    The chunk's sections are kept as they were loaded, with their nibble arrays still packed, until Blocks, Data,
+    BlockLight or SkyLight is first used. Only then are the full-height arrays allocated and filled in. A chunk
+    that is only visited for its entities or tile entities, or saved without its blocks changing, costs a few
+    kilobytes per section instead of 320 KB.
+
+    The section tags are kept after the arrays are unpacked, and savedTagData only rebuilds the tags of sections
+    marked as changed. Setting dirty to True marks every section, as does chunkChanged. Callers that know which
+    blocks they changed call markDirty with their y range instead, so saving after a small edit only re-encodes
+    the sections it touched. Code that writes to the arrays must still set dirty or call chunkChanged afterward.
     """
     def __init__(self, world, chunkPosition, root_tag = None, create = False):
         self.chunkPosition = chunkPosition
         self.world = world
         self.root_tag = root_tag
-        self.dirty = False
 
-        self.Blocks = zeros((16, 16, world.Height), 'uint16')
-        self.Data = zeros((16, 16, world.Height), 'uint8')
-        self.BlockLight = zeros((16, 16, world.Height), 'uint8')
-        self.SkyLight = zeros((16, 16, world.Height), 'uint8')
-        self.SkyLight[:] = 15
+        self._sections = {}  # section Y -> section TAG_Compound as last loaded or saved
+        self._dirtySections = set()  # section Ys whose tag no longer matches the arrays
+        self._arrays = None  # (Blocks, Data, BlockLight, SkyLight)
+        self.dirty = False
 
         if create:
             self._create()
@@ -129,6 +175,52 @@ class AnvilChunkData(object):
             levelTag["Biomes"] = nbt.TAG_Byte_Array(zeros((16, 16), 'uint8'))
             levelTag["Biomes"].value[:] = -1
 
+    def memoryUsage(self):
+        """ Returns the number of bytes used by this chunk's arrays and section tags. """
+        size = sum(tag.value.nbytes for sec in self._sections.itervalues() for tag in sec.itervalues()
+                   if isinstance(tag, nbt.TAG_Byte_Array))
+        if self._arrays is not None:
+            size += sum(arr.nbytes for arr in self._arrays)
+        return size
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    @dirty.setter
+    def dirty(self, value):
+        self._dirty = value
+        if value:
+            self._dirtySections.update(range(self.world.Height >> 4))
+
+    def markDirty(self, miny=0, maxy=None):
+        """ Marks the chunk dirty and the sections holding blocks miny up to maxy as changed. By default every
+        section is marked; pass miny == maxy if only the entities, tile entities or other level tags changed. """
+        if maxy is None:
+            maxy = self.world.Height
+        self._dirty = True
+        self._dirtySections.update(range(max(0, miny) >> 4, (min(maxy, self.world.Height) + 15) >> 4))
+
+    @property
+    def isUnpacked(self):
+        return self._arrays is not None
+
+    @property
+    def Blocks(self):
+        return (self._arrays or self._unpackSections())[0]
+
+    @property
+    def Data(self):
+        return (self._arrays or self._unpackSections())[1]
+
+    @property
+    def BlockLight(self):
+        return (self._arrays or self._unpackSections())[2]
+
+    @property
+    def SkyLight(self):
+        return (self._arrays or self._unpackSections())[3]
+
     def _create(self):
         (cx, cz) = self.chunkPosition
         chunkTag = nbt.TAG_Compound()
@@ -155,48 +247,112 @@ class AnvilChunkData(object):
         self.root_tag = root_tag
 
         for sec in self.root_tag["Level"].pop("Sections", []):
+            self._sections[sec["Y"].value] = sec
+
+    def _unpackSections(self):
+        Height = self.world.Height
+        if self.world.nativeSectionOrder:
+            def chunkArray(dtype):
+                # stored [y, z, x] like the section tags, seen through an [x, z, y] view
+                return zeros((Height, 16, 16), dtype).swapaxes(0, 2)
+        else:
+            def chunkArray(dtype):
+                return zeros((16, 16, Height), dtype)
+
+        Blocks = chunkArray('uint16')
+        if self.world.packedNibbleArrays:
+            Data = NibbleArray.filled(Height)
+            BlockLight = NibbleArray.filled(Height)
+            SkyLight = NibbleArray.filled(Height, 15)
+        else:
+            Data = chunkArray('uint8')
+            BlockLight = chunkArray('uint8')
+            SkyLight = chunkArray('uint8')
+            SkyLight[:] = 15
+        arrays = dict(Blocks=Blocks, Data=Data, BlockLight=BlockLight, SkyLight=SkyLight)
+
+        for sec in self._sections.itervalues():
             y = sec["Y"].value * 16
 
             for name in "Blocks", "Data", "SkyLight", "BlockLight":
-                arr = getattr(self, name)
+                arr = arrays[name]
                 secarray = sec[name].value
                 if name == "Blocks":
                     secarray.shape = (16, 16, 16)
+                    arr[..., y:y + 16] = secarray.swapaxes(0, 2)
+                elif isinstance(arr, NibbleArray):
+                    arr.packed[y:y + 16] = secarray.reshape(16, 16, 8)
                 else:
                     secarray.shape = (16, 16, 8)
-                    secarray = unpackNibbleArray(secarray)
-
-                arr[..., y:y + 16] = secarray.swapaxes(0, 2)
+                    section = arr[..., y:y + 16].swapaxes(0, 2)
+                    section[..., 0::2] = secarray & 0xf
+                    section[..., 1::2] = secarray >> 4
 
             tag = sec.get("Add")
             if tag is not None:
                 tag.value.shape = (16, 16, 8)
                 add = unpackNibbleArray(tag.value)
-                self.Blocks[...,y:y + 16] |= (array(add, 'uint16') << 8).swapaxes(0, 2)
+                Blocks[...,y:y + 16] |= (array(add, 'uint16') << 8).swapaxes(0, 2)
+
+        self._arrays = Blocks, Data, BlockLight, SkyLight
+        self._memoryChanged()
+        return self._arrays
+
+    def unpackNibbleArrays(self):
+        """ Replaces any NibbleArrays with plain uint8 arrays. """
+        def unpacked(arr):
+            if not isinstance(arr, NibbleArray):
+                return arr
+            if self.world.nativeSectionOrder:
+                return arr.unpack()  # already a view of a new array in section order
+            return arr.unpack().copy()
+
+        arrays = self._arrays or self._unpackSections()
+        if any(isinstance(arr, NibbleArray) for arr in arrays):
+            self._arrays = tuple(unpacked(arr) for arr in arrays)
+            self._memoryChanged()
+
+    def _memoryChanged(self):
+        # the chunk cache measures a chunk when it is stored, while its sections are still packed
+        self.world._loadedChunkData.resize(self.chunkPosition, self)
 
     def savedTagData(self):
         """ does not recalculate any data or light """
 
         log.debug(u"Saving chunk: {0}".format(self))
-        sanitizeBlocks(self)
+        if self._arrays is None:
+            # the blocks were never looked at, so the sections are saved as they were loaded
+            self.root_tag["Level"]["Sections"] = nbt.TAG_List([self._sections[y] for y in sorted(self._sections)])
+            data = self.root_tag.save(compressed=False)
+            del self.root_tag["Level"]["Sections"]
+            self._dirtySections.clear()
+            return data
+
+        for miny, maxy in _sectionRuns(self._dirtySections):
+            sanitizeBlocks(_ChunkSlice(self, miny, maxy))
 
         sections = nbt.TAG_List()
         for y in range(0, self.world.Height, 16):
+            if y >> 4 not in self._dirtySections:
+                # unchanged since it was loaded or last saved; a missing tag was an empty section
+                if y >> 4 in self._sections:
+                    sections.append(self._sections[y >> 4])
+                continue
+
+            self._sections.pop(y >> 4, None)
             section = nbt.TAG_Compound()
 
             Blocks = self.Blocks[..., y:y + 16].swapaxes(0, 2)
-            Data = self.Data[..., y:y + 16].swapaxes(0, 2)
-            BlockLight = self.BlockLight[..., y:y + 16].swapaxes(0, 2)
-            SkyLight = self.SkyLight[..., y:y + 16].swapaxes(0, 2)
+            BlockLight = _sectionNibbles(self.BlockLight, y)
+            SkyLight = _sectionNibbles(self.SkyLight, y)
 
+            # packed nibbles are all 0xff when every light value is 15
             if (not Blocks.any() and
                 not BlockLight.any() and
-                (SkyLight == 15).all()):
+                (SkyLight == 0xff).all()):
                 continue
 
-            Data = packNibbleArray(Data)
-            BlockLight = packNibbleArray(BlockLight)
-            SkyLight = packNibbleArray(SkyLight)
+            Data = _sectionNibbles(self.Data, y)
 
             add = Blocks >> 8
             if add.any():
@@ -209,7 +365,9 @@ class AnvilChunkData(object):
 
             section["Y"] = nbt.TAG_Byte(y / 16)
             sections.append(section)
+            self._sections[y >> 4] = section
 
+        self._dirtySections.clear()
         self.root_tag["Level"]["Sections"] = sections
         data = self.root_tag.save(compressed=False)
         del self.root_tag["Level"]["Sections"]
@@ -240,6 +398,12 @@ class AnvilChunk(LightedChunk):
     def savedTagData(self):
         return self.chunkData.savedTagData()
 
+    def unpackNibbleArrays(self):
+        self.chunkData.unpackNibbleArrays()
+
+    def markDirty(self, miny=0, maxy=None):
+        self.chunkData.markDirty(miny, maxy)
+
 
     def __str__(self):
         return u"AnvilChunk, coords:{0}, world: {1}, D:{2}, L:{3}".format(self.chunkPosition, self.world.displayName, self.dirty, self.needsLighting)
@@ -250,6 +414,8 @@ class AnvilChunk(LightedChunk):
 
     @needsLighting.setter
     def needsLighting(self, value):
+        # the blocks recorded by _recordLightEdits no longer describe the chunk's lighting
+        self.world._lightEdits.pop(self.chunkPosition, None)
         if value:
             self.world.chunksNeedingLighting.add(self.chunkPosition)
         else:
@@ -272,15 +438,15 @@ class AnvilChunk(LightedChunk):
         doubleize("Motion")
         doubleize("Position")
 
-        self.dirty = True
+        self.markDirty(0, 0)
         return super(AnvilChunk, self).addEntity(entityTag)
 
     def removeEntitiesInBox(self, box):
-        self.dirty = True
+        self.markDirty(0, 0)
         return super(AnvilChunk, self).removeEntitiesInBox(box)
 
     def removeTileEntitiesInBox(self, box):
-        self.dirty = True
+        self.markDirty(0, 0)
         return super(AnvilChunk, self).removeTileEntitiesInBox(box)
 
     # --- AnvilChunkData accessors ---
@@ -344,7 +510,7 @@ class AnvilChunk(LightedChunk):
         """True or False. If False, the game will populate the chunk with
         ores and vegetation on next load"""
         self.root_tag["Level"]["TerrainPopulated"].value = val
-        self.dirty = True
+        self.markDirty(0, 0)
 
 
 base36alphabet = "0123456789abcdefghijklmnopqrstuvwxyz"
@@ -410,7 +576,8 @@ class ChunkedLevelMixin(MCLevel):
 
         ch = self.getChunk(xc, zc)
         ch.BlockLight[xInChunk, zInChunk, y] = newLight
-        ch.chunkChanged(False)
+        ch.generateHeightMap()
+        ch.markDirty(y, y + 1)
 
     def blockDataAt(self, x, y, z):
         if y < 0 or y >= self.Height:
@@ -443,8 +610,8 @@ class ChunkedLevelMixin(MCLevel):
             return 0
 
         ch.Data[xInChunk, zInChunk, y] = newdata
-        ch.dirty = True
-        ch.needsLighting = True
+        ch.markDirty(y, y + 1)
+        self._recordLightEdits(ch, [(x, y, z)])
 
     def blockAt(self, x, y, z):
         """returns 0 for blocks outside the loadable chunks.  automatically loads chunks."""
@@ -479,8 +646,62 @@ class ChunkedLevelMixin(MCLevel):
             return 0
 
         ch.Blocks[xInChunk, zInChunk, y] = blockID
-        ch.dirty = True
-        ch.needsLighting = True
+        ch.markDirty(y, y + 1)
+        self._recordLightEdits(ch, [(x, y, z)])
+
+    def _pointsByChunk(self, xs, ys, zs):
+        # groups the points in the flat arrays xs, ys and zs with 0 <= y < Height by chunk, and yields
+        # (chunk, indices) for each chunk that can be loaded
+        indices = flatnonzero((ys >= 0) & (ys < self.Height))
+        cxs = xs[indices] >> 4
+        czs = zs[indices] >> 4
+
+        order = lexsort((czs, cxs))
+        indices, cxs, czs = indices[order], cxs[order], czs[order]
+        starts = flatnonzero(concatenate(([True], (cxs[1:] != cxs[:-1]) | (czs[1:] != czs[:-1]))))
+        ends = append(starts[1:], len(indices))
+
+        for start, end in zip(starts, ends):
+            try:
+                ch = self.getChunk(int(cxs[start]), int(czs[start]))
+            except ChunkNotPresent:
+                continue
+            yield ch, indices[start:end]
+
+    def getBlocksAt(self, xs, ys, zs):
+        """ Returns the block IDs at each of the points given by the arrays xs, ys and zs, like blockAt does for
+        a single point. Points outside the loadable chunks are 0. The result has the shape of the broadcast
+        coordinates.
+
+        The points are grouped by chunk, so each chunk is looked up and indexed once. """
+        shape = broadcast_arrays(asarray(xs), asarray(ys), asarray(zs))[0].shape
+        xs, ys, zs = (a.ravel() for a in broadcast_arrays(asarray(xs, int), asarray(ys, int), asarray(zs, int)))
+        blocks = zeros(len(xs), 'uint16')
+        for ch, i in self._pointsByChunk(xs, ys, zs):
+            blocks[i] = ch.Blocks[xs[i] & 0xf, zs[i] & 0xf, ys[i]]
+        return blocks.reshape(shape)
+
+    def setBlocksAt(self, xs, ys, zs, blockIDs, blockData=None):
+        """ Sets the block ID, and the block data if given, at each of the points given by the arrays xs, ys and
+        zs, like setBlockAt does for a single point. blockIDs and blockData may be arrays or single values. Points
+        outside the loadable chunks are ignored. Where a point is given more than once, the last value wins. """
+        # broadcast the values with the coordinates before they are flattened, so they can have the same shape
+        values = broadcast_arrays(asarray(xs, int), asarray(ys, int), asarray(zs, int), asarray(blockIDs),
+                                  asarray(0 if blockData is None else blockData))
+        xs, ys, zs, blockIDs = (a.ravel() for a in values[:4])
+        if blockData is not None:
+            blockData = values[4].ravel()
+
+        for ch, i in self._pointsByChunk(xs, ys, zs):
+            chunkPoints = xs[i] & 0xf, zs[i] & 0xf, ys[i]
+            ch.Blocks[chunkPoints] = blockIDs[i]
+            if blockData is not None:
+                ch.Data[chunkPoints] = blockData[i]
+            ch.markDirty(int(ys[i].min()), int(ys[i].max()) + 1)
+            if len(i) <= self.incrementalLightingLimit:
+                self._recordLightEdits(ch, zip(xs[i].tolist(), ys[i].tolist(), zs[i].tolist()))
+            else:
+                self._recordLightEdits(ch, None)
 
     def skylightAt(self, x, y, z):
 
@@ -510,7 +731,7 @@ class ChunkedLevelMixin(MCLevel):
 
         oldValue = skyLight[xInChunk, zInChunk, y]
 
-        ch.chunkChanged(False)
+        ch.markDirty(y, y + 1)
         if oldValue < lightValue:
             skyLight[xInChunk, zInChunk, y] = lightValue
         return oldValue < lightValue
@@ -525,8 +746,19 @@ class ChunkedLevelMixin(MCLevel):
     def generateLightsIter(self, dirtyChunkPositions=None):
         """ dirtyChunks may be an iterable yielding (xPos,zPos) tuples
         if none, generate lights for all chunks that need lighting
+
+        If none, and the chunks need lighting only because of a few blocks set with setBlockAt and the like, just
+        the light around those blocks is updated. See incrementalLightingLimit.
         """
 
+        if dirtyChunkPositions is None and self._canRelightEdits():
+            progressInfo = u"Lighting around {0} blocks".format(sum(len(e) for e in self._lightEdits.itervalues()))
+            log.info(progressInfo)
+            yield 0, 1, progressInfo
+            self._relightEdits()
+            yield 1, 1, progressInfo
+            return
+
         startTime = datetime.now()
 
         if dirtyChunkPositions is None:
@@ -596,10 +828,173 @@ class ChunkedLevelMixin(MCLevel):
 
         return
 
-    def _generateLightsIter(self, dirtyChunkPositions):
-        la = array(self.materials.lightAbsorption)
-        clip(la, 1, 15, la)
+    # --- Incremental lighting ---
+
+    # if nonzero, up to this many blocks changed with setBlockAt, setBlockDataAt and setBlocksAt are remembered, and
+    # generateLights updates the light around them instead of relighting their chunks and the chunks next to them.
+    # The result is the same as relighting the chunks. Off here; MCInfdevOldLevel turns it on.
+    incrementalLightingLimit = 0
+
+    def _recordLightEdits(self, chunk, points):
+        # marks the chunk as needing lighting after the blocks at points, a list of (x, y, z), changed. The points
+        # are remembered if the chunk's lighting was otherwise up to date and the edits so far are few enough;
+        # points=None means too many to remember.
+        cPos = chunk.chunkPosition
+        edits = None
+        if self.incrementalLightingLimit and points is not None:
+            if cPos in self._lightEdits or not chunk.needsLighting:
+                edits = self._lightEdits.get(cPos, set())
+
+        chunk.needsLighting = True
+        if edits is not None:
+            edits.update(points)
+            self._lightEdits[cPos] = edits
+            if sum(len(e) for e in self._lightEdits.itervalues()) > self.incrementalLightingLimit:
+                self._lightEdits.clear()
+
+    def _canRelightEdits(self):
+        if not (self.incrementalLightingLimit and self.chunksNeedingLighting):
+            return False
+        if not all(cPos in self._lightEdits for cPos in self.chunksNeedingLighting):
+            return False
 
+        # the edits are relit in one box around all of them, so they must be close together
+        cxs, czs = zip(*self.chunksNeedingLighting)
+        return max(cxs) - min(cxs) < 3 and max(czs) - min(czs) < 3
+
+    def _relightEdits(self):
+        # updates the light around the blocks recorded by _recordLightEdits with a flood fill for each light. The
+        # light that could have come from each changed block is taken away, spreading out through the lower light
+        # around it, and then put back from the blocks at the edge of the darkened area and from each light source
+        # inside it. Each step of the fill handles its whole frontier at once.
+        #
+        # Light falls by at least 1 per block, so nothing further than 14 blocks from a changed block is darkened or
+        # relit. The fill works on a copy of the box reaching 15 blocks past the changed blocks, with a layer of
+        # missing blocks around it so the neighbors of every block in the box are in the copy.
+        points = set()
+        for cPos in list(self.chunksNeedingLighting):
+            points.update(self._lightEdits[cPos])
+            self.getChunk(*cPos).needsLighting = False
+
+        # a block that starts or stops absorbing light moves the top of its column, where the sky light starts. The
+        # heightmap is kept up to date as generateHeightMap would, even where there is no sky light.
+        skyPoints = set(points)
+        if self.dimNo != DIM_NETHER:
+            for x, z in set((x, z) for x, y, z in points):
+                try:
+                    chunk = self.getChunk(x >> 4, z >> 4)
+                except (ChunkNotPresent, ChunkMalformed):
+                    continue
+                absorbing = flatnonzero(self.materials.lightAbsorption[chunk.Blocks[x & 0xf, z & 0xf]])
+                newHeight = absorbing[-1] + 1 if len(absorbing) else 0
+                oldHeight = int(chunk.HeightMap[z & 0xf, x & 0xf])
+                if newHeight != oldHeight:
+                    chunk.HeightMap[z & 0xf, x & 0xf] = newHeight
+                    chunk.markDirty(0, 0)
+                    if self.hasSkyLight:
+                        skyPoints.update((x, y, z) for y in range(min(oldHeight, newHeight), max(oldHeight, newHeight)))
+
+        xs, ys, zs = (array(c) for c in zip(*skyPoints))
+        miny = max(0, ys.min() - 15)
+        box = BoundingBox((xs.min() - 15, miny, zs.min() - 15),
+                          (xs.ptp() + 31, min(self.Height, ys.max() + 16) - miny, zs.ptp() + 31))
+        shape = box.width + 2, box.length + 2, box.height + 2
+
+        blocks = zeros(shape, 'uint16')
+        present = zeros(shape, bool)
+        heights = zeros(shape[:2], 'int32')
+        lights = dict((name, zeros(shape, 'int16')) for name in ("BlockLight", "SkyLight"))
+        chunks = []
+        for cPos, slices, (x, y, z) in getSlices(box, self.Height):
+            try:
+                chunk = self.getChunk(*cPos)
+            except (ChunkNotPresent, ChunkMalformed):
+                continue
+            chunk.unpackNibbleArrays()
+            boxSlices = (slice(x + 1, x + 1 + slices[0].stop - slices[0].start),
+                         slice(z + 1, z + 1 + slices[1].stop - slices[1].start),
+                         slice(1, box.height + 1))
+            blocks[boxSlices] = chunk.Blocks[slices]
+            present[boxSlices] = True
+            heights[boxSlices[:2]] = chunk.HeightMap.swapaxes(0, 1)[slices[:2]]
+            for name, light in lights.iteritems():
+                light[boxSlices] = getattr(chunk, name)[slices]
+            chunks.append((chunk, slices, boxSlices))
+
+        # flat indexes into the copy, and the steps to each block's six neighbors
+        blocks, present = blocks.ravel(), present.ravel()
+        steps = array([1, -1, shape[2], -shape[2], shape[1] * shape[2], -shape[1] * shape[2]])
+        la = array(self.materials.lightAbsorption, 'int16')
+        clip(la, 1, 15, la)
+        la = la[blocks]
+
+        def flatIndexes(points):
+            xs, ys, zs = (array(c) for c in zip(*points))
+            return unique(((xs - box.minx + 1) * shape[1] + zs - box.minz + 1) * shape[2] + ys - box.miny + 1)
+
+        def neighbors(indexes):
+            return (indexes[:, newaxis] + steps).ravel()
+
+        def relight(light, seeds, source):
+            seeds = seeds[present[seeds]]
+
+            # take away the light that may have come from the changed blocks. A neighbor with less light may have
+            # been lit through this block; one with as much or more was lit some other way and lights the darkened
+            # area back up.
+            darkened = [seeds]
+            relit = []
+            frontier = seeds
+            values = light[seeds]
+            light[seeds] = 0
+            while len(frontier):
+                n = neighbors(frontier)
+                v = repeat(values, len(steps))
+                w = light[n]
+                lit = present[n] & (w > 0)
+                n, v, w = n[lit], v[lit], w[lit]
+                dimmer = w < v
+                relit.append(n[~dimmer])
+                frontier, first = unique(n[dimmer], return_index=True)
+                values = w[dimmer][first]
+                light[frontier] = 0
+                darkened.append(frontier)
+
+            darkened = concatenate(darkened)
+            light[darkened] = source(darkened)
+            frontier = unique(concatenate(relit + [darkened]))
+
+            while len(frontier):
+                n = neighbors(frontier)
+                newLight = repeat(light[frontier], len(steps)) - la[n]
+                brighter = present[n] & (newLight > light[n])
+                n, newLight = n[brighter], newLight[brighter]
+                order = newLight.argsort()
+                light[n[order]] = newLight[order]  # the brightest of several writes to a block comes last
+                frontier = unique(n)
+
+        def blockLightSource(indexes):
+            return self.materials.lightEmission[blocks[indexes]]
+
+        def skyLightSource(indexes):
+            columns, ys = divmod(indexes, shape[2])
+            return where(ys - 1 + box.miny >= heights.ravel()[columns], 15, 0)
+
+        relight(lights["BlockLight"].ravel(), flatIndexes(points), blockLightSource)
+        if self.hasSkyLight:
+            relight(lights["SkyLight"].ravel(), flatIndexes(skyPoints), skyLightSource)
+
+        for chunk, slices, boxSlices in chunks:
+            for name, light in lights.iteritems():
+                chunkLight = getattr(chunk, name)[slices]
+                changed = light[boxSlices] != chunkLight
+                ys = flatnonzero(changed.reshape(-1, changed.shape[2]).any(0))
+                if len(ys):
+                    chunkLight[:] = light[boxSlices]
+                    chunk.markDirty(slices[2].start + ys[0], slices[2].start + ys[-1] + 1)
+
+    def _generateLightsIter(self, dirtyChunkPositions, chunkPositions=None):
+        # if chunkPositions is given, only the chunks in it are relit or spread into, and the rest are treated as
+        # missing. See _lightRegion.
         dirtyChunks = set(self.getChunk(*cPos) for cPos in dirtyChunkPositions)
 
         workDone = 0
@@ -621,30 +1016,48 @@ class ChunkedLevelMixin(MCLevel):
             # relight all blocks in neighboring chunks in case their light source disappeared.
             cx, cz = ch.chunkPosition
             for dx, dz in itertools.product((-1, 0, 1), (-1, 0, 1)):
+                if chunkPositions is not None and (cx + dx, cz + dz) not in chunkPositions:
+                    continue
                 try:
                     ch = self.getChunk(cx + dx, cz + dz)
                 except (ChunkNotPresent, ChunkMalformed):
                     continue
                 dirtyChunks.add(ch)
-                ch.dirty = True
 
         dirtyChunks = sorted(dirtyChunks, key=lambda x: x.chunkPosition)
         workTotal += len(dirtyChunks) * 28
 
         for i, chunk in enumerate(dirtyChunks):
-            chunk.BlockLight[:] = self.materials.lightEmission[chunk.Blocks]
-            chunk.dirty = True
+            # only the heights where the reset changes the light need saving; _spreadLightsIter marks the heights
+            # where it changes it afterward.
+            chunk.unpackNibbleArrays()
+            blockLight = self.materials.lightEmission[chunk.Blocks]
+            changed = blockLight != chunk.BlockLight
+            ys = flatnonzero(changed.reshape(-1, changed.shape[2]).any(0))
+            if len(ys):
+                chunk.BlockLight[:] = blockLight
+                chunk.markDirty(ys[0], ys[-1] + 1)
+
+        for progress in self._spreadLightsIter(dirtyChunks, workDone, workTotal, chunkPositions):
+            yield progress
+
+        for ch in dirtyChunks:
+            ch.needsLighting = False
+
+    def _spreadLightsIter(self, startingDirtyChunks, workDone=0, workTotal=0, chunkPositions=None):
+        # spreads the light in startingDirtyChunks to each other and to their neighbors until it stops changing or
+        # for 14 passes, without resetting it first. Yields progress continuing from workDone and workTotal.
+        la = array(self.materials.lightAbsorption)
+        clip(la, 1, 15, la)
+
+        for chunk in startingDirtyChunks:
+            chunk.unpackNibbleArrays()
 
         zeroChunk = ZeroChunk(self.Height)
         zeroChunk.BlockLight[:] = 0
         zeroChunk.SkyLight[:] = 0
 
-        startingDirtyChunks = dirtyChunks
-
-        oldLeftEdge = zeros((1, 16, self.Height), 'uint8')
-        oldBottomEdge = zeros((16, 1, self.Height), 'uint8')
-        oldChunk = zeros((16, 16, self.Height), 'uint8')
-        if self.dimNo in (-1, 1):
+        if not self.hasSkyLight:
             lights = ("BlockLight",)
         else:
             lights = ("BlockLight", "SkyLight")
@@ -656,13 +1069,68 @@ class ChunkedLevelMixin(MCLevel):
             # and then clip to range
             light.view('int8').clip(0, 15, light)
 
+        def changedRange(changed, miny):
+            # returns the (miny, maxy) range of heights where an [x, z, y] mask is set, offset by miny, or None
+            ys = flatnonzero(changed.reshape(-1, changed.shape[2]).any(0))
+            if not len(ys):
+                return None
+            return miny + ys[0], miny + ys[-1] + 1
+
+        def addDirtyRange(dirtyRanges, chunk, yRange):
+            if yRange is None:
+                return
+            miny, maxy = yRange
+            if chunk in dirtyRanges:
+                oldMiny, oldMaxy = dirtyRanges[chunk]
+                miny, maxy = min(miny, oldMiny), max(maxy, oldMaxy)
+            dirtyRanges[chunk] = miny, maxy
+            chunk.markDirty(*yRange)
+
+        edges = ((FaceXDecreasing, -1, 0, (slice(15, 16), slice(None))),
+                 (FaceXIncreasing, 1, 0, (slice(0, 1), slice(None))),
+                 (FaceZDecreasing, 0, -1, (slice(None), slice(15, 16))),
+                 (FaceZIncreasing, 0, 1, (slice(None), slice(0, 1))))
+
+        opaqueLayers = {}
+
+        def layerLimits(light):
+            # returns the lowest and highest light in each layer of an [x, z, y] array
+            light = light.reshape(-1, light.shape[2])
+            return light.min(0), light.max(0)
+
+        def activeRange(chunk, neighboringChunks, light, miny, maxy):
+            # narrows miny, maxy to the layers where the light can still change. A layer is skipped if its light and
+            # the light at its neighbors' edges is all 0 or all 15, or if it is all opaque and dark, since it will
+            # neither take in nor give out any light. Only the layers at the top and bottom of the range are skipped,
+            # and one of them is kept at each end so light can still move up or down into it.
+            if chunk not in opaqueLayers:
+                opaqueLayers[chunk] = (la[chunk.Blocks] == 15).reshape(-1, chunk.Blocks.shape[2]).all(0)
+
+            low, high = layerLimits(getattr(chunk, light)[:, :, miny:maxy])
+            sealed = opaqueLayers[chunk][miny:maxy] & (high == 0)
+            for dir, dx, dz, edge in edges:
+                nc = neighboringChunks[dir]
+                if nc is not zeroChunk:  # the zero chunk gives out no light and drops what it takes in
+                    edgeLow, edgeHigh = layerLimits(getattr(nc, light)[edge + (slice(miny, maxy),)])
+                    low, high = minimum(low, edgeLow), maximum(high, edgeHigh)
+
+            active = flatnonzero(~(sealed | (high == 0) | (low == 15)))
+            if not len(active):
+                return miny, miny
+            return max(miny, miny + active[0] - 1), min(maxy, miny + active[-1] + 2)
+
         for j, light in enumerate(lights):
             zerochunkLight = getattr(zeroChunk, light)
-            newDirtyChunks = list(startingDirtyChunks)
+
+            # chunk : (miny, maxy) for the heights where each chunk's light changed on the last pass. Light moves one
+            # block up or down per pass, so a chunk's next pass only has to look at that range and one block past
+            # each end of it. The first pass looks at the whole height of every chunk.
+            newDirtyChunks = dict((ch, (0, self.Height)) for ch in startingDirtyChunks)
 
             work = 0
 
             for i in range(14):
+                newDirtyChunks.pop(zeroChunk, None)
                 if len(newDirtyChunks) == 0:
                     workTotal -= len(startingDirtyChunks) * (14 - i)
                     break
@@ -678,166 +1146,177 @@ class ChunkedLevelMixin(MCLevel):
 #                we calculate all chunks one step before moving to the next step, to ensure all gaps at chunk edges are filled.
 #                we do an extra cycle because lights sent across edges may lag by one cycle.
 #
-#                xxx this can be optimized by finding the highest and lowest blocks
-#                that changed after one pass, and only calculating changes for that
-#                vertical slice on the next pass. newDirtyChunks would have to be a
-#                list of (cPos, miny, maxy) tuples or a cPos : (miny, maxy) dict
-
-                newDirtyChunks = set(newDirtyChunks)
-                newDirtyChunks.discard(zeroChunk)
+#                each chunk is only calculated between the lowest and highest blocks that changed on the previous pass,
+#                widened by one block. Changes made to a chunk's edges by neighbors calculated earlier in this pass are
+#                added to its range before it is calculated, as they would be seen if the whole chunk were calculated.
 
-                dirtyChunks = sorted(newDirtyChunks, key=lambda x: x.chunkPosition)
+                dirtyRanges = newDirtyChunks
+                dirtyChunks = sorted(dirtyRanges, key=lambda x: x.chunkPosition)
 
-                newDirtyChunks = list()
+                newDirtyChunks = dict()
 
                 for chunk in dirtyChunks:
                     (cx, cz) = chunk.chunkPosition
-                    neighboringChunks = {}
-
-                    for dir, dx, dz in ((FaceXDecreasing, -1, 0),
-                                        (FaceXIncreasing, 1, 0),
-                                        (FaceZDecreasing, 0, -1),
-                                        (FaceZIncreasing, 0, 1)):
-                        try:
-                            neighboringChunks[dir] = self.getChunk(cx + dx, cz + dz)
-                        except (ChunkNotPresent, ChunkMalformed):
-                            neighboringChunks[dir] = zeroChunk
-                        neighboringChunks[dir].dirty = True
+                    miny, maxy = dirtyRanges[chunk]
+                    if chunk in newDirtyChunks:
+                        miny, maxy = min(miny, newDirtyChunks[chunk][0]), max(maxy, newDirtyChunks[chunk][1])
+                    miny, maxy = max(0, miny - 1), min(self.Height, maxy + 1)
 
-                    chunkLa = la[chunk.Blocks]
-                    chunkLight = getattr(chunk, light)
-                    oldChunk[:] = chunkLight[:]
+                    neighboringChunks = {}
+                    oldEdges = {}
+
+                    for dir, dx, dz, edge in edges:
+                        nc = zeroChunk
+                        if chunkPositions is None or (cx + dx, cz + dz) in chunkPositions:
+                            try:
+                                nc = self.getChunk(cx + dx, cz + dz)
+                            except (ChunkNotPresent, ChunkMalformed):
+                                pass
+                        nc.unpackNibbleArrays()
+                        neighboringChunks[dir] = nc
+
+                    if i == 0:
+                        miny, maxy = activeRange(chunk, neighboringChunks, light, miny, maxy)
+                    if miny == maxy:
+                        work += 1
+                        yield workDone + work, workTotal, progressInfo
+                        continue
+
+                    for dir, dx, dz, edge in edges:
+                        oldEdges[dir] = getattr(neighboringChunks[dir], light)[edge + (slice(miny, maxy),)].copy()
+
+                    chunkLa = la[chunk.Blocks[:, :, miny:maxy]]
+                    chunkLight = getattr(chunk, light)[:, :, miny:maxy]
+                    oldChunk = chunkLight.copy()
 
                     ### Spread light toward -X
 
                     nc = neighboringChunks[FaceXDecreasing]
-                    ncLight = getattr(nc, light)
-                    oldLeftEdge[:] = ncLight[15:16, :, 0:self.Height]  # save the old left edge
+                    ncLight = getattr(nc, light)[:, :, miny:maxy]
 
                     # left edge
-                    newlight = (chunkLight[0:1, :, :self.Height] - la[nc.Blocks[15:16, :, 0:self.Height]])
+                    newlight = (chunkLight[0:1] - la[nc.Blocks[15:16, :, miny:maxy]])
                     clipLight(newlight)
 
-                    maximum(ncLight[15:16, :, 0:self.Height], newlight, ncLight[15:16, :, 0:self.Height])
+                    maximum(ncLight[15:16], newlight, ncLight[15:16])
 
                     # chunk body
-                    newlight = (chunkLight[1:16, :, 0:self.Height] - chunkLa[0:15, :, 0:self.Height])
+                    newlight = (chunkLight[1:16] - chunkLa[0:15])
                     clipLight(newlight)
 
-                    maximum(chunkLight[0:15, :, 0:self.Height], newlight, chunkLight[0:15, :, 0:self.Height])
+                    maximum(chunkLight[0:15], newlight, chunkLight[0:15])
 
                     # right edge
                     nc = neighboringChunks[FaceXIncreasing]
-                    ncLight = getattr(nc, light)
+                    ncLight = getattr(nc, light)[:, :, miny:maxy]
 
-                    newlight = ncLight[0:1, :, :self.Height] - chunkLa[15:16, :, 0:self.Height]
+                    newlight = ncLight[0:1] - chunkLa[15:16]
                     clipLight(newlight)
 
-                    maximum(chunkLight[15:16, :, 0:self.Height], newlight, chunkLight[15:16, :, 0:self.Height])
+                    maximum(chunkLight[15:16], newlight, chunkLight[15:16])
 
                     ### Spread light toward +X
 
                     # right edge
                     nc = neighboringChunks[FaceXIncreasing]
-                    ncLight = getattr(nc, light)
+                    ncLight = getattr(nc, light)[:, :, miny:maxy]
 
-                    newlight = (chunkLight[15:16, :, 0:self.Height] - la[nc.Blocks[0:1, :, 0:self.Height]])
+                    newlight = (chunkLight[15:16] - la[nc.Blocks[0:1, :, miny:maxy]])
                     clipLight(newlight)
 
-                    maximum(ncLight[0:1, :, 0:self.Height], newlight, ncLight[0:1, :, 0:self.Height])
+                    maximum(ncLight[0:1], newlight, ncLight[0:1])
 
                     # chunk body
-                    newlight = (chunkLight[0:15, :, 0:self.Height] - chunkLa[1:16, :, 0:self.Height])
+                    newlight = (chunkLight[0:15] - chunkLa[1:16])
                     clipLight(newlight)
 
-                    maximum(chunkLight[1:16, :, 0:self.Height], newlight, chunkLight[1:16, :, 0:self.Height])
+                    maximum(chunkLight[1:16], newlight, chunkLight[1:16])
 
                     # left edge
                     nc = neighboringChunks[FaceXDecreasing]
-                    ncLight = getattr(nc, light)
+                    ncLight = getattr(nc, light)[:, :, miny:maxy]
 
-                    newlight = ncLight[15:16, :, :self.Height] - chunkLa[0:1, :, 0:self.Height]
+                    newlight = ncLight[15:16] - chunkLa[0:1]
                     clipLight(newlight)
 
-                    maximum(chunkLight[0:1, :, 0:self.Height], newlight, chunkLight[0:1, :, 0:self.Height])
+                    maximum(chunkLight[0:1], newlight, chunkLight[0:1])
 
                     zerochunkLight[:] = 0  # zero the zero chunk after each direction
                     # so the lights it absorbed don't affect the next pass
 
-                    # check if the left edge changed and dirty or compress the chunk appropriately
-                    if (oldLeftEdge != ncLight[15:16, :, :self.Height]).any():
-                        # chunk is dirty
-                        newDirtyChunks.append(nc)
-
                     ### Spread light toward -Z
 
                     # bottom edge
                     nc = neighboringChunks[FaceZDecreasing]
-                    ncLight = getattr(nc, light)
-                    oldBottomEdge[:] = ncLight[:, 15:16, :self.Height]  # save the old bottom edge
+                    ncLight = getattr(nc, light)[:, :, miny:maxy]
 
-                    newlight = (chunkLight[:, 0:1, :self.Height] - la[nc.Blocks[:, 15:16, :self.Height]])
+                    newlight = (chunkLight[:, 0:1] - la[nc.Blocks[:, 15:16, miny:maxy]])
                     clipLight(newlight)
 
-                    maximum(ncLight[:, 15:16, :self.Height], newlight, ncLight[:, 15:16, :self.Height])
+                    maximum(ncLight[:, 15:16], newlight, ncLight[:, 15:16])
 
                     # chunk body
-                    newlight = (chunkLight[:, 1:16, :self.Height] - chunkLa[:, 0:15, :self.Height])
+                    newlight = (chunkLight[:, 1:16] - chunkLa[:, 0:15])
                     clipLight(newlight)
 
-                    maximum(chunkLight[:, 0:15, :self.Height], newlight, chunkLight[:, 0:15, :self.Height])
+                    maximum(chunkLight[:, 0:15], newlight, chunkLight[:, 0:15])
 
                     # top edge
                     nc = neighboringChunks[FaceZIncreasing]
-                    ncLight = getattr(nc, light)
+                    ncLight = getattr(nc, light)[:, :, miny:maxy]
 
-                    newlight = ncLight[:, 0:1, :self.Height] - chunkLa[:, 15:16, 0:self.Height]
+                    newlight = ncLight[:, 0:1] - chunkLa[:, 15:16]
                     clipLight(newlight)
 
-                    maximum(chunkLight[:, 15:16, 0:self.Height], newlight, chunkLight[:, 15:16, 0:self.Height])
+                    maximum(chunkLight[:, 15:16], newlight, chunkLight[:, 15:16])
 
                     ### Spread light toward +Z
 
                     # top edge
                     nc = neighboringChunks[FaceZIncreasing]
+                    ncLight = getattr(nc, light)[:, :, miny:maxy]
 
-                    ncLight = getattr(nc, light)
-
-                    newlight = (chunkLight[:, 15:16, :self.Height] - la[nc.Blocks[:, 0:1, :self.Height]])
+                    newlight = (chunkLight[:, 15:16] - la[nc.Blocks[:, 0:1, miny:maxy]])
                     clipLight(newlight)
 
-                    maximum(ncLight[:, 0:1, :self.Height], newlight, ncLight[:, 0:1, :self.Height])
+                    maximum(ncLight[:, 0:1], newlight, ncLight[:, 0:1])
 
                     # chunk body
-                    newlight = (chunkLight[:, 0:15, :self.Height] - chunkLa[:, 1:16, :self.Height])
+                    newlight = (chunkLight[:, 0:15] - chunkLa[:, 1:16])
                     clipLight(newlight)
 
-                    maximum(chunkLight[:, 1:16, :self.Height], newlight, chunkLight[:, 1:16, :self.Height])
+                    maximum(chunkLight[:, 1:16], newlight, chunkLight[:, 1:16])
 
                     # bottom edge
                     nc = neighboringChunks[FaceZDecreasing]
-                    ncLight = getattr(nc, light)
+                    ncLight = getattr(nc, light)[:, :, miny:maxy]
 
-                    newlight = ncLight[:, 15:16, :self.Height] - chunkLa[:, 0:1, 0:self.Height]
+                    newlight = ncLight[:, 15:16] - chunkLa[:, 0:1]
                     clipLight(newlight)
 
-                    maximum(chunkLight[:, 0:1, 0:self.Height], newlight, chunkLight[:, 0:1, 0:self.Height])
+                    maximum(chunkLight[:, 0:1], newlight, chunkLight[:, 0:1])
 
                     zerochunkLight[:] = 0
 
-                    if (oldBottomEdge != ncLight[:, 15:16, :self.Height]).any():
-                        newDirtyChunks.append(nc)
+                    ### Spread light up and down
 
-                    newlight = (chunkLight[:, :, 0:self.Height - 1] - chunkLa[:, :, 1:self.Height])
+                    newlight = (chunkLight[:, :, :-1] - chunkLa[:, :, 1:])
                     clipLight(newlight)
-                    maximum(chunkLight[:, :, 1:self.Height], newlight, chunkLight[:, :, 1:self.Height])
+                    maximum(chunkLight[:, :, 1:], newlight, chunkLight[:, :, 1:])
 
-                    newlight = (chunkLight[:, :, 1:self.Height] - chunkLa[:, :, 0:self.Height - 1])
+                    newlight = (chunkLight[:, :, 1:] - chunkLa[:, :, :-1])
                     clipLight(newlight)
-                    maximum(chunkLight[:, :, 0:self.Height - 1], newlight, chunkLight[:, :, 0:self.Height - 1])
+                    maximum(chunkLight[:, :, :-1], newlight, chunkLight[:, :, :-1])
+
+                    # every neighbor whose edge changed, and this chunk if it changed, gets another pass over the
+                    # heights that changed
+                    for dir, dx, dz, edge in edges:
+                        nc = neighboringChunks[dir]
+                        if nc is not zeroChunk:
+                            ncEdge = getattr(nc, light)[edge + (slice(miny, maxy),)]
+                            addDirtyRange(newDirtyChunks, nc, changedRange(oldEdges[dir] != ncEdge, miny))
 
-                    if (oldChunk != chunkLight).any():
-                        newDirtyChunks.append(chunk)
+                    addDirtyRange(newDirtyChunks, chunk, changedRange(oldChunk != chunkLight, miny))
 
                     work += 1
                     yield workDone + work, workTotal, progressInfo
@@ -848,9 +1327,6 @@ class ChunkedLevelMixin(MCLevel):
 
                 work = 0
 
-        for ch in startingDirtyChunks:
-            ch.needsLighting = False
-
 
 def TagProperty(tagName, tagType, default_or_func=None):
     def getter(self):
@@ -869,7 +1345,15 @@ def TagProperty(tagName, tagType, default_or_func=None):
     return property(getter, setter)
 
 class AnvilWorldFolder(object):
-    def __init__(self, filename):
+    useChunkIndex = False  # if True, listChunks keeps an index of the chunks in each region file. see loadChunkIndex
+    maxOpenRegionFiles = 0  # if nonzero, region files are kept open in a FileHandlePool of this size
+
+    # how chunks are stored by saveChunk. compressMode is MCRegionFile.VERSION_DEFLATE or VERSION_UNCOMPRESSED, and
+    # compressionLevel is the zlib level from 0 to 9. Only use VERSION_UNCOMPRESSED for folders Minecraft never reads.
+    compressMode = MCRegionFile.VERSION_DEFLATE
+    compressionLevel = MCRegionFile.compressionLevel
+
+    def __init__(self, filename, readonly=False):
         if not os.path.exists(filename):
             os.mkdir(filename)
 
@@ -877,7 +1361,21 @@ class AnvilWorldFolder(object):
             raise IOError, "AnvilWorldFolder: Not a folder: %s" % filename
 
         self.filename = filename
+        self.readonly = readonly
         self.regionFiles = {}
+        if self.maxOpenRegionFiles:
+            self.filePool = FileHandlePool(self.maxOpenRegionFiles)
+        else:
+            self.filePool = None
+
+        # if set, saveChunk queues chunks to be compressed and written by this ChunkWriter's threads
+        self.chunkWriter = None
+        # if set, called on the chunkWriter's thread just before each queued chunk is written. It raises to stop the
+        # write, and the error is raised by the chunkWriter's next submit or flush.
+        self.sessionLockCheck = None
+        self._pendingChunks = {}  # (cx, cz) -> uncompressed data queued on the chunkWriter
+        self._regionLocks = {}
+        self._regionLocksLock = threading.Lock()
 
     # --- File paths ---
 
@@ -901,7 +1399,7 @@ class AnvilWorldFolder(object):
         regionFile = self.regionFiles.get((rx, rz))
         if regionFile:
             return regionFile
-        regionFile = MCRegionFile(self.getRegionFilename(rx, rz), (rx, rz))
+        regionFile = MCRegionFile(self.getRegionFilename(rx, rz), (rx, rz), self.filePool)
         self.regionFiles[rx, rz] = regionFile
         return regionFile
 
@@ -910,16 +1408,63 @@ class AnvilWorldFolder(object):
         rz = cz >> 5
         return self.getRegionFile(rx, rz)
 
+    def flush(self):
+        """ Write any queued chunks and deferred region headers. See MCRegionFile.deferHeaderWrites """
+        self.waitForWrites()
+        for rf in self.regionFiles.itervalues():
+            rf.flush()
+
     def closeRegions(self):
+        self.waitForWrites()
         for rf in self.regionFiles.values():
             rf.close()
 
         self.regionFiles = {}
+        if self.filePool is not None:
+            self.filePool.closeAll()
+
+    # --- Background writes ---
+
+    def waitForWrites(self):
+        """ Waits until every chunk queued on the chunkWriter has been written. Called before any operation that
+        reads or changes more than one chunk. """
+        if self.chunkWriter is not None:
+            self.chunkWriter.flush()
+
+    def _regionLock(self, cx, cz):
+        # held while a region file is used by the caller's thread or by the chunkWriter, so only one thread at a
+        # time reads or writes each region file
+        key = cx >> 5, cz >> 5
+        with self._regionLocksLock:
+            lock = self._regionLocks.get(key)
+            if lock is None:
+                lock = self._regionLocks[key] = threading.Lock()
+        return lock
+
+    def _writeQueuedChunk(self, cx, cz):
+        # runs on a chunkWriter thread. if the chunk was saved again before this ran, the newest data is written
+        # and the later call finds nothing left to do.
+        lock = self._regionLock(cx, cz)
+        with lock:
+            data = self._pendingChunks.get((cx, cz))
+            if data is None:
+                return
+            regionFile = self.getRegionForChunk(cx, cz)
+
+        compressed, format = regionFile.compressChunk(data, self.compressMode, self.compressionLevel)
+
+        with lock:
+            if self._pendingChunks.get((cx, cz)) is not data:
+                return
+            if self.sessionLockCheck is not None:
+                self.sessionLockCheck()
+            regionFile._saveChunk(cx, cz, compressed, format)
+            del self._pendingChunks[cx, cz]
 
     # --- Chunks and chunk listing ---
 
-    def tryLoadRegionFile(self, filepath):
-        filename = os.path.basename(filepath)
+    @staticmethod
+    def regionCoordsForFilename(filename):
         bits = filename.split('.')
         if len(bits) < 4 or bits[0] != 'r' or bits[3] != "mca":
             return None
@@ -929,7 +1474,14 @@ class AnvilWorldFolder(object):
         except ValueError:
             return None
 
-        return MCRegionFile(filepath, (rx, rz))
+        return rx, rz
+
+    def tryLoadRegionFile(self, filepath):
+        regionCoords = self.regionCoordsForFilename(os.path.basename(filepath))
+        if regionCoords is None:
+            return None
+
+        return MCRegionFile(filepath, regionCoords, self.filePool)
 
     def findRegionFiles(self):
         regionDir = self.getFolderPath("region")
@@ -938,10 +1490,90 @@ class AnvilWorldFolder(object):
         for filename in regionFiles:
             yield os.path.join(regionDir, filename)
 
+    # --- Chunk index ---
+
+    CHUNK_INDEX_FILENAME = "##MCEDIT.CHUNKS##.dat"
+    CHUNK_INDEX_VERSION = 1
+
+    def loadChunkIndex(self):
+        """
+        The chunk index records which chunks are present in each region file, along with the size and modification
+        time the file had when it was scanned. listChunks uses it to skip region files that have not changed since.
+
+        Returns a dict mapping region filenames to (size, mtime, bitmap) tuples, where bitmap is a packed string
+        with one bit per offset table entry. Returns an empty dict if the index is missing or unreadable.
+        """
+        path = self.getFilePath(self.CHUNK_INDEX_FILENAME)
+        if not os.path.exists(path):
+            return {}
+
+        try:
+            root_tag = nbt.load(path)
+            if root_tag["Version"].value != self.CHUNK_INDEX_VERSION:
+                return {}
+
+            return dict((name, (tag["Size"].value, tag["MTime"].value, tag["Chunks"].value.tostring()))
+                        for name, tag in root_tag["Regions"].iteritems())
+        except Exception, e:
+            log.info(u"Error loading chunk index {0}: {1!r}".format(path, e))
+            return {}
+
+    def saveChunkIndex(self, index):
+        root_tag = nbt.TAG_Compound()
+        root_tag["Version"] = nbt.TAG_Int(self.CHUNK_INDEX_VERSION)
+        regions = root_tag["Regions"] = nbt.TAG_Compound()
+        for name, (size, mtime, bitmap) in index.iteritems():
+            tag = regions[name] = nbt.TAG_Compound()
+            tag["Size"] = nbt.TAG_Long(size)
+            tag["MTime"] = nbt.TAG_Double(mtime)
+            tag["Chunks"] = nbt.TAG_Byte_Array(frombuffer(bitmap, 'uint8'))
+
+        path = self.getFilePath(self.CHUNK_INDEX_FILENAME)
+        try:
+            root_tag.save(path + ".tmp")
+            if os.path.exists(path) and sys.platform == "win32":
+                os.unlink(path)  # rename can't replace files on Windows
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError), e:
+            log.info(u"Error saving chunk index {0}: {1!r}".format(path, e))
+
+    def _indexedChunkPositions(self, index, filepath, st):
+        entry = index.get(os.path.basename(filepath))
+        if entry is None:
+            return None
+
+        size, mtime, bitmap = entry
+        if size != st.st_size or mtime != st.st_mtime:
+            return None
+
+        indexes = unpackbits(frombuffer(bitmap, 'uint8')).nonzero()[0]
+        if not len(indexes):
+            return None  # let the region file be opened and removed
+
+        return regionChunkPositions(self.regionCoordsForFilename(os.path.basename(filepath)), indexes)
+
     def listChunks(self):
         chunks = set()
+        self.flush()  # region files are reopened below, so their headers must be up to date
+
+        if self.useChunkIndex:
+            index = self.loadChunkIndex()
+            newIndex = {}
+        else:
+            index = newIndex = None
 
         for filepath in self.findRegionFiles():
+            if index is not None:
+                if self.regionCoordsForFilename(os.path.basename(filepath)) is None:
+                    continue
+
+                st = os.stat(filepath)
+                positions = self._indexedChunkPositions(index, filepath, st)
+                if positions is not None:
+                    chunks.update(positions)
+                    newIndex[os.path.basename(filepath)] = index[os.path.basename(filepath)]
+                    continue
+
             regionFile = self.tryLoadRegionFile(filepath)
             if regionFile is None:
                 continue
@@ -950,23 +1582,31 @@ class AnvilWorldFolder(object):
                 rx, rz = regionFile.regionCoords
                 self.regionFiles[rx, rz] = regionFile
 
-                for index, offset in enumerate(regionFile.offsets):
-                    if offset:
-                        cx = index & 0x1f
-                        cz = index >> 5
+                chunks.update(regionFile.chunkPositions())
 
-                        cx += rx << 5
-                        cz += rz << 5
-
-                        chunks.add((cx, cz))
+                # a file modified within the last couple of seconds may be modified again without its mtime
+                # changing, so it is left out of the index until it has settled
+                if index is not None and time.time() - st.st_mtime > 2:
+                    newIndex[os.path.basename(filepath)] = (st.st_size, st.st_mtime,
+                                                            packbits(regionFile.offsets != 0).tostring())
             else:
                 log.info(u"Removing empty region file {0}".format(filepath))
                 regionFile.close()
                 os.unlink(regionFile.path)
 
+        if index is not None and newIndex != index and not self.readonly:
+            self.saveChunkIndex(newIndex)
+
         return chunks
 
     def containsChunk(self, cx, cz):
+        with self._regionLock(cx, cz):
+            return self._containsChunk(cx, cz)
+
+    def _containsChunk(self, cx, cz):
+        if (cx, cz) in self._pendingChunks:
+            return True
+
         rx = cx >> 5
         rz = cz >> 5
         if not os.path.exists(self.getRegionFilename(rx, rz)):
@@ -975,33 +1615,101 @@ class AnvilWorldFolder(object):
         return self.getRegionForChunk(cx, cz).containsChunk(cx, cz)
 
     def deleteChunk(self, cx, cz):
-        r = cx >> 5, cz >> 5
-        rf = self.getRegionFile(*r)
-        if rf:
-            rf.setOffset(cx & 0x1f, cz & 0x1f, 0)
-            if (rf.offsets == 0).all():
-                rf.close()
-                os.unlink(rf.path)
-                del self.regionFiles[r]
+        self.waitForWrites()
+        with self._regionLock(cx, cz):
+            r = cx >> 5, cz >> 5
+            rf = self.getRegionFile(*r)
+            if rf:
+                rf.setOffset(cx & 0x1f, cz & 0x1f, 0)
+                if (rf.offsets == 0).all():
+                    rf.close()
+                    os.unlink(rf.path)
+                    del self.regionFiles[r]
 
     def readChunk(self, cx, cz):
-        if not self.containsChunk(cx, cz):
-            raise ChunkNotPresent((cx, cz))
+        with self._regionLock(cx, cz):
+            data = self._pendingChunks.get((cx, cz))
+            if data is not None:
+                return data
+
+            if not self._containsChunk(cx, cz):
+                raise ChunkNotPresent((cx, cz))
 
-        return self.getRegionForChunk(cx, cz).readChunk(cx, cz)
+            return self.getRegionForChunk(cx, cz).readChunk(cx, cz)
+
+    def readChunks(self, chunkPositions=None):
+        """
+        Yields (cx, cz, data) for each of the given chunks that are present, or for every chunk in the folder. The
+        chunks are grouped by region file and read in the order they are stored. data is None for chunks that could
+        not be decompressed. See MCRegionFile.readChunks
+        """
+        self.waitForWrites()
+        if chunkPositions is None:
+            regions = {}
+            for filepath in self.findRegionFiles():
+                regionCoords = self.regionCoordsForFilename(os.path.basename(filepath))
+                if regionCoords is not None:
+                    regions[regionCoords] = None
+        else:
+            regions = defaultdict(set)
+            for cx, cz in chunkPositions:
+                regions[cx >> 5, cz >> 5].add((cx, cz))
+
+        for rx, rz in sorted(regions):
+            if not os.path.exists(self.getRegionFilename(rx, rz)):
+                continue
+
+            for chunk in self.getRegionFile(rx, rz).readChunks(regions[rx, rz]):
+                yield chunk
 
     def saveChunk(self, cx, cz, data):
-        regionFile = self.getRegionForChunk(cx, cz)
-        regionFile.saveChunk(cx, cz, data)
+        if self.chunkWriter is not None:
+            with self._regionLock(cx, cz):
+                self._pendingChunks[cx, cz] = data
+            self.chunkWriter.submit(self._writeQueuedChunk, cx, cz)
+            return
+
+        with self._regionLock(cx, cz):
+            regionFile = self.getRegionForChunk(cx, cz)
+            regionFile.saveChunk(cx, cz, data, self.compressMode, self.compressionLevel)
+
+    def saveCompressedChunk(self, cx, cz, data, format):
+        """ Like saveChunk, for data and format returned by MCRegionFile.compressChunk. """
+        with self._regionLock(cx, cz):
+            self._pendingChunks.pop((cx, cz), None)  # an older save still queued on the chunkWriter is dropped
+            self.getRegionForChunk(cx, cz)._saveChunk(cx, cz, data, format)
 
     def copyChunkFrom(self, worldFolder, cx, cz):
-        fromRF = worldFolder.getRegionForChunk(cx, cz)
-        rf = self.getRegionForChunk(cx, cz)
-        rf.copyChunkFrom(fromRF, cx, cz)
+        self.waitForWrites()
+        worldFolder.waitForWrites()
+        with self._regionLock(cx, cz):
+            with worldFolder._regionLock(cx, cz):
+                fromRF = worldFolder.getRegionForChunk(cx, cz)
+                rf = self.getRegionForChunk(cx, cz)
+                rf.copyChunkFrom(fromRF, cx, cz)
+
+    # --- Compaction ---
+
+    def compactRegion(self, rx, rz):
+        """ Removes the free space from a region file. Returns the number of bytes reclaimed. """
+        self.waitForWrites()
+        with self._regionLock(rx << 5, rz << 5):
+            return self.getRegionFile(rx, rz).compact()
+
+    def compactWorld(self):
+        """ Removes the free space from every region file. Returns the total number of bytes reclaimed. """
+        reclaimed = 0
+        for filepath in self.findRegionFiles():
+            regionCoords = self.regionCoordsForFilename(os.path.basename(filepath))
+            if regionCoords is not None:
+                reclaimed += self.compactRegion(*regionCoords)
+
+        return reclaimed
 
 class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
 
-    def __init__(self, filename=None, create=False, random_seed=None, last_played=None, readonly=False):
+    def __init__(self, filename=None, create=False, random_seed=None, last_played=None, readonly=False,
+                 sessionLock=None):
         """
         Load an Alpha level from the given filename. It can point to either
         a level.dat or a folder containing one. If create is True, it will
@@ -1010,6 +1718,10 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         and long(time.time() * 1000) will be used for LastPlayed.
 
         If you try to create an existing world, its level.dat will be replaced.
+
+        sessionLock is for the worker processes of mapChunks and generateLights, which write to a world that another
+        MCInfdevOldLevel has open. It is that level's initTime. The world is opened for writing without taking the
+        session lock or clearing the work folders, and checkSessionLock fails once the other level loses its lock.
         """
 
         self.Length = 0
@@ -1033,28 +1745,52 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
             raise IOError('File is not a Minecraft Alpha world')
 
 
-        self.worldFolder = AnvilWorldFolder(filename)
+        self.worldFolder = AnvilWorldFolder(filename, readonly)
         self.filename = self.worldFolder.getFilePath("level.dat")
         self.readonly = readonly
+        self._borrowedSessionLock = sessionLock
         if not readonly:
-            self.acquireSessionLock()
+            if sessionLock is None:
+                self.acquireSessionLock()
+            else:
+                self.initTime = sessionLock
 
             workFolderPath = self.worldFolder.getFolderPath("##MCEDIT.TEMP##")
-            if os.path.exists(workFolderPath):
+            if os.path.exists(workFolderPath) and sessionLock is None:
                 # xxxxxxx Opening a world a second time deletes the first world's work folder and crashes when the first
                 # world tries to read a modified chunk from the work folder. This mainly happens when importing a world
                 # into itself after modifying it.
                 shutil.rmtree(workFolderPath, True)
 
             self.unsavedWorkFolder = AnvilWorldFolder(workFolderPath)
+            self.unsavedWorkFolder.useChunkIndex = False
+            self.unsavedWorkFolder.compressMode = self.workFolderCompressMode
+            self.unsavedWorkFolder.compressionLevel = self.workFolderCompressionLevel
+
+        if self.writeBehindThreads and not readonly:
+            self.chunkWriter = ChunkWriter(self.writeBehindThreads, self.writeBehindQueueSize)
+            self.worldFolder.chunkWriter = self.chunkWriter
+            self.unsavedWorkFolder.chunkWriter = self.chunkWriter
+            # the lock is checked when a save is queued, and again when it is written, in case it was lost between
+            self.worldFolder.sessionLockCheck = self.checkSessionLock
+            self.unsavedWorkFolder.sessionLockCheck = self.checkSessionLock
+        else:
+            self.chunkWriter = None
 
         # maps (cx, cz) pairs to AnvilChunk
         self._loadedChunks = weakref.WeakValueDictionary()
 
-        # maps (cx, cz) pairs to AnvilChunkData
-        self._loadedChunkData = {}
+        # maps (cx, cz) pairs to AnvilChunkData, dropping the least recently used when over the limits
+        self._loadedChunkData = ChunkCache(self.loadedChunkLimit, self.loadedChunkBytesLimit,
+                                           sizeFunc=AnvilChunkData.memoryUsage,
+                                           canEvict=self._canUnloadChunkData,
+                                           onEvict=self._unloadChunkData)
+
+        # maps (cx, cz) pairs to the AsyncResult of a chunk being read ahead by getChunks. See _prefetchChunk
+        self._prefetching = {}
 
         self.chunksNeedingLighting = set()
+        self._lightEdits = {}  # (cx, cz) -> set of the (x, y, z) blocks changed since the chunk was lit
         self._allChunks = None
         self.dimensions = {}
 
@@ -1099,9 +1835,21 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
 
         self.createPlayer("Player")
 
+    # checkSessionLock only reads session.lock again when its inode, size or modification time changed since it
+    # last held our lock, or when it was modified so shortly before that read that a later write could share its
+    # timestamp. If sessionLockCheckInterval is nonzero, a successful check is also trusted for that many seconds
+    # without looking at the file at all, which is cheaper still but may miss another program taking the world.
+    sessionLockCheckInterval = 0
+    sessionLockTimestampResolution = 2.0  # seconds. Coarse enough for FAT and HFS+ timestamps
+
+    _sessionLockStat = None  # (inode, size, mtime) of session.lock when it last held our lock
+    _sessionLockReadTime = 0
+    _sessionLockCheckTime = 0
+
     def acquireSessionLock(self):
         lockfile = self.worldFolder.getFilePath("session.lock")
         self.initTime = int(time.time() * 1000)
+        self._sessionLockStat = None
         with file(lockfile, "wb") as f:
             f.write(struct.pack(">q", self.initTime))
             f.flush()
@@ -1111,14 +1859,33 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         if self.readonly:
             raise SessionLockLost, "World is opened read only."
 
+        now = time.time()
+        if self.sessionLockCheckInterval and now - self._sessionLockCheckTime < self.sessionLockCheckInterval:
+            return
+
         lockfile = self.worldFolder.getFilePath("session.lock")
+        try:
+            st = os.stat(lockfile)
+            lockStat = st.st_ino, st.st_size, st.st_mtime
+        except OSError:
+            lockStat = None
+
+        if (lockStat is not None and lockStat == self._sessionLockStat
+                and lockStat[2] < self._sessionLockReadTime - self.sessionLockTimestampResolution):
+            self._sessionLockCheckTime = now
+            return
+
         try:
             (lock, ) = struct.unpack(">q", file(lockfile, "rb").read())
         except struct.error:
             lock = -1
         if lock != self.initTime:
+            self._sessionLockStat = None
             raise SessionLockLost, "Session lock lost. This world is being accessed from another location."
 
+        self._sessionLockStat = lockStat
+        self._sessionLockReadTime = self._sessionLockCheckTime = now
+
     def loadLevelDat(self, create=False, random_seed=None, last_played=None):
 
         if create:
@@ -1149,6 +1916,18 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         for level in self.dimensions.itervalues():
             level.saveInPlace(True)
 
+        dirtyChunkCount = self._saveChunksInPlace()
+
+        for path, tag in self.playerTagCache.iteritems():
+            tag.save(path)
+
+        self.playerTagCache.clear()
+
+        self.root_tag.save(self.filename)
+        log.info(u"Saved {0} chunks (dim {1})".format(dirtyChunkCount, self.dimNo))
+
+    def _saveChunksInPlace(self):
+        # writes the dirty chunks and the chunks in the work folder to the world and returns how many were written
         dirtyChunkCount = 0
         for chunk in self._loadedChunkData.itervalues():
             cx, cz = chunk.chunkPosition
@@ -1164,19 +1943,14 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
                 self.worldFolder.saveChunk(cx, cz, data)
                 dirtyChunkCount += 1
 
+        self.worldFolder.flush()
 
         self.unsavedWorkFolder.closeRegions()
         shutil.rmtree(self.unsavedWorkFolder.filename, True)
         if not os.path.exists(self.unsavedWorkFolder.filename):
             os.mkdir(self.unsavedWorkFolder.filename)
 
-        for path, tag in self.playerTagCache.iteritems():
-            tag.save(path)
-
-        self.playerTagCache.clear()
-
-        self.root_tag.save(self.filename)
-        log.info(u"Saved {0} chunks (dim {1})".format(dirtyChunkCount, self.dimNo))
+        return dirtyChunkCount
 
     def unload(self):
         """
@@ -1195,6 +1969,10 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         Unload all chunks and close all open filehandles. Discard any unsaved data.
         """
         self.unload()
+        if self.chunkWriter is not None:
+            self.chunkWriter.close()
+        if self._borrowedSessionLock is not None:
+            return  # the work folder belongs to the level that holds the lock
         try:
             self.checkSessionLock()
             shutil.rmtree(self.unsavedWorkFolder.filename, True)
@@ -1204,6 +1982,27 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
     # --- Resource limits ---
 
     loadedChunkLimit = 400
+    loadedChunkBytesLimit = 0  # if nonzero, also unload chunks when their arrays use more than this many bytes
+
+    # if True, Data, BlockLight and SkyLight are NibbleArrays that keep two values per byte. Lighting converts the
+    # chunks it works on back to plain arrays.
+    packedNibbleArrays = False
+
+    # if True, the chunk arrays are stored in the [y, z, x] order of Anvil's section tags and Blocks, Data,
+    # BlockLight and SkyLight are [x, z, y] views of them. Copying sections in and out of the arrays is then a
+    # straight copy of each section's bytes instead of a transpose. The views are not C-contiguous, so code that
+    # needs a contiguous array must copy it.
+    nativeSectionOrder = False
+
+    # chunks in the ##MCEDIT.TEMP## work folder are only read back by MCEdit, so they are stored for speed rather
+    # than size. They are recompressed with the world folder's policy by saveInPlace.
+    workFolderCompressMode = MCRegionFile.VERSION_DEFLATE
+    workFolderCompressionLevel = 1
+
+    # if nonzero, chunks saved by saveInPlace or unloaded into the work folder are compressed and written by this
+    # many background threads, with at most writeBehindQueueSize chunks waiting. See ChunkWriter
+    writeBehindThreads = 0
+    writeBehindQueueSize = 64
 
     # --- Constants ---
 
@@ -1260,11 +2059,8 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         if self.chunkCount == 0:
             return BoundingBox((0, 0, 0), (0, 0, 0))
 
-        allChunks = array(list(self.allChunks))
-        mincx = (allChunks[:, 0]).min()
-        maxcx = (allChunks[:, 0]).max()
-        mincz = (allChunks[:, 1]).min()
-        maxcz = (allChunks[:, 1]).max()
+        # kept up to date by the chunk position set as chunks are created and deleted
+        mincx, mincz, maxcx, maxcz = self._allChunks.bounds
 
         origin = (mincx << 4, 0, mincz << 4)
         size = ((maxcx - mincx + 1) << 4, self.Height, (maxcz - mincz + 1) << 4)
@@ -1324,7 +2120,7 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
 
     def preloadChunkPositions(self):
         log.info(u"Scanning for regions...")
-        self._allChunks = self.worldFolder.listChunks()
+        self._allChunks = ChunkPositionSet(self.worldFolder.listChunks())
         if not self.readonly:
             self._allChunks.update(self.unsavedWorkFolder.listChunks())
         self._allChunks.update(self._loadedChunkData.iterkeys())
@@ -1332,6 +2128,17 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
     def getRegionForChunk(self, cx, cz):
         return self.worldFolder.getRegionFile(cx, cz)
 
+    def compactWorld(self):
+        """
+        Rewrites this level's region files without the free space left behind when chunks grow and are moved.
+        Unsaved changes are not affected. Returns the number of bytes reclaimed.
+        """
+        if self.readonly:
+            raise IOError, "World is opened read only."
+        self.checkSessionLock()
+
+        return self.worldFolder.compactWorld()
+
     # --- Chunk I/O ---
 
     def dirhash(self, n):
@@ -1443,39 +2250,74 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         chunkData = self._loadedChunkData.get((cx, cz))
         if chunkData is not None: return chunkData
 
+        prefetched = self._prefetching.pop((cx, cz), None)
+        if prefetched is not None:
+            data, fromWorkFolder = prefetched.get()
+            return self._addLoadedChunkData(self._decodeChunkData(cx, cz, data), fromWorkFolder)
+
         try:
             data = self._getChunkBytes(cx, cz)
-            root_tag = nbt.load(buf=data)
-            chunkData = AnvilChunkData(self, (cx, cz), root_tag)
         except (MemoryError, ChunkNotPresent):
             raise
         except Exception, e:
             raise ChunkMalformed, "Chunk {0} had an error: {1!r}".format((cx, cz), e), sys.exc_info()[2]
 
-        if not self.readonly and self.unsavedWorkFolder.containsChunk(cx, cz):
-            chunkData.dirty = True
+        return self._loadChunkData(cx, cz, data)
+
+    def _loadChunkData(self, cx, cz, data):
+        chunkData = self._decodeChunkData(cx, cz, data)
+        return self._addLoadedChunkData(chunkData, not self.readonly and self.unsavedWorkFolder.containsChunk(cx, cz))
+
+    def _decodeChunkData(self, cx, cz, data):
+        try:
+            root_tag = nbt.load(buf=data)
+            return AnvilChunkData(self, (cx, cz), root_tag)
+        except MemoryError:
+            raise
+        except Exception, e:
+            raise ChunkMalformed, "Chunk {0} had an error: {1!r}".format((cx, cz), e), sys.exc_info()[2]
+
+    def _addLoadedChunkData(self, chunkData, fromWorkFolder):
+        if fromWorkFolder:
+            # not yet saved to the world, but its sections were just loaded and are saved as they are
+            chunkData.markDirty(0, 0)
 
         self._storeLoadedChunkData(chunkData)
 
         return chunkData
 
-    def _storeLoadedChunkData(self, chunkData):
-        if len(self._loadedChunkData) > self.loadedChunkLimit:
-            # Try to find a chunk to unload. The chunk must not be in _loadedChunks, which contains only chunks that
-            # are in use by another object. If the chunk is dirty, save it to the temporary folder.
-            if not self.readonly:
-                self.checkSessionLock()
-            for (ocx, ocz), oldChunkData in self._loadedChunkData.items():
-                if (ocx, ocz) not in self._loadedChunks:
-                    if oldChunkData.dirty and not self.readonly:
-                        data = oldChunkData.savedTagData()
-                        self.unsavedWorkFolder.saveChunk(ocx, ocz, data)
-
-                    del self._loadedChunkData[ocx, ocz]
-                    break
+    def _prefetchChunk(self, cx, cz):
+        # runs on a getChunks prefetch thread. Reads and decompresses the chunk without touching the loaded chunks;
+        # _getChunkData decodes the result when the chunk is asked for.
+        fromWorkFolder = not self.readonly and self.unsavedWorkFolder.containsChunk(cx, cz)
+        try:
+            if fromWorkFolder:
+                data = self.unsavedWorkFolder.readChunk(cx, cz)
+            else:
+                data = self.worldFolder.readChunk(cx, cz)
+        except (MemoryError, ChunkNotPresent):
+            raise
+        except Exception, e:
+            raise ChunkMalformed, "Chunk {0} had an error: {1!r}".format((cx, cz), e), sys.exc_info()[2]
 
+        return data, fromWorkFolder
+
+    def _storeLoadedChunkData(self, chunkData):
+        # a chunk read ahead before this one was loaded may be out of date by the time it is asked for
+        self._prefetching.pop(chunkData.chunkPosition, None)
         self._loadedChunkData[chunkData.chunkPosition] = chunkData
 
+    def _canUnloadChunkData(self, cPos, chunkData):
+        # _loadedChunks contains only chunks that are in use by another object
+        return cPos not in self._loadedChunks
+
+    def _unloadChunkData(self, (cx, cz), chunkData):
+        # called by the chunk cache when it drops a chunk. If the chunk is dirty, save it to the temporary folder.
+        if chunkData.dirty and not self.readonly:
+            self.checkSessionLock()
+            self.unsavedWorkFolder.saveChunk(cx, cz, chunkData.savedTagData())
+            return True
+
     def getChunk(self, cx, cz):
         """ read the chunk from disk, load it, and return it."""
 
@@ -1489,6 +2331,268 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         self._loadedChunks[cx, cz] = chunk
         return chunk
 
+    def getChunks(self, chunks=None, prefetch=0, workers=2):
+        """
+        Returns an iterator of the AnvilChunks at the given chunk positions, or of every chunk in the level,
+        loading them as needed. Positions with no chunk are skipped.
+
+        If prefetch is nonzero, up to that many of the following chunks are read from their region files and
+        decompressed ahead of the caller by a pool of this many worker threads. File reads and zlib release the
+        GIL, so they overlap the caller's work. Each chunk's NBT is decoded on the caller's thread when the caller
+        reaches it, since decoding holds the GIL and would only contend with the caller.
+        """
+        if not prefetch:
+            return super(MCInfdevOldLevel, self).getChunks(chunks)
+
+        return self._getChunksPrefetched(chunks, prefetch, workers)
+
+    def _getChunksPrefetched(self, chunks, prefetch, workers):
+        if chunks is None:
+            chunks = self.allChunks
+
+        pool = ThreadPool(workers)
+        ahead = deque()
+        started = {}
+        try:
+            for cPos in chunks:
+                if (cPos not in self._loadedChunks and cPos not in self._loadedChunkData
+                        and cPos not in self._prefetching):
+                    started[cPos] = self._prefetching[cPos] = pool.apply_async(self._prefetchChunk, cPos)
+                ahead.append(cPos)
+
+                while len(ahead) > prefetch:
+                    cPos = ahead.popleft()
+                    started.pop(cPos, None)
+                    try:
+                        yield self.getChunk(*cPos)
+                    except ChunkNotPresent:
+                        pass
+
+            while ahead:
+                cPos = ahead.popleft()
+                started.pop(cPos, None)
+                try:
+                    yield self.getChunk(*cPos)
+                except ChunkNotPresent:
+                    pass
+        finally:
+            # forget the chunks the caller didn't get to
+            for cPos, result in started.iteritems():
+                if self._prefetching.get(cPos) is result:
+                    del self._prefetching[cPos]
+            pool.terminate()
+            pool.join()
+
+    def getChunksInFileOrder(self, chunks=None, skipMalformed=False):
+        """
+        Like getChunks, but reads the chunks in the order they are stored in the region files, merging reads of
+        neighboring chunks. Use this in place of getChunk to visit every chunk of a large world. Chunks that are
+        loaded or modified are yielded first. If skipMalformed is True, chunks that fail to load are logged and
+        skipped; otherwise ChunkMalformed is raised.
+        """
+        if chunks is None:
+            chunks = self.allChunks
+
+        remaining = []
+        for cx, cz in chunks:
+            if ((cx, cz) in self._loadedChunks or (cx, cz) in self._loadedChunkData
+                    or (not self.readonly and self.unsavedWorkFolder.containsChunk(cx, cz))):
+                try:
+                    yield self.getChunk(cx, cz)
+                except ChunkMalformed, e:
+                    if not skipMalformed:
+                        raise
+                    log.warn(u"%s", e)
+            else:
+                remaining.append((cx, cz))
+
+        for cx, cz, data in self.worldFolder.readChunks(remaining):
+            chunk = self._loadedChunks.get((cx, cz))
+            if chunk is None:
+                try:
+                    chunkData = self._loadedChunkData.get((cx, cz))
+                    if chunkData is None:
+                        if data is None:
+                            chunkData = self._getChunkData(cx, cz)  # raises the read error
+                        else:
+                            chunkData = self._loadChunkData(cx, cz, data)
+                except ChunkMalformed, e:
+                    if not skipMalformed:
+                        raise
+                    log.warn(u"%s", e)
+                    continue
+
+                chunk = AnvilChunk(chunkData)
+                self._loadedChunks[cx, cz] = chunk
+
+            yield chunk
+
+    def mapChunks(self, func, reduce=None, processes=None, readonly=True):
+        """
+        Calls func(chunk) for every chunk in the level, spread across this many worker processes, or one per CPU
+        if processes is None. Returns the list of results, or if reduce is given, the results combined with
+        reduce(a, b), or None if there were no chunks. The order of the results is not defined, so reduce should
+        not depend on it.
+
+        The work is split by region file, and each worker opens the world on its own. func, reduce and the results
+        are sent between processes, so they must be picklable: use module-level functions. Workers read the world
+        from disk, so if it has unsaved changes, func is called in this process instead, as MCLevel.mapChunks does.
+
+        If readonly is False, chunks that func marked dirty are written back to their region files by the worker
+        as soon as func returns. func should only change the chunk it is given. The workers write under this
+        world's session lock, and stop if it is lost. The world must have no unsaved changes, and its loaded chunks
+        are unloaded afterward.
+        """
+        sessionLock = None
+        if not readonly:
+            self.checkSessionLock()
+            if self.hasUnsavedChunks():
+                raise IOError, "World has unsaved changes. Save it before changing it with mapChunks."
+            sessionLock = (self.parentWorld if self.dimNo else self).initTime
+        elif self.hasUnsavedChunks():
+            return super(MCInfdevOldLevel, self).mapChunks(func, reduce)
+
+        regions = sorted(filter(None, (self.worldFolder.regionCoordsForFilename(os.path.basename(path))
+                                       for path in self.worldFolder.findRegionFiles())))
+        if self.dimNo:
+            worldPath = self.parentWorld.worldFolder.filename
+        else:
+            worldPath = self.worldFolder.filename
+        tasks = [(worldPath, self.dimNo, regionCoords, func, reduce, sessionLock) for regionCoords in regions]
+
+        if processes == 1:
+            pool = None
+            partials = itertools.imap(_mapRegion, tasks)
+        else:
+            pool = multiprocessing.Pool(processes)
+            partials = pool.imap_unordered(_mapRegion, tasks)
+
+        results = []
+        try:
+            for partial in partials:
+                if reduce is None:
+                    results.extend(partial)
+                elif partial:
+                    results = [reduce(results[0], partial[0])] if results else partial
+        except:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if not readonly:
+                self.unload()
+
+        if reduce is None:
+            return results
+        return results[0] if results else None
+
+    # --- Lighting ---
+
+    lightingTileSize = 16  # chunks on a side of the tiles lit by each worker in generateLights; must divide 32
+    incrementalLightingLimit = 64
+
+    def generateLights(self, dirtyChunkPositions=None, processes=1):
+        return exhaust(self.generateLightsIter(dirtyChunkPositions, processes))
+
+    def generateLightsIter(self, dirtyChunkPositions=None, processes=1):
+        """
+        Lights the chunks as ChunkedLevelMixin.generateLightsIter does. If processes is not 1, they are lit by this
+        many worker processes, or one per CPU if processes is None, and written straight to the region files. As
+        with mapChunks(readonly=False), the world must have no unsaved changes, and its loaded chunks are unloaded
+        afterward.
+
+        Each worker lights the chunks of one region file, one tile of lightingTileSize by lightingTileSize chunks
+        at a time, reading a one-chunk border around the tile from its neighbors. Light only grows as it spreads,
+        so no tile ends up lighter than it should; a last pass in this process spreads the light across the
+        tiles' edges, and the world ends with the same light as when it is lit in one process. The workers return
+        the chunks they lit, compressed, and this process writes them once all of the workers are done, so every
+        border is read as it was before lighting started.
+        """
+        if processes == 1:
+            return ChunkedLevelMixin.generateLightsIter(self, dirtyChunkPositions)
+        return self._generateLightsInTilesIter(dirtyChunkPositions, processes)
+
+    def _generateLightsInTilesIter(self, dirtyChunkPositions, processes):
+        if self.readonly:
+            raise IOError, "World is opened read only."
+        self.checkSessionLock()
+        if self.hasUnsavedChunks():
+            raise IOError, "World has unsaved changes. Save it before lighting it with more than one process."
+
+        if dirtyChunkPositions is None:
+            dirtyChunkPositions = self.chunksNeedingLighting
+        dirtyChunkPositions = sorted(set(cPos for cPos in dirtyChunkPositions if self.containsChunk(*cPos)))
+
+        # a tile is lit if it holds any of the chunks or their neighbors, since the neighbors' light is reset too
+        size = self.lightingTileSize
+        tiles = defaultdict(list)
+        for cx, cz in dirtyChunkPositions:
+            neighborTiles = set(((cx + dx) // size, (cz + dz) // size)
+                                for dx, dz in itertools.product((-1, 0, 1), (-1, 0, 1)))
+            for tile in neighborTiles:
+                tiles[tile].append((cx, cz))
+
+        regions = defaultdict(list)
+        for (tx, tz), positions in sorted(tiles.iteritems()):
+            regions[(tx * size) >> 5, (tz * size) >> 5].append(((tx, tz), positions))
+
+        if self.dimNo:
+            worldPath = self.parentWorld.worldFolder.filename
+        else:
+            worldPath = self.worldFolder.filename
+        tasks = [(worldPath, self.dimNo, size, regionTiles)
+                 for regionCoords, regionTiles in sorted(regions.iteritems())]
+
+        workTotal = len(tasks) * 2
+        progressInfo = u"Lighting {0} chunks in {1} tiles".format(len(dirtyChunkPositions), len(tiles))
+        log.info(progressInfo)
+
+        relitChunks = []
+        pool = multiprocessing.Pool(processes)
+        try:
+            for i, relit in enumerate(pool.imap_unordered(_lightRegion, tasks)):
+                relitChunks.extend(relit)
+                yield i + 1, workTotal, progressInfo
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+            self.unload()
+
+        # each worker reads a border from the region files next to its own, so nothing is written until they have
+        # all finished. A worker that fails leaves the world as it was.
+        self.checkSessionLock()
+        for cx, cz, data, format in relitChunks:
+            self.worldFolder.saveCompressedChunk(cx, cz, data, format)
+        self.worldFolder.flush()
+        writtenChunks = [(cx, cz) for cx, cz, data, format in relitChunks]
+        del relitChunks
+
+        # light is spread across the tiles' edges from the chunks along them that the workers lit, in batches small
+        # enough to stay loaded. The chunks the workers left alone hold the same light as they would after lighting
+        # in one process.
+        edgeChunks = sorted((cx, cz) for cx, cz in writtenChunks
+                            if cx % size in (0, size - 1) or cz % size in (0, size - 1))
+        batchSize = max(1, self.loadedChunkLimit // 4)
+        batches = [edgeChunks[i:i + batchSize] for i in range(0, len(edgeChunks), batchSize)]
+
+        progressInfo = u"Lighting the edges of {0} tiles".format(len(tiles))
+        log.info(progressInfo)
+        for i, batch in enumerate(batches):
+            exhaust(self._spreadLightsIter([self.getChunk(*cPos) for cPos in batch]))
+            yield len(tasks) + len(tasks) * (i + 1) / len(batches), workTotal, progressInfo
+
+        self._saveChunksInPlace()
+        self.unload()
+        self.chunksNeedingLighting.difference_update(dirtyChunkPositions)
+        for cPos in dirtyChunkPositions:
+            self._lightEdits.pop(cPos, None)
+
     def markDirtyChunk(self, cx, cz):
         self.getChunk(cx, cz).chunkChanged()
 
@@ -1501,6 +2605,12 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
             if chunkData.dirty:
                 yield cPos
 
+    def hasUnsavedChunks(self):
+        """ Returns True if any chunk was changed since the world was last saved. """
+        if self.readonly:
+            return False
+        return any(self.listDirtyChunks()) or bool(self.unsavedWorkFolder.listChunks())
+
     # --- HeightMaps ---
 
     def heightMapAt(self, x, z):
@@ -1616,6 +2726,7 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
         return self.createChunks(box.chunkPositions)
 
     def deleteChunk(self, cx, cz):
+        self._prefetching.pop((cx, cz), None)
         self.worldFolder.deleteChunk(cx, cz)
         if self._allChunks is not None:
             self._allChunks.discard((cx, cz))
@@ -1638,6 +2749,7 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
             if i % 100 == 0:
                 log.info(u"Chunk {0}...".format(i))
 
+        self.worldFolder.flush()
         return ret
 
     # --- Player and spawn manipulation ---
@@ -1792,12 +2904,76 @@ class MCInfdevOldLevel(ChunkedLevelMixin, EntityLevel):
             playerTag.save(self.getPlayerPath(playerName))
 
 
+def _mapRegion((worldPath, dimNo, regionCoords, func, reduce, sessionLock)):
+    # runs in a mapChunks worker process. Returns a list of the results for the chunks in one region file, or a
+    # list of one result combined with reduce. The world is opened for writing under sessionLock, or read only if
+    # it is None.
+    readonly = sessionLock is None
+    world = MCInfdevOldLevel(worldPath, readonly=readonly, sessionLock=sessionLock)
+    try:
+        level = world.dimensions[dimNo] if dimNo else world
+        folder = level.worldFolder
+        positions = regionChunkPositions(regionCoords, flatnonzero(folder.getRegionFile(*regionCoords).offsets))
+
+        results = []
+        for chunk in level.getChunksInFileOrder(positions, skipMalformed=True):
+            result = func(chunk)
+            if chunk.dirty and not readonly:
+                cx, cz = chunk.chunkPosition
+                level.checkSessionLock()
+                folder.saveChunk(cx, cz, chunk.savedTagData())
+                chunk.dirty = False
+
+            if reduce is not None and results:
+                results[0] = reduce(results[0], result)
+            else:
+                results.append(result)
+
+        folder.flush()
+        return results
+    finally:
+        world.close()
+
+
+def _lightRegion((worldPath, dimNo, size, tiles)):
+    # runs in a generateLights worker process. Lights the tiles of one region file in turn, each with a one-chunk
+    # border read from its neighbors. tiles is a list of ((tx, tz), dirtyChunkPositions) with the chunks to relight
+    # that are in or next to the tile. Returns (cx, cz, data, format) for each chunk of the tiles that changed, with
+    # data compressed by MCRegionFile.compressChunk, for the parent to write once every worker is done reading.
+    world = MCInfdevOldLevel(worldPath, readonly=True)
+    try:
+        level = world.dimensions[dimNo] if dimNo else world
+        folder = level.worldFolder
+        # a read-only world has nowhere to put a dirty chunk it unloads, so keep every chunk a tile touches
+        level._loadedChunkData.maxChunks = 0
+
+        relit = []
+        for (tx, tz), dirtyChunkPositions in tiles:
+            tile = set(itertools.product(range(tx * size, (tx + 1) * size), range(tz * size, (tz + 1) * size)))
+            border = set(itertools.product(range(tx * size - 1, (tx + 1) * size + 1),
+                                           range(tz * size - 1, (tz + 1) * size + 1)))
+            chunkPositions = set(cPos for cPos in border if level.containsChunk(*cPos))
+            dirtyChunkPositions = [cPos for cPos in dirtyChunkPositions if cPos in chunkPositions]
+            exhaust(level._generateLightsIter(dirtyChunkPositions, chunkPositions))
+
+            for (cx, cz), chunkData in level._loadedChunkData.iteritems():
+                if (cx, cz) in tile and chunkData.dirty:
+                    data, format = folder.getRegionForChunk(cx, cz).compressChunk(chunkData.savedTagData())
+                    relit.append((cx, cz, data, format))
+            level.unload()
+
+        return relit
+    finally:
+        world.close()
+
+
 class MCAlphaDimension (MCInfdevOldLevel):
     def __init__(self, parentWorld, dimNo, create=False):
         filename = parentWorld.worldFolder.getFolderPath("DIM" + str(int(dimNo)))
 
         self.parentWorld = parentWorld
-        MCInfdevOldLevel.__init__(self, filename, create)
+        MCInfdevOldLevel.__init__(self, filename, create, readonly=parentWorld.readonly,
+                                  sessionLock=parentWorld._borrowedSessionLock)
         self.dimNo = dimNo
         self.filename = parentWorld.filename
         self.players = self.parentWorld.players
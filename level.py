@@ -8,13 +8,15 @@ import blockrotation
 from box import BoundingBox
 from collections import defaultdict
 from entity import Entity, TileEntity
+import functools
 import itertools
 from logging import getLogger
 import materials
 from math import floor
 from mclevelbase import ChunkMalformed, ChunkNotPresent, exhaust
 import nbt
-from numpy import argmax, swapaxes, zeros, zeros_like
+from numpy import (argmax, asarray, broadcast_arrays, clip, cumsum, maximum, minimum, newaxis, ogrid, swapaxes, zeros,
+                   zeros_like)
 import os.path
 
 log = getLogger(__name__)
@@ -140,6 +142,11 @@ class MCLevel(object):
     parentWorld = None
     world = None
 
+    @property
+    def hasSkyLight(self):
+        """ False for the Nether and the End, which have no sky light. """
+        return self.dimNo not in (-1, 1)
+
     @classmethod
     def isLevel(cls, filename):
         """Tries to find out whether the given filename can be loaded
@@ -228,6 +235,30 @@ class MCLevel(object):
             chunks = self.allChunks
         return (self.getChunk(cx, cz) for (cx, cz) in chunks if self.containsChunk(cx, cz))
 
+    def getChunksInFileOrder(self, chunks=None, skipMalformed=False):
+        """ Like getChunks, but formats that store chunks in files may read them in a faster order. If
+        skipMalformed is True, chunks that fail to load are logged and skipped. """
+        if chunks is None:
+            chunks = self.allChunks
+        for cx, cz in chunks:
+            if not self.containsChunk(cx, cz):
+                continue
+            try:
+                yield self.getChunk(cx, cz)
+            except ChunkMalformed, e:
+                if not skipMalformed:
+                    raise
+                log.warn(u"%s", e)
+
+    def mapChunks(self, func, reduce=None, processes=None, readonly=True):
+        """ Calls func(chunk) for every chunk and returns the list of results, or the results combined with
+        reduce(a, b) if given. Levels that can't be split between processes run func in this process and ignore
+        processes and readonly. See MCInfdevOldLevel.mapChunks """
+        results = [func(chunk) for chunk in self.getChunksInFileOrder(skipMalformed=True)]
+        if reduce is None:
+            return results
+        return functools.reduce(reduce, results) if results else None
+
     def _getFakeChunkEntities(self, cx, cz):
         """Returns Entities, TileEntities"""
         return nbt.TAG_List(), nbt.TAG_List()
@@ -352,6 +383,34 @@ class MCLevel(object):
             return 0
         self.Blocks[x, z, y] = blockID
 
+    def _pointsInside(self, xs, ys, zs):
+        # returns the points as flat arrays of the same length, and a mask of those inside the level
+        xs, ys, zs = (a.ravel() for a in broadcast_arrays(asarray(xs, int), asarray(ys, int), asarray(zs, int)))
+        w, h, l = self.size
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h) & (zs >= 0) & (zs < l)
+        return xs, ys, zs, inside
+
+    def getBlocksAt(self, xs, ys, zs):
+        """ Returns the block IDs at each of the points given by the arrays xs, ys and zs, like blockAt does for
+        a single point. Points outside the level are 0. The result has the shape of the broadcast coordinates. """
+        shape = broadcast_arrays(asarray(xs), asarray(ys), asarray(zs))[0].shape
+        xs, ys, zs, inside = self._pointsInside(xs, ys, zs)
+        blocks = zeros(len(xs), self.Blocks.dtype)
+        blocks[inside] = self.Blocks[xs[inside], zs[inside], ys[inside]]
+        return blocks.reshape(shape)
+
+    def setBlocksAt(self, xs, ys, zs, blockIDs, blockData=None):
+        """ Sets the block ID, and the block data if given, at each of the points given by the arrays xs, ys and
+        zs, like setBlockAt does for a single point. blockIDs and blockData may be arrays or single values. Points
+        outside the level are ignored. """
+        # broadcast the values with the coordinates before they are flattened, so they can have the same shape
+        values = broadcast_arrays(asarray(xs, int), asarray(ys, int), asarray(zs, int), asarray(blockIDs),
+                                  asarray(0 if blockData is None else blockData))
+        xs, ys, zs, inside = self._pointsInside(*values[:3])
+        self.Blocks[xs[inside], zs[inside], ys[inside]] = values[3].ravel()[inside]
+        if blockData is not None:
+            self.Data[xs[inside], zs[inside], ys[inside]] = values[4].ravel()[inside]
+
     # --- Fill and Replace ---
 
     from block_fill import fillBlocks, fillBlocksIter
@@ -535,6 +594,16 @@ class ChunkBase(EntityLevel):
         self.dirty = True
         self.needsLighting = needsLighting or self.needsLighting
 
+    def markDirty(self, miny=0, maxy=None):
+        """ Marks the chunk dirty after changing the blocks from miny up to maxy. Chunks that save each section
+        separately use the range to re-encode only the sections that changed. """
+        self.dirty = True
+
+    def unpackNibbleArrays(self):
+        """ Chunks that store Data, BlockLight and SkyLight as NibbleArrays replace them with plain arrays here.
+        Called before lighting, which writes the light arrays with numpy's out= arguments. """
+        pass
+
     @property
     def materials(self):
         return self.world.materials
@@ -583,22 +652,28 @@ class LightedChunk(ChunkBase):
             self.genFastLights()
 
     def genFastLights(self):
-        self.SkyLight[:] = 0
-        if self.world.dimNo in (-1, 1):
-            return  # no light in nether or the end
-
-        blocks = self.Blocks
-        la = self.world.materials.lightAbsorption
+        self.unpackNibbleArrays()
         skylight = self.SkyLight
-        heightmap = self.HeightMap
+        if not self.world.hasSkyLight:
+            skylight[:] = 0
+            return  # no light in nether or the end
 
-        for x, z in itertools.product(xrange(16), xrange(16)):
+        # every block below the heightmap takes at least 1 from the light coming down its column, so the light is 15
+        # above the heightmap and 0 from 15 blocks below it. Only the layers between the lowest and highest columns'
+        # limits are computed. There, above[x, z, y - lo] is the total taken by the blocks from y up to hi, and the
+        # light at y is 15 less what the blocks from y up to the column's height take, clipped to 0 to 15.
+        heights = minimum(self.HeightMap.swapaxes(0, 1), skylight.shape[2]).astype('int32')
+        lo = max(0, int(heights.min()) - 15)
+        hi = int(heights.max())
+        skylight[..., :lo] = 0
+        skylight[..., hi:] = 15
+        if hi == lo:
+            return
 
-            skylight[x, z, heightmap[z, x]:] = 15
-            lv = 15
-            for y in reversed(range(heightmap[z, x])):
-                lv -= (la[blocks[x, z, y]] or 1)
+        absorption = maximum(self.world.materials.lightAbsorption[self.Blocks[..., lo:hi]], 1)
+        above = zeros((16, 16, hi - lo + 1), 'int16')
+        cumsum(absorption[..., ::-1], axis=2, dtype='int16', out=above[..., -2::-1])
 
-                if lv <= 0:
-                    break
-                skylight[x, z, y] = lv
+        x, z = ogrid[:16, :16]
+        light = above[..., :-1] - above[x, z, heights - lo][..., newaxis]
+        skylight[..., lo:hi] = clip(15 - light, 0, 15)
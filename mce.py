@@ -6,6 +6,7 @@ import infiniteworld
 import sys
 import os
 from box import BoundingBox, Vector
+from level import MCLevel
 import numpy
 from numpy import zeros, bincount
 import logging
@@ -34,6 +35,38 @@ class PlayerNotFound(RuntimeError):
     pass
 
 
+# whole-world scans run in worker processes with level.mapChunks, so their per-chunk parts are module functions
+
+def _countBlockTypes(chunk):
+    # for input to bincount, create an array of uint16s by
+    # shifting the data left and adding the blocks
+    btypes = numpy.array(chunk.Data.ravel(), dtype='uint16')
+    btypes <<= 12
+    btypes += chunk.Blocks.ravel()
+    return bincount(btypes)
+
+
+def _addBlockCounts(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    a[:len(b)] += b
+    return a
+
+
+def _findSigns(chunk):
+    return [(map(lambda x: tileEntity[x].value, "xyz"),
+             [tileEntity["Text{0}".format(i + 1)].value for i in range(4)])
+            for tileEntity in chunk.TileEntities if tileEntity["id"].value == "Sign"]
+
+
+def _findChests(chunk):
+    def chestItem(itemTag):
+        return tuple(itemTag[name].value if name in itemTag else None for name in ("id", "Damage", "Count"))
+
+    return [(map(lambda x: tileEntity[x].value, "xyz"), [chestItem(itemTag) for itemTag in tileEntity["Items"]])
+            for tileEntity in chunk.TileEntities if tileEntity["id"].value == "Chest"]
+
+
 class mce(object):
     """
     Block commands:
@@ -60,7 +93,7 @@ class mce(object):
        {commandPrefix}createChunks <box>
        {commandPrefix}deleteChunks <box>
        {commandPrefix}prune <box>
-       {commandPrefix}relight [ <box> ]
+       {commandPrefix}relight [ <box> ] [processes]
 
     World commands:
        {commandPrefix}create <filename>
@@ -68,6 +101,7 @@ class mce(object):
        {commandPrefix}degrief
        {commandPrefix}time [ <time> ]
        {commandPrefix}worldsize
+       {commandPrefix}compact
        {commandPrefix}heightmap <filename>
        {commandPrefix}randomseed [ <seed> ]
        {commandPrefix}gametype [ <player> [ <gametype> ] ]
@@ -124,6 +158,7 @@ class mce(object):
         "degrief",
         "time",
         "worldsize",
+        "compact",
         "heightmap",
         "randomseed",
         "gametype",
@@ -437,6 +472,12 @@ class mce(object):
         self.level.copyBlocksFrom(chest, chest.bounds, point)
         self.needsSave = True
 
+    def mapLevelChunks(self, func, reduce=None):
+        # mapChunks workers read the world from disk, so scan it in this process while it has unsaved edits
+        if self.needsSave:
+            return MCLevel.mapChunks(self.level, func, reduce)
+        return self.level.mapChunks(func, reduce)
+
     def _analyze(self, command):
         """
         analyze
@@ -444,22 +485,12 @@ class mce(object):
         Counts all of the block types in every chunk of the world.
         """
         blockCounts = zeros((65536,), 'uint64')
-        sizeOnDisk = 0
 
         print "Analyzing {0} chunks...".format(self.level.chunkCount)
-        # for input to bincount, create an array of uint16s by
-        # shifting the data left and adding the blocks
 
-        for i, cPos in enumerate(self.level.allChunks, 1):
-            ch = self.level.getChunk(*cPos)
-            btypes = numpy.array(ch.Data.ravel(), dtype='uint16')
-            btypes <<= 12
-            btypes += ch.Blocks.ravel()
-            counts = bincount(btypes)
-
-            blockCounts[:counts.shape[0]] += counts
-            if i % 100 == 0:
-                logging.info("Chunk {0}...".format(i))
+        counts = self.mapLevelChunks(_countBlockTypes, _addBlockCounts)
+        if counts is not None:
+            blockCounts[:counts.shape[0]] += counts.astype(blockCounts.dtype)
 
         for blockID in range(materials.id_limit):
             block = self.level.materials.blockWithID(blockID, 0)
@@ -610,23 +641,13 @@ class mce(object):
         print "Dumping signs..."
         signCount = 0
 
-        for i, cPos in enumerate(self.level.allChunks):
-            try:
-                chunk = self.level.getChunk(*cPos)
-            except mclevelbase.ChunkMalformed:
-                continue
+        for signs in self.mapLevelChunks(_findSigns):
+            for position, signTexts in signs:
+                signCount += 1
 
-            for tileEntity in chunk.TileEntities:
-                if tileEntity["id"].value == "Sign":
-                    signCount += 1
-
-                    outFile.write(str(map(lambda x: tileEntity[x].value, "xyz")) + "\n")
-                    for i in range(4):
-                        signText = tileEntity["Text{0}".format(i + 1)].value
-                        outFile.write(signText + u"\n")
-
-            if i % 100 == 0:
-                print "Chunk {0}...".format(i)
+                outFile.write(str(position) + "\n")
+                for signText in signTexts:
+                    outFile.write(signText + u"\n")
 
 
         print "Dumped {0} signs to {1}".format(signCount, filename)
@@ -644,25 +665,7 @@ class mce(object):
         assert level.version
 
         def getFreeSectors(rf):
-            runs = []
-            start = None
-            count = 0
-            for i, free in enumerate(rf.freeSectors):
-                if free:
-                    if start is None:
-                        start = i
-                        count = 1
-                    else:
-                        count += 1
-                else:
-                    if start is None:
-                        pass
-                    else:
-                        runs.append((start, count))
-                        start = None
-                        count = 0
-
-            return runs
+            return rf.sectors.freeExtents()
 
         def printFreeSectors(runs):
 
@@ -768,35 +771,23 @@ class mce(object):
         print "Dumping chests..."
         chestCount = 0
 
-        for i, cPos in enumerate(self.level.allChunks):
-            try:
-                chunk = self.level.getChunk(*cPos)
-            except mclevelbase.ChunkMalformed:
-                continue
-
-            for tileEntity in chunk.TileEntities:
-                if tileEntity["id"].value == "Chest":
-                    chestCount += 1
-
-                    outFile.write(str(map(lambda x: tileEntity[x].value, "xyz")) + "\n")
-                    itemsTag = tileEntity["Items"]
-                    if len(itemsTag):
-                        for itemTag in itemsTag:
-                            try:
-                                id = itemTag["id"].value
-                                damage = itemTag["Damage"].value
-                                item = items.findItem(id, damage)
-                                itemname = item.name
-                            except KeyError:
-                                itemname = "Unknown Item {0}".format(itemTag)
-                            except Exception, e:
-                                itemname = repr(e)
-                            outFile.write("{0} {1}\n".format(itemTag["Count"].value, itemname))
-                    else:
-                        outFile.write("Empty Chest\n")
-
-            if i % 100 == 0:
-                print "Chunk {0}...".format(i)
+        for chests in self.mapLevelChunks(_findChests):
+            for position, chestItems in chests:
+                chestCount += 1
+
+                outFile.write(str(position) + "\n")
+                if len(chestItems):
+                    for id, damage, count in chestItems:
+                        try:
+                            item = items.findItem(id, damage)
+                            itemname = item.name
+                        except KeyError:
+                            itemname = "Unknown Item {0}".format((id, damage, count))
+                        except Exception, e:
+                            itemname = repr(e)
+                        outFile.write("{0} {1}\n".format(count, itemname))
+                else:
+                    outFile.write("Empty Chest\n")
 
 
         print "Dumped {0} chests to {1}".format(chestCount, filename)
@@ -941,11 +932,24 @@ class mce(object):
 
     def _relight(self, command):
         """
-    relight [ <box> ]
+    relight [ <box> ] [processes]
 
     Recalculates lights in the region specified. If omitted,
     recalculates the entire world.
+
+    With "processes", the lights are calculated by one worker
+    process per CPU, and the chunks are written straight to the
+    world's region files. The world must have been saved first,
+    and "save" is not needed afterward.
     """
+        useProcesses = len(command) and command[-1].lower() == "processes"
+        if useProcesses:
+            command.pop()
+            if not isinstance(self.level, infiniteworld.MCInfdevOldLevel):
+                raise UsageError("Only Anvil worlds can be relit by worker processes.")
+            if self.needsSave:
+                raise UsageError("Save the world before relighting it with worker processes.")
+
         if len(command):
             box = self.readBox(command)
             chunks = itertools.product(range(box.mincx, box.maxcx), range(box.mincz, box.maxcz))
@@ -953,10 +957,13 @@ class mce(object):
         else:
             chunks = self.level.allChunks
 
-        self.level.generateLights(chunks)
+        if useProcesses:
+            self.level.generateLights(chunks, processes=None)
+        else:
+            self.level.generateLights(chunks)
+            self.needsSave = True
 
         print "Relit 0 chunks."
-        self.needsSave = True
 
     def _create(self, command):
         """
@@ -1133,6 +1140,20 @@ class mce(object):
         else:
             print "\nWorld size: \n  {0[0]:7} wide\n  {0[1]:7} tall\n  {0[2]:7} long\n".format(bounds.size)
 
+    def _compact(self, command):
+        """
+    compact
+
+    Rewrites the world's region files with their chunks packed together,
+    removing the free space left behind when chunks grow and are moved.
+    """
+        level = self.level
+        if not isinstance(level, mclevel.MCInfdevOldLevel):
+            raise UsageError("compact only works with region-format saves.")
+
+        reclaimed = level.compactWorld()
+        print "Reclaimed {0} bytes.".format(reclaimed)
+
     def _heightmap(self, command):
         """
     heightmap <filename>
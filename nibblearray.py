@@ -0,0 +1,199 @@
+from numpy import asarray, empty, integer, uint8, zeros
+
+__author__ = 'Rio'
+
+
+class NibbleArray(object):
+    """
+    A 16x16xHeight array of 4-bit values indexed [x, z, y] like the unpacked Data, BlockLight and SkyLight arrays,
+    but stored two values to a byte in the layout Anvil sections use on disk: packed[y, z, x / 2], with even x in
+    the low nibble. Loading and saving a section is a plain copy of its bytes, and the array takes half the memory.
+
+    Indexing with slices returns another NibbleArray sharing the same storage, so assignments through it, such as
+    chunk.Data[slices][mask] = values, write through to the chunk. Indexing with integers returns the value. Any
+    other index, and arithmetic, comparisons and methods such as any() or ravel(), work on an unpacked copy.
+    Numpy functions accept a NibbleArray anywhere they accept an array, except as an out= argument; call unpack()
+    and store the result back with [:] = for that.
+    """
+    dtype = uint8
+    ndim = 3
+
+    def __init__(self, packed, window=None):
+        self.packed = packed
+        if window is None:
+            window = (0, 16), (0, packed.shape[1]), (0, packed.shape[0])
+        self._window = window
+
+    @classmethod
+    def filled(cls, height, value=0):
+        packed = zeros((height, 16, 8), uint8)
+        if value:
+            packed[:] = (value & 0xf) * 0x11
+        return cls(packed)
+
+    def __repr__(self):
+        return "NibbleArray(shape={0})".format(self.shape)
+
+    @property
+    def shape(self):
+        return tuple(end - start for start, end in self._window)
+
+    @property
+    def size(self):
+        x, z, y = self.shape
+        return x * z * y
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    # --- Packing ---
+
+    def _packedRegion(self):
+        (x0, x1), (z0, z1), (y0, y1) = self._window
+        return self.packed[y0:y1, z0:z1, x0 >> 1:(x1 + 1) >> 1]
+
+    def unpack(self):
+        """ Returns the values as a new uint8 array indexed [x, z, y]. """
+        region = self._packedRegion()
+        full = empty(region.shape[:2] + (region.shape[2] * 2,), uint8)
+        full[..., 0::2] = region & 0xf
+        full[..., 1::2] = region >> 4
+
+        (x0, x1) = self._window[0]
+        first = x0 & 1
+        return full[..., first:first + x1 - x0].transpose(2, 1, 0)
+
+    def _store(self, values):
+        (x0, x1) = self._window[0]
+        region = self._packedRegion()
+        full = empty(region.shape[:2] + (region.shape[2] * 2,), uint8)
+        if x0 & 1 or x1 & 1:
+            # the values at the ends share a byte with values outside the window
+            full[..., 0::2] = region & 0xf
+            full[..., 1::2] = region >> 4
+
+        first = x0 & 1
+        full[..., first:first + x1 - x0] = asarray(values).transpose(2, 1, 0) & 0xf
+        region[:] = full[..., 0::2] | (full[..., 1::2] << 4)
+
+    def __array__(self, dtype=None):
+        values = self.unpack()
+        if dtype is not None:
+            values = values.astype(dtype)
+        return values
+
+    # --- Indexing ---
+
+    def _subWindow(self, index):
+        # returns the window selected by an index made only of contiguous slices, or None
+        if not isinstance(index, tuple):
+            index = (index,)
+        ellipses = [i for i, s in enumerate(index) if s is Ellipsis]
+        if ellipses:
+            i = ellipses[0]
+            index = index[:i] + (slice(None),) * (3 - len(index) + 1) + index[i + 1:]
+        if len(index) > 3:
+            return None
+
+        index = index + (slice(None),) * (3 - len(index))
+        window = []
+        for s, (start, end) in zip(index, self._window):
+            if not isinstance(s, slice):
+                return None
+            first, last, step = s.indices(end - start)
+            if step != 1:
+                return None
+            window.append((start + first, start + max(first, last)))
+
+        return tuple(window)
+
+    def _scalarPosition(self, index):
+        # returns (y, z, x) in packed coordinates if the index names a single value, or None
+        if not isinstance(index, tuple) or len(index) != 3:
+            return None
+
+        position = []
+        for i, (start, end) in zip(index, self._window):
+            if not isinstance(i, (int, long, integer)):
+                return None
+            if i < 0:
+                i += end - start
+            if not 0 <= i < end - start:
+                raise IndexError("index {0} is out of bounds for NibbleArray of shape {1}".format(index, self.shape))
+            position.append(start + i)
+
+        x, z, y = position
+        return y, z, x
+
+    def __getitem__(self, index):
+        window = self._subWindow(index)
+        if window is not None:
+            return NibbleArray(self.packed, window)
+
+        position = self._scalarPosition(index)
+        if position is not None:
+            y, z, x = position
+            return uint8(self.packed[y, z, x >> 1] >> ((x & 1) << 2) & 0xf)
+
+        return self.unpack()[index]
+
+    def __setitem__(self, index, value):
+        window = self._subWindow(index)
+        if window is not None:
+            target = NibbleArray(self.packed, window)
+            values = empty(target.shape, uint8)
+            values[:] = value
+            target._store(values)
+            return
+
+        position = self._scalarPosition(index)
+        if position is not None:
+            y, z, x = position
+            shift = (x & 1) << 2
+            byte = self.packed[y, z, x >> 1]
+            self.packed[y, z, x >> 1] = (byte & (0xf0 >> shift)) | ((int(value) & 0xf) << shift)
+            return
+
+        values = self.unpack()
+        values[index] = value
+        self._store(values)
+
+    def fill(self, value):
+        self[:] = value
+
+
+def _unpacked(name):
+    def method(self, *args):
+        return getattr(self.unpack(), name)(*args)
+
+    method.__name__ = name
+    return method
+
+
+def _inPlace(name):
+    def method(self, other):
+        values = self.unpack()
+        getattr(values, name)(other)
+        self._store(values)
+        return self
+
+    method.__name__ = name
+    return method
+
+
+for _name in ("__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__",
+              "__add__", "__radd__", "__sub__", "__rsub__", "__mul__", "__rmul__",
+              "__and__", "__rand__", "__or__", "__ror__", "__xor__", "__rxor__",
+              "__lshift__", "__rshift__", "__invert__", "__neg__",
+              "any", "all", "sum", "min", "max", "nonzero", "ravel", "flatten", "astype", "copy",
+              "swapaxes", "transpose", "reshape", "tostring"):
+    setattr(NibbleArray, _name, _unpacked(_name))
+
+for _name in ("__iadd__", "__isub__", "__iand__", "__ior__", "__ixor__", "__ilshift__", "__irshift__"):
+    setattr(NibbleArray, _name, _inPlace(_name))
+
+del _name
@@ -1,10 +1,12 @@
+from filepool import FileHandlePool
 from level import FakeChunk
 import logging
 from materials import pocketMaterials
 from mclevelbase import ChunkNotPresent, notclosing
 from nbt import TAG_List
-from numpy import array, fromstring, zeros
+from numpy import array, count_nonzero, fromstring, zeros
 import os
+from sectorallocator import SectorAllocator
 import struct
 
 # values are usually little-endian, unlike Minecraft PC
@@ -19,6 +21,9 @@ class PocketChunksFile(object):
 
     @property
     def file(self):
+        if self.filePool is not None:
+            return self.filePool.open(self.path)
+
         openfile = lambda: file(self.path, "rb+")
         if PocketChunksFile.holdFileOpen:
             if self._file is None:
@@ -28,12 +33,16 @@ class PocketChunksFile(object):
             return openfile()
 
     def close(self):
-        if PocketChunksFile.holdFileOpen:
+        if self.filePool is not None:
+            self.filePool.release(self.path)
+        if PocketChunksFile.holdFileOpen and self._file is not None:
             self._file.close()
             self._file = None
 
-    def __init__(self, path):
+    def __init__(self, path, filePool=None):
+        """ If filePool is given, the file is opened through it. See filepool.FileHandlePool """
         self.path = path
+        self.filePool = filePool
         self._file = None
         if not os.path.exists(path):
             file(path, "w").close()
@@ -52,29 +61,20 @@ class PocketChunksFile(object):
             f.seek(0)
             offsetsData = f.read(self.SECTOR_BYTES)
 
-            self.freeSectors = [True] * (filesize / self.SECTOR_BYTES)
-            self.freeSectors[0] = False
+            self.sectors = SectorAllocator(filesize / self.SECTOR_BYTES, 1)
 
             self.offsets = fromstring(offsetsData, dtype='<u4')
 
-        needsRepair = False
-
-        for index, offset in enumerate(self.offsets):
-            sector = offset >> 8
-            count = offset & 0xff
-
-            for i in xrange(sector, sector + count):
-                if i >= len(self.freeSectors):
-                    # raise RegionMalformed("Region file offset table points to sector {0} (past the end of the file)".format(i))
-                    print  "Region file offset table points to sector {0} (past the end of the file)".format(i)
-                    needsRepair = True
-                    break
-                if self.freeSectors[i] is False:
-                    logger.debug("Double-allocated sector number %s (offset %s @ %s)", i, offset, index)
-                    needsRepair = True
-                self.freeSectors[i] = False
+        sectorStarts = self.offsets >> 8
+        sectorCounts = self.offsets & 0xff
+        sectorEnds = sectorStarts + sectorCounts
+        if (sectorEnds > self.sectorCount).any():
+            logger.warning("Chunks file %s offset table points to sector %d (past the end of the file)", path,
+                           sectorEnds.max() - 1)
 
+        needsRepair = not self.sectors.markUsedExtents(sectorStarts, sectorCounts)
         if needsRepair:
+            logger.debug("Double-allocated sectors in %s", path)
             self.repair()
 
         logger.info("Found region file {file} with {used}/{total} sectors used and {chunks} chunks present".format(
@@ -82,15 +82,15 @@ class PocketChunksFile(object):
 
     @property
     def usedSectors(self):
-        return len(self.freeSectors) - sum(self.freeSectors)
+        return self.sectors.usedCount
 
     @property
     def sectorCount(self):
-        return len(self.freeSectors)
+        return self.sectors.sectorCount
 
     @property
     def chunkCount(self):
-        return sum(self.offsets > 0)
+        return count_nonzero(self.offsets)
 
     def repair(self):
         pass
@@ -170,7 +170,7 @@ class PocketChunksFile(object):
         if numSectors == 0:
             return None
 
-        if sectorStart + numSectors > len(self.freeSectors):
+        if sectorStart + numSectors > self.sectorCount:
             return None
 
         with self.file as f:
@@ -210,36 +210,13 @@ class PocketChunksFile(object):
             # we need to allocate new sectors
 
             # mark the sectors previously used for this chunk as free
-            for i in xrange(sectorNumber, sectorNumber + sectorsAllocated):
-                self.freeSectors[i] = True
-
-            runLength = 0
-            try:
-                runStart = self.freeSectors.index(True)
-
-                for i in range(runStart, len(self.freeSectors)):
-                    if runLength:
-                        if self.freeSectors[i]:
-                            runLength += 1
-                        else:
-                            runLength = 0
-                    elif self.freeSectors[i]:
-                        runStart = i
-                        runLength = 1
-
-                    if runLength >= sectorsNeeded:
-                        break
-            except ValueError:
-                pass
-
-            # we found a free space large enough
-            if runLength >= sectorsNeeded:
-                logger.debug("REGION SAVE {0},{1}, reusing {2}b".format(cx, cz, len(data)))
-                sectorNumber = runStart
-                self.setOffset(cx, cz, sectorNumber << 8 | sectorsNeeded)
-                self.writeSector(sectorNumber, data, format)
-                self.freeSectors[sectorNumber:sectorNumber + sectorsNeeded] = [False] * sectorsNeeded
+            self.sectors.free(sectorNumber, sectorsAllocated)
+
+            sectorCount = self.sectorCount
+            sectorNumber = self.sectors.allocate(sectorsNeeded)
 
+            if self.sectorCount == sectorCount:
+                logger.debug("REGION SAVE {0},{1}, reusing {2}b".format(cx, cz, len(data)))
             else:
                 # no free space large enough found -- we need to grow the
                 # file
@@ -247,20 +224,10 @@ class PocketChunksFile(object):
                 logger.debug("REGION SAVE {0},{1}, growing by {2}b".format(cx, cz, len(data)))
 
                 with self.file as f:
-                    f.seek(0, 2)
-                    filesize = f.tell()
-
-                    sectorNumber = len(self.freeSectors)
+                    f.truncate(self.sectorCount * self.SECTOR_BYTES)
 
-                    assert sectorNumber * self.SECTOR_BYTES == filesize
-
-                    filesize += sectorsNeeded * self.SECTOR_BYTES
-                    f.truncate(filesize)
-
-                self.freeSectors += [False] * sectorsNeeded
-
-                self.setOffset(cx, cz, sectorNumber << 8 | sectorsNeeded)
-                self.writeSector(sectorNumber, data, format)
+            self.setOffset(cx, cz, sectorNumber << 8 | sectorsNeeded)
+            self.writeSector(sectorNumber, data, format)
 
     def writeSector(self, sectorNumber, data, format):
         with self.file as f:
@@ -288,9 +255,8 @@ class PocketChunksFile(object):
             f.write(self.offsets.tostring())
 
     def chunkCoords(self):
-        indexes = (i for (i, offset) in enumerate(self.offsets) if offset)
-        coords = ((i % 32, i // 32) for i in indexes)
-        return coords
+        indexes = self.offsets.nonzero()[0]
+        return zip((indexes & 0x1f).tolist(), (indexes >> 5).tolist())
 
 from infiniteworld import ChunkedLevelMixin
 from level import MCLevel, LightedChunk
@@ -303,6 +269,7 @@ class PocketWorld(ChunkedLevelMixin, MCLevel):
 
     isInfinite = True  # Wrong. isInfinite actually means 'isChunked' and should be changed
     materials = pocketMaterials
+    keepChunkFileOpen = False  # if True, chunks.dat is kept open in a FileHandlePool until close()
 
     @property
     def allChunks(self):
@@ -314,9 +281,16 @@ class PocketWorld(ChunkedLevelMixin, MCLevel):
         self.filename = filename
         self.dimensions = {}
 
-        self.chunkFile = PocketChunksFile(os.path.join(filename, "chunks.dat"))
+        if self.keepChunkFileOpen:
+            self.filePool = FileHandlePool(1)
+        else:
+            self.filePool = None
+        self.chunkFile = PocketChunksFile(os.path.join(filename, "chunks.dat"), self.filePool)
         self._loadedChunks = {}
 
+    def close(self):
+        self.chunkFile.close()
+
     def getChunk(self, cx, cz):
         for p in cx, cz:
             if not 0 <= p <= 31:
@@ -1,29 +1,55 @@
 import logging
+import mmap
 import os
 import struct
+import sys
 import zlib
 
-from numpy import fromstring
+from numpy import argsort, array, count_nonzero, fromstring, zeros_like
 import time
 from mclevelbase import notclosing, RegionMalformed, ChunkNotPresent
 import nbt
+from sectorallocator import SectorAllocator
 
 log = logging.getLogger(__name__)
 
 __author__ = 'Rio'
 
-def deflate(data):
-    return zlib.compress(data, 2)
+def deflate(data, level=2):
+    return zlib.compress(data, level)
 
 def inflate(data):
     return zlib.decompress(data)
 
 
+def regionChunkPositions(regionCoords, indexes):
+    """ Converts an array of offset table indexes into a list of (cx, cz) world chunk coordinates. """
+    rx, rz = regionCoords
+    cxs = (indexes & 0x1f) + (rx << 5)
+    czs = (indexes >> 5) + (rz << 5)
+    return zip(cxs.tolist(), czs.tolist())
+
+
+def _zOrder():
+    # offset table indexes sorted so that chunks that are near each other in the world are near each other in the
+    # file, by interleaving the bits of their x and z coordinates
+    def key(index):
+        x, z = index & 0x1f, index >> 5
+        return sum(((x >> b) & 1) << (2 * b) | ((z >> b) & 1) << (2 * b + 1) for b in range(5))
+
+    return sorted(range(1024), key=key)
+
+
 class MCRegionFile(object):
     holdFileOpen = False  # if False, reopens and recloses the file on each access
+    useMemoryMap = False  # if True, chunks are read through a read-only mapping of the whole file
+    deferHeaderWrites = False  # if True, the offset and timestamp tables are only written by flush()
 
     @property
     def file(self):
+        if self.filePool is not None:
+            return self.filePool.open(self.path)
+
         openfile = lambda: file(self.path, "rb+")
         if MCRegionFile.holdFileOpen:
             if self._file is None:
@@ -32,18 +58,68 @@ class MCRegionFile(object):
         else:
             return openfile()
 
+    @property
+    def mapping(self):
+        """
+        A read-only memory map of the region file, created on first use. The mapping is dropped whenever the file
+        grows, so it always covers every sector in freeSectors.
+        """
+        if self._mmap is None:
+            with self.file as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _dropMapping(self):
+        # Don't close the mapping here - buffers returned by _readChunk may still refer to it. It is unmapped when
+        # the last of them is released.
+        self._mmap = None
+
+    def flush(self):
+        """
+        Writes the offset and timestamp tables if they were changed while deferHeaderWrites was set.
+
+        The chunk sectors are synced to disk before the header that points to them is written, and sectors freed
+        since the last flush are not reused until the new header is on disk. If the write is interrupted, the file
+        still has its old, consistent header.
+        """
+        if self._headerDirty:
+            with self.file as f:
+                f.flush()
+                os.fsync(f.fileno())
+
+                f.seek(0)
+                f.write(self.offsets.tostring())
+                f.write(self.modTimes.tostring())
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._headerDirty = False
+
+        for sectorNumber, sectorCount in self._pendingFreeSectors:
+            self.sectors.free(sectorNumber, sectorCount)
+        self._pendingFreeSectors = []
+
     def close(self):
-        if MCRegionFile.holdFileOpen:
+        self.flush()
+        self._dropMapping()
+        if self.filePool is not None:
+            self.filePool.release(self.path)
+        if MCRegionFile.holdFileOpen and self._file is not None:
             self._file.close()
             self._file = None
 
     def __del__(self):
         self.close()
 
-    def __init__(self, path, regionCoords):
+    def __init__(self, path, regionCoords, filePool=None):
+        """ If filePool is given, the file is opened through it. See filepool.FileHandlePool """
         self.path = path
         self.regionCoords = regionCoords
+        self.filePool = filePool
         self._file = None
+        self._mmap = None
+        self._headerDirty = False
+        self._pendingFreeSectors = []
         if not os.path.exists(path):
             file(path, "w").close()
 
@@ -62,27 +138,19 @@ class MCRegionFile(object):
             offsetsData = f.read(self.SECTOR_BYTES)
             modTimesData = f.read(self.SECTOR_BYTES)
 
-            self.freeSectors = [True] * (filesize / self.SECTOR_BYTES)
-            self.freeSectors[0:2] = False, False
+            self.sectors = SectorAllocator(filesize / self.SECTOR_BYTES, 2, self.allocationPolicy)
 
             self.offsets = fromstring(offsetsData, dtype='>u4')
             self.modTimes = fromstring(modTimesData, dtype='>u4')
 
-        needsRepair = False
+        sectorStarts = self.offsets >> 8
+        sectorCounts = self.offsets & 0xff
+        sectorEnds = sectorStarts + sectorCounts
+        if (sectorEnds > self.sectorCount).any():
+            log.warning("Region file %s offset table points to sector %d (past the end of the file)", path,
+                        sectorEnds.max() - 1)
 
-        for offset in self.offsets:
-            sector = offset >> 8
-            count = offset & 0xff
-
-            for i in xrange(sector, sector + count):
-                if i >= len(self.freeSectors):
-                    # raise RegionMalformed("Region file offset table points to sector {0} (past the end of the file)".format(i))
-                    print  "Region file offset table points to sector {0} (past the end of the file)".format(i)
-                    needsRepair = True
-                    break
-                if self.freeSectors[i] is False:
-                    needsRepair = True
-                self.freeSectors[i] = False
+        needsRepair = not self.sectors.markUsedExtents(sectorStarts, sectorCounts)
 
         if needsRepair:
             self.repair()
@@ -93,21 +161,32 @@ class MCRegionFile(object):
     def __repr__(self):
         return "%s(\"%s\")" % (self.__class__.__name__, self.path)
     @property
+    def freeSectors(self):
+        """ A list with one boolean per sector, True if the sector is free. """
+        freeSectors = [False] * self.sectorCount
+        for start, count in self.sectors.freeExtents():
+            freeSectors[start:start + count] = [True] * count
+        return freeSectors
+
+    @property
     def usedSectors(self):
-        return len(self.freeSectors) - sum(self.freeSectors)
+        return self.sectors.usedCount
 
     @property
     def sectorCount(self):
-        return len(self.freeSectors)
+        return self.sectors.sectorCount
 
     @property
     def chunkCount(self):
-        return sum(self.offsets > 0)
+        return count_nonzero(self.offsets)
+
+    def chunkPositions(self):
+        """ Returns a list of (cx, cz) world chunk coordinates, one for each chunk present in this region. """
+        return regionChunkPositions(self.regionCoords, self.offsets.nonzero()[0])
 
     def repair(self):
         lostAndFound = {}
-        _freeSectors = [True] * len(self.freeSectors)
-        _freeSectors[0] = _freeSectors[1] = False
+        _sectors = SectorAllocator(self.sectorCount, 2)
         deleted = 0
         recovered = 0
         log.info("Beginning repairs on {file} ({chunks} chunks)".format(file=os.path.basename(self.path), chunks=sum(self.offsets > 0)))
@@ -122,7 +201,7 @@ class MCRegionFile(object):
                 sectorCount = offset & 0xff
                 try:
 
-                    if sectorStart + sectorCount > len(self.freeSectors):
+                    if sectorStart + sectorCount > self.sectorCount:
                         raise RegionMalformed("Offset {start}:{end} ({offset}) at index {index} pointed outside of the file".format(
                             start=sectorStart, end=sectorStart + sectorCount, index=index, offset=offset))
 
@@ -134,12 +213,7 @@ class MCRegionFile(object):
                     lev = chunkTag["Level"]
                     xPos = lev["xPos"].value
                     zPos = lev["zPos"].value
-                    overlaps = False
-
-                    for i in xrange(sectorStart, sectorStart + sectorCount):
-                        if _freeSectors[i] is False:
-                            overlaps = True
-                        _freeSectors[i] = False
+                    overlaps = not _sectors.markUsed(sectorStart, sectorCount)
 
                     if xPos != cx or zPos != cz or overlaps:
                         lostAndFound[xPos, zPos] = data
@@ -164,6 +238,67 @@ class MCRegionFile(object):
         log.info("Repair complete. Removed {0} chunks, recovered {1} chunks, net {2}".format(deleted, recovered, recovered - deleted))
 
 
+    zOrder = _zOrder()
+
+    def compact(self):
+        """
+        Rewrites the region file with its chunks packed together in Z-order and no free sectors in between, then
+        returns the number of bytes reclaimed. Chunk data is copied as it is stored, without being decompressed.
+
+        The new file is written alongside the old one and renamed over it once it is complete.
+        """
+        self.flush()
+        oldSize = self.sectorCount * self.SECTOR_BYTES
+        offsets = zeros_like(self.offsets)
+        tempPath = self.path + ".tmp"
+        sectorNumber = 2
+
+        with self.file as f:
+            with file(tempPath, "wb") as out:
+                out.seek(sectorNumber * self.SECTOR_BYTES)
+
+                for index in self.zOrder:
+                    offset = self.offsets[index]
+                    sectorStart = offset >> 8
+                    numSectors = offset & 0xff
+                    if numSectors == 0 or sectorStart + numSectors > self.sectorCount:
+                        continue
+
+                    f.seek(sectorStart * self.SECTOR_BYTES)
+                    data = f.read(numSectors * self.SECTOR_BYTES)
+
+                    # drop the unused part of the chunk's last sectors, unless the length is unreadable
+                    if len(data) >= 4:
+                        length = struct.unpack_from(">I", data)[0]
+                        if 0 < length <= len(data) - 4:
+                            data = data[:length + 4]
+
+                    sectorsUsed = (len(data) + self.SECTOR_BYTES - 1) / self.SECTOR_BYTES
+                    out.write(data)
+                    out.write("\0" * (sectorsUsed * self.SECTOR_BYTES - len(data)))
+
+                    offsets[index] = sectorNumber << 8 | sectorsUsed
+                    sectorNumber += sectorsUsed
+
+                out.seek(0)
+                out.write(offsets.tostring())
+                out.write(self.modTimes.tostring())
+                out.flush()
+                os.fsync(out.fileno())
+
+        self.close()
+        if os.path.exists(self.path) and sys.platform == "win32":
+            os.unlink(self.path)  # rename can't replace files on Windows
+        os.rename(tempPath, self.path)
+
+        self.offsets = offsets
+        self.sectors = SectorAllocator(sectorNumber, sectorNumber, self.allocationPolicy)
+
+        reclaimed = oldSize - sectorNumber * self.SECTOR_BYTES
+        log.info("Compacted region file {file}, {reclaimed} bytes reclaimed".format(
+            file=os.path.basename(self.path), reclaimed=reclaimed))
+        return reclaimed
+
     def _readChunk(self, cx, cz):
         cx &= 0x1f
         cz &= 0x1f
@@ -176,9 +311,12 @@ class MCRegionFile(object):
         if numSectors == 0:
             raise ChunkNotPresent((cx, cz))
 
-        if sectorStart + numSectors > len(self.freeSectors):
+        if sectorStart + numSectors > self.sectorCount:
             raise ChunkNotPresent((cx, cz))
 
+        if self.useMemoryMap:
+            return self._readMappedChunk(sectorStart, numSectors)
+
         with self.file as f:
             f.seek(sectorStart * self.SECTOR_BYTES)
             data = f.read(numSectors * self.SECTOR_BYTES)
@@ -189,18 +327,102 @@ class MCRegionFile(object):
 
         length = struct.unpack_from(">I", data)[0]
         format = struct.unpack_from("B", data, 4)[0]
-        data = data[5:length + 5]
+        data = data[5:length + 4]  # length counts the format byte
         return data, format
 
+    def _readMappedChunk(self, sectorStart, numSectors):
+        """
+        Returns a buffer pointing directly into the mapped file instead of a copy of the chunk's sectors.
+        """
+        m = self.mapping
+        start = sectorStart * self.SECTOR_BYTES
+        end = min(start + numSectors * self.SECTOR_BYTES, len(m))
+        if end - start < 5:
+            raise RegionMalformed, "Chunk data is only %d bytes long (expected 5)" % (end - start)
+
+        length, format = struct.unpack_from(">IB", m, start)
+        length = min(length + 4, end - start)
+        return buffer(m, start + 5, length - 5), format
+
     def readChunk(self, cx, cz):
         data, format = self._readChunk(cx, cz)
+        return self._decompress(data, format)
+
+    def _decompress(self, data, format):
         if format == self.VERSION_GZIP:
-            return nbt.gunzip(data)
+            return nbt.gunzip(str(data))
         if format == self.VERSION_DEFLATE:
             return inflate(data)
+        if format == self.VERSION_UNCOMPRESSED:
+            return str(data)
 
         raise IOError("Unknown compress format: {0}".format(format))
 
+    def readChunks(self, chunkPositions=None):
+        """
+        Yields (cx, cz, data) for each of the given chunks that are present, or for every chunk in the file, in the
+        order they are stored in the file. Chunks that are next to each other, or separated by at most
+        readGapSectors unused sectors, are read with a single call of up to readAheadSectors sectors, so reading a
+        whole file is mostly sequential.
+
+        data is None for chunks that could not be decompressed; readChunk will raise the error for them.
+        """
+        if chunkPositions is None:
+            indexes = self.offsets.nonzero()[0]
+        else:
+            indexes = array([(cx & 0x1f) + (cz & 0x1f) * 32 for cx, cz in chunkPositions], 'int64')
+            indexes = indexes[self.offsets[indexes] != 0]
+
+        offsets = self.offsets[indexes]
+        starts = offsets >> 8
+        ends = starts + (offsets & 0xff)
+        valid = (ends > starts) & (ends <= self.sectorCount)
+        indexes, starts, ends = indexes[valid], starts[valid], ends[valid]
+
+        order = argsort(starts, kind='mergesort')
+        positions = regionChunkPositions(self.regionCoords, indexes[order])
+        starts = starts[order].tolist()
+        ends = ends[order].tolist()
+
+        i = 0
+        while i < len(starts):
+            runStart = starts[i]
+            runEnd = ends[i]
+            j = i + 1
+            while (j < len(starts) and starts[j] <= runEnd + self.readGapSectors
+                   and ends[j] - runStart <= self.readAheadSectors):
+                runEnd = max(runEnd, ends[j])
+                j += 1
+
+            run = self._readSectors(runStart, runEnd - runStart)
+            for k in range(i, j):
+                offset = (starts[k] - runStart) * self.SECTOR_BYTES
+                end = min((ends[k] - runStart) * self.SECTOR_BYTES, len(run))
+                cx, cz = positions[k]
+                try:
+                    if end - offset < 5:
+                        raise RegionMalformed, "Chunk data is only %d bytes long (expected 5)" % (end - offset)
+
+                    length, format = struct.unpack_from(">IB", run, offset)
+                    length = min(length + 4, end - offset)
+                    data = self._decompress(buffer(run, offset + 5, length - 5), format)
+                except Exception, e:
+                    log.warn("Failed to read chunk %s from %s: %r", (cx, cz), self.path, e)
+                    data = None
+
+                yield cx, cz, data
+
+            i = j
+
+    def _readSectors(self, sectorStart, numSectors):
+        start = sectorStart * self.SECTOR_BYTES
+        if self.useMemoryMap:
+            return buffer(self.mapping, start, numSectors * self.SECTOR_BYTES)
+
+        with self.file as f:
+            f.seek(start)
+            return f.read(numSectors * self.SECTOR_BYTES)
+
     def copyChunkFrom(self, regionFile, cx, cz):
         """
         Silently fails if regionFile does not contain the requested chunk.
@@ -211,13 +433,33 @@ class MCRegionFile(object):
         except ChunkNotPresent:
             pass
 
-    def saveChunk(self, cx, cz, uncompressedData):
-        data = deflate(uncompressedData)
+    def saveChunk(self, cx, cz, uncompressedData, compressMode=None, compressionLevel=None):
+        """
+        Compresses and stores the chunk. See compressChunk
+        """
+        data, format = self.compressChunk(uncompressedData, compressMode, compressionLevel)
         try:
-            self._saveChunk(cx, cz, data, self.VERSION_DEFLATE)
+            self._saveChunk(cx, cz, data, format)
         except ChunkTooBig as e:
             raise ChunkTooBig(e.message + " (%d uncompressed)" % len(uncompressedData))
 
+    def compressChunk(self, uncompressedData, compressMode=None, compressionLevel=None):
+        """
+        Returns (data, format) for storing the chunk. compressMode is VERSION_DEFLATE or VERSION_UNCOMPRESSED; it and
+        compressionLevel default to the attributes of the same name. A chunk that is too big to store uncompressed
+        is deflated instead. Does not touch the file, so it may be called from any thread.
+        """
+        if compressMode is None:
+            compressMode = self.compressMode
+        if compressionLevel is None:
+            compressionLevel = self.compressionLevel
+
+        if compressMode == self.VERSION_UNCOMPRESSED:
+            if len(uncompressedData) + self.CHUNK_HEADER_SIZE < 255 * self.SECTOR_BYTES:
+                return uncompressedData, self.VERSION_UNCOMPRESSED
+
+        return deflate(uncompressedData, compressionLevel), self.VERSION_DEFLATE
+
     def _saveChunk(self, cx, cz, data, format):
         cx &= 0x1f
         cz &= 0x1f
@@ -236,38 +478,19 @@ class MCRegionFile(object):
         else:
             # we need to allocate new sectors
 
-            # mark the sectors previously used for this chunk as free
-            for i in xrange(sectorNumber, sectorNumber + sectorsAllocated):
-                self.freeSectors[i] = True
+            # mark the sectors previously used for this chunk as free. if the header is deferred, the header on
+            # disk still points to them, so they are only freed once flush() has replaced it.
+            if self.deferHeaderWrites:
+                if sectorsAllocated:
+                    self._pendingFreeSectors.append((sectorNumber, sectorsAllocated))
+            else:
+                self.sectors.free(sectorNumber, sectorsAllocated)
 
-            runLength = 0
-            runStart = 0
-            try:
-                runStart = self.freeSectors.index(True)
+            sectorCount = self.sectorCount
+            sectorNumber = self.sectors.allocate(sectorsNeeded)
 
-                for i in range(runStart, len(self.freeSectors)):
-                    if runLength:
-                        if self.freeSectors[i]:
-                            runLength += 1
-                        else:
-                            runLength = 0
-                    elif self.freeSectors[i]:
-                        runStart = i
-                        runLength = 1
-
-                    if runLength >= sectorsNeeded:
-                        break
-            except ValueError:
-                pass
-
-            # we found a free space large enough
-            if runLength >= sectorsNeeded:
+            if self.sectorCount == sectorCount:
                 log.debug("REGION SAVE {0},{1}, reusing {2}b".format(cx, cz, len(data)))
-                sectorNumber = runStart
-                self.setOffset(cx, cz, sectorNumber << 8 | sectorsNeeded)
-                self.writeSector(sectorNumber, data, format)
-                self.freeSectors[sectorNumber:sectorNumber + sectorsNeeded] = [False] * sectorsNeeded
-
             else:
                 # no free space large enough found -- we need to grow the
                 # file
@@ -275,20 +498,12 @@ class MCRegionFile(object):
                 log.debug("REGION SAVE {0},{1}, growing by {2}b".format(cx, cz, len(data)))
 
                 with self.file as f:
-                    f.seek(0, 2)
-                    filesize = f.tell()
-
-                    sectorNumber = len(self.freeSectors)
-
-                    assert sectorNumber * self.SECTOR_BYTES == filesize
+                    f.truncate(self.sectorCount * self.SECTOR_BYTES)
 
-                    filesize += sectorsNeeded * self.SECTOR_BYTES
-                    f.truncate(filesize)
+                self._dropMapping()
 
-                self.freeSectors += [False] * sectorsNeeded
-
-                self.setOffset(cx, cz, sectorNumber << 8 | sectorsNeeded)
-                self.writeSector(sectorNumber, data, format)
+            self.setOffset(cx, cz, sectorNumber << 8 | sectorsNeeded)
+            self.writeSector(sectorNumber, data, format)
 
         self.setTimestamp(cx, cz)
 
@@ -314,6 +529,10 @@ class MCRegionFile(object):
         cx &= 0x1f
         cz &= 0x1f
         self.offsets[cx + cz * 32] = offset
+        if self.deferHeaderWrites:
+            self._headerDirty = True
+            return
+
         with self.file as f:
             f.seek(0)
             f.write(self.offsets.tostring())
@@ -330,17 +549,28 @@ class MCRegionFile(object):
         cx &= 0x1f
         cz &= 0x1f
         self.modTimes[cx + cz * 32] = timestamp
+        if self.deferHeaderWrites:
+            self._headerDirty = True
+            return
+
         with self.file as f:
             f.seek(self.SECTOR_BYTES)
             f.write(self.modTimes.tostring())
 
+    allocationPolicy = SectorAllocator.BEST_FIT
+
+    readAheadSectors = 256  # largest single read made by readChunks
+    readGapSectors = 4  # readChunks reads through holes up to this size rather than seeking past them
+
     SECTOR_BYTES = 4096
     SECTOR_INTS = SECTOR_BYTES / 4
     CHUNK_HEADER_SIZE = 5
     VERSION_GZIP = 1
     VERSION_DEFLATE = 2
+    VERSION_UNCOMPRESSED = 3  # not read by older versions of Minecraft. meant for MCEdit's own work folder
 
     compressMode = VERSION_DEFLATE
+    compressionLevel = 2  # zlib level, 0-9. 1 is fastest, 9 is smallest
 
 
 class ChunkTooBig(ValueError):
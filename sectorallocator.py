@@ -0,0 +1,218 @@
+from bisect import bisect_left, bisect_right
+from numpy import argsort, asarray, concatenate
+
+__author__ = 'Rio'
+
+
+class SectorAllocator(object):
+    """
+    Tracks the free space of a file made of fixed-size sectors, such as a region file or a Pocket Edition
+    chunks.dat. Free space is kept as lists of free extents, one sorted by first sector and one by length.
+
+    BEST_FIT, the default, places data in the smallest hole that fits it. The hole is found by binary search on the
+    extents sorted by length, and the neighbors merged by free() by binary search on the extents sorted by first
+    sector, so both take O(log n) comparisons in the number of holes. Keeping the two lists sorted still inserts
+    into and deletes from Python lists, which moves O(n) entries, but as a single memmove.
+    FIRST_FIT places data in the lowest hole that fits it, which keeps files packed toward their start. It scans
+    the holes in file order, so it costs O(n) Python steps for each allocation.
+
+    When no hole is large enough, the file is grown. A free extent at the end of the file is reused, so the file
+    only grows by as many sectors as are missing.
+    """
+    FIRST_FIT = "first"
+    BEST_FIT = "best"
+
+    def __init__(self, sectorCount, reservedSectors=0, policy=BEST_FIT):
+        self.policy = policy
+        self._sectorCount = sectorCount
+        self._freeCount = 0
+
+        self._starts = []  # first sector of each free extent, ascending
+        self._lengths = {}  # first sector -> extent length
+        self._bySize = []  # (length, first sector) for each free extent, ascending
+
+        if sectorCount > reservedSectors:
+            self._addExtent(reservedSectors, sectorCount - reservedSectors)
+
+    def __repr__(self):
+        return "SectorAllocator({0} sectors, {1} free in {2} extents)".format(self.sectorCount, self.freeCount,
+                                                                               len(self._starts))
+
+    def __len__(self):
+        return self._sectorCount
+
+    @property
+    def sectorCount(self):
+        return self._sectorCount
+
+    @property
+    def freeCount(self):
+        return self._freeCount
+
+    @property
+    def usedCount(self):
+        return self._sectorCount - self._freeCount
+
+    def freeExtents(self):
+        """ Returns a list of (start, count) tuples, one for each run of free sectors, in file order. """
+        return [(start, self._lengths[start]) for start in self._starts]
+
+    def isFree(self, sector):
+        i = bisect_right(self._starts, sector) - 1
+        if i < 0:
+            return False
+        start = self._starts[i]
+        return sector < start + self._lengths[start]
+
+    # --- Extent bookkeeping ---
+
+    def _addExtent(self, start, count):
+        self._starts.insert(bisect_left(self._starts, start), start)
+        self._lengths[start] = count
+        item = (count, start)
+        self._bySize.insert(bisect_left(self._bySize, item), item)
+        self._freeCount += count
+
+    def _removeExtent(self, start):
+        count = self._lengths.pop(start)
+        del self._starts[bisect_left(self._starts, start)]
+        del self._bySize[bisect_left(self._bySize, (count, start))]
+        self._freeCount -= count
+        return count
+
+    # --- Allocation ---
+
+    def markUsed(self, start, count):
+        """
+        Marks the given sectors as used. Returns False if any of them were already used or lie past the end of
+        the file, which means two chunks overlap or the offset table is damaged. Sectors past the end of the file
+        are ignored.
+        """
+        start, count = int(start), int(count)
+        taken = self._take(start, count)
+        return taken == count and start + count <= self._sectorCount
+
+    def markUsedExtents(self, starts, counts):
+        """
+        Marks many runs of sectors as used at once, such as every entry of a region file's offset table. starts
+        and counts are arrays; entries with a count of zero are skipped. Returns False if any run overlaps another
+        one or a used sector, or lies past the end of the file.
+
+        When every run falls in the same free extent, as when the allocator was just created, the remaining free
+        extents are computed with whole-array operations.
+        """
+        starts = asarray(starts, 'int64')
+        counts = asarray(counts, 'int64')
+        present = counts > 0
+        starts = starts[present]
+        counts = counts[present]
+        if not len(starts):
+            return True
+
+        order = argsort(starts, kind='mergesort')
+        starts = starts[order]
+        ends = starts + counts[order]
+
+        if len(self._starts) == 1:
+            freeStart = self._starts[0]
+            freeEnd = freeStart + self._lengths[freeStart]
+
+            if starts[0] >= freeStart and ends[-1] <= freeEnd and not (ends[:-1] > starts[1:]).any():
+                gapStarts = concatenate(([freeStart], ends))
+                gapEnds = concatenate((starts, [freeEnd]))
+                hasGap = gapEnds > gapStarts
+                gapLengths = (gapEnds - gapStarts)[hasGap].tolist()
+                gapStarts = gapStarts[hasGap].tolist()
+
+                self._starts = gapStarts
+                self._lengths = dict(zip(gapStarts, gapLengths))
+                self._bySize = sorted(zip(gapLengths, gapStarts))
+                self._freeCount = sum(gapLengths)
+                return True
+
+        ok = True
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if not self.markUsed(start, end - start):
+                ok = False
+        return ok
+
+    def _take(self, start, count):
+        # removes the given sectors from the free extents and returns how many of them were free
+        end = start + count
+        i = max(0, bisect_right(self._starts, start) - 1)
+        overlapping = []
+        while i < len(self._starts) and self._starts[i] < end:
+            s = self._starts[i]
+            if s + self._lengths[s] > start:
+                overlapping.append(s)
+            i += 1
+
+        taken = 0
+        for s in overlapping:
+            e = s + self._removeExtent(s)
+            if s < start:
+                self._addExtent(s, start - s)
+            if e > end:
+                self._addExtent(end, e - end)
+            taken += min(e, end) - max(s, start)
+
+        return taken
+
+    def free(self, start, count):
+        """ Returns the given sectors to the free list, merging them with any free neighbors. Freeing sectors that
+        are already free has no effect. """
+        start = int(start)
+        count = min(int(count), self._sectorCount - start)
+        if count <= 0:
+            return
+
+        self._take(start, count)
+
+        i = bisect_left(self._starts, start)
+        if i < len(self._starts):
+            nextStart = self._starts[i]
+            if nextStart == start + count:
+                count += self._removeExtent(nextStart)
+
+        if i > 0:
+            prevStart = self._starts[i - 1]
+            if prevStart + self._lengths[prevStart] == start:
+                count += self._removeExtent(prevStart)
+                start = prevStart
+
+        self._addExtent(start, count)
+
+    def _findHole(self, count):
+        if self.policy == self.BEST_FIT:
+            i = bisect_left(self._bySize, (count, -1))
+            if i < len(self._bySize):
+                return self._bySize[i][1]
+        else:
+            for start in self._starts:
+                if self._lengths[start] >= count:
+                    return start
+
+        return None
+
+    def allocate(self, count):
+        """
+        Finds and marks count contiguous sectors and returns the first one. If no hole is large enough, grows the
+        file; callers should compare sectorCount before and after to find out whether the file must be extended.
+        """
+        start = self._findHole(count)
+        if start is not None:
+            length = self._removeExtent(start)
+            if length > count:
+                self._addExtent(start + count, length - count)
+            return start
+
+        if self._starts:
+            lastStart = self._starts[-1]
+            if lastStart + self._lengths[lastStart] == self._sectorCount:
+                self._removeExtent(lastStart)
+                self._sectorCount = lastStart + count
+                return lastStart
+
+        start = self._sectorCount
+        self._sectorCount += count
+        return start
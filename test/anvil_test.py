@@ -1,12 +1,15 @@
 import itertools
+import operator
 import os
 import shutil
 import unittest
 import numpy
 
 from pymclevel import mclevel
-from pymclevel.infiniteworld import MCInfdevOldLevel
+from pymclevel.infiniteworld import AnvilChunkData, MCInfdevOldLevel, SessionLockLost, _mapRegion, DIM_END, \
+    DIM_NETHER
 from pymclevel import nbt
+from pymclevel.nibblearray import NibbleArray
 from pymclevel.schematic import MCSchematic
 from pymclevel.box import BoundingBox
 from pymclevel import block_copy
@@ -14,6 +17,33 @@ from templevel import mktemp, TempLevel
 
 __author__ = 'Rio'
 
+
+def _loopFastLights(chunk):
+    # the column-by-column skylight fill that genFastLights replaced, to check it against
+    skylight = numpy.zeros_like(chunk.SkyLight)
+    la = chunk.world.materials.lightAbsorption
+    for x, z in itertools.product(xrange(16), xrange(16)):
+        height = chunk.HeightMap[z, x]
+        skylight[x, z, height:] = 15
+        lv = 15
+        for y in reversed(range(height)):
+            lv -= (la[chunk.Blocks[x, z, y]] or 1)
+            if lv <= 0:
+                break
+            skylight[x, z, y] = lv
+    return skylight
+
+
+def _countEntities(chunk):
+    return len(chunk.Entities)
+
+
+def _removeEntities(chunk):
+    if len(chunk.Entities):
+        del chunk.Entities[:]
+        chunk.markDirty(0, 0)
+
+
 class TestAnvilLevelCreate(unittest.TestCase):
     def testCreate(self):
         temppath = mktemp("AnvilCreate")
@@ -148,6 +178,355 @@ class TestAnvilLevel(unittest.TestCase):
             for key in keys:
                 assert (d[key] == getattr(ch, key)).all()
 
+    def testChunksInFileOrder(self):
+        level = self.anvilLevel.level
+        cx, cz = level.allChunks.next()
+        ch = level.getChunk(cx, cz)
+        ch.Blocks[:] = 6
+        ch.chunkChanged()
+        del ch
+
+        chunks = list(level.getChunksInFileOrder())
+        assert set(c.chunkPosition for c in chunks) == set(level.allChunks)
+        assert len(chunks) == level.chunkCount
+        assert (level.getChunk(cx, cz).Blocks == 6).all()
+
+    def testPrefetchChunks(self):
+        level = self.anvilLevel.level
+        positions = list(level.allChunks)[:40] + [(1000, 1000)]
+        cx, cz = positions[3]
+
+        chunks = level.getChunks(positions, prefetch=8, workers=2)
+        first = chunks.next()
+        assert first.chunkPosition == positions[0]
+        assert (cx, cz) in level._prefetching
+
+        # asked for out of turn, then changed and saved
+        ch = level.getChunk(cx, cz)
+        assert (cx, cz) not in level._prefetching
+        ch.Blocks[:] = 6
+        ch.chunkChanged()
+        del ch
+        level.saveInPlace()
+        level._loadedChunkData.clear()
+
+        rest = list(chunks)
+        assert [c.chunkPosition for c in rest] == positions[1:-1]
+        assert (level.getChunk(cx, cz).Blocks == 6).all()
+        assert not level._prefetching
+
+        chunks = level.getChunks(positions, prefetch=8)
+        chunks.next()
+        chunks.close()
+        assert not level._prefetching
+
+    def testMapChunks(self):
+        level = self.anvilLevel.level
+        entityCount = sum(len(chunk.Entities) for chunk in level.getChunks())
+        assert entityCount
+
+        assert level.mapChunks(_countEntities, operator.add, processes=2) == entityCount
+        counts = level.mapChunks(_countEntities, processes=1)
+        assert len(counts) == level.chunkCount and sum(counts) == entityCount
+
+        chunk = (chunk for chunk in level.getChunks() if len(chunk.Entities)).next()
+        entityCount -= len(chunk.Entities)
+        _removeEntities(chunk)
+        assert level.mapChunks(_countEntities, operator.add, processes=2) == entityCount
+        self.assertRaises(IOError, level.mapChunks, _removeEntities, readonly=False)
+        level.saveInPlace()
+
+        cx, cz = (chunk.chunkPosition for chunk in level.getChunks() if len(chunk.Entities)).next()
+        task = (level.worldFolder.filename, 0, (cx >> 5, cz >> 5), _removeEntities, None, level.initTime - 1)
+        self.assertRaises(SessionLockLost, _mapRegion, task)
+
+        level.mapChunks(_removeEntities, processes=2, readonly=False)
+        assert level.mapChunks(_countEntities, operator.add) == 0
+        assert not any(len(chunk.Entities) for chunk in level.getChunks())
+
+    def testFastLights(self):
+        level = self.anvilLevel.level
+        random = numpy.random.RandomState(3)
+        for i, chunk in enumerate(itertools.islice(level.getChunks(), 20)):
+            if i % 2:
+                chunk.Blocks[:] = random.choice([0, 1, 8, 18, 20, 79], chunk.Blocks.shape)
+                chunk.HeightMap[:] = random.randint(0, level.Height + 1, (16, 16))
+            else:
+                chunk.generateHeightMap()
+            expected = _loopFastLights(chunk)
+            chunk.genFastLights()
+            assert (chunk.SkyLight == expected).all()
+
+    def testLightSpread(self):
+        temp = TempLevel("LightSpread", createFunc=lambda f: MCInfdevOldLevel(f, create=True))
+        level = temp.level
+        level.createChunks([(cx, 0) for cx in range(-1, 4)])
+        level.setBlockAt(31, 10, 8, level.materials.Glowstone.ID)
+
+        # the glowstone is in the ring of neighbors relit around (0, 0); its light has to carry on into (2, 0)
+        level.generateLights([(0, 0)])
+        for x in range(17, 46):
+            assert level.blockLightAt(x, 10, 8) == 15 - abs(x - 31)
+        for y in range(0, 25):
+            assert level.blockLightAt(31, y, 8) == 15 - abs(y - 10)
+        assert level.blockLightAt(31, 30, 8) == 0
+        assert level.getChunk(2, 0).dirty
+
+    def testLightInTiles(self):
+        level = self.anvilLevel.level
+        serialLevel = TempLevel("AnvilWorld").level
+        serialLevel.loadedChunkLimit = 1000  # light them in one batch
+        positions = list(itertools.product(range(10, 22), range(10, 22)))
+
+        level.getChunk(*positions[0]).chunkChanged()
+        self.assertRaises(IOError, level.generateLights, positions, processes=2)
+        level.saveInPlace()
+
+        # tiles of 16 chunks, so the positions cross the edges of four tiles
+        serialLevel.generateLights(positions)
+        level.generateLights(positions, processes=2)
+        assert not any(level.listDirtyChunks())
+        for cPos in itertools.product(range(8, 24), range(8, 24)):
+            if level.containsChunk(*cPos):
+                chunk, serialChunk = level.getChunk(*cPos), serialLevel.getChunk(*cPos)
+                assert (chunk.BlockLight == serialChunk.BlockLight).all()
+                assert (chunk.SkyLight == serialChunk.SkyLight).all()
+
+    def testLightAcrossRegions(self):
+        level = self.anvilLevel.level
+        serialLevel = TempLevel("AnvilWorld").level
+        serialLevel.loadedChunkLimit = serialLevel._loadedChunkData.maxChunks = 1000  # light them in one batch
+        positions = list(level.allChunks)
+        assert len(set((cx >> 5, cz >> 5) for cx, cz in positions)) > 1
+
+        # the workers read borders from each other's region files, which are written only after they all finish
+        serialLevel.generateLights(positions)
+        level.generateLights(positions, processes=3)
+        for cPos in positions:
+            chunk, serialChunk = level.getChunk(*cPos), serialLevel.getChunk(*cPos)
+            assert (chunk.BlockLight == serialChunk.BlockLight).all()
+            assert (chunk.SkyLight == serialChunk.SkyLight).all()
+
+    def testLightInSolidLayers(self):
+        temp = TempLevel("LightSolid", createFunc=lambda f: MCInfdevOldLevel(f, create=True))
+        level = temp.level
+        level.createChunks([(cx, cz) for cx in range(-1, 2) for cz in range(-1, 2)])
+        for chunk in level.getChunks():
+            chunk.Blocks[:, :, :40] = level.materials.Stone.ID
+            chunk.chunkChanged()
+
+        # a shaft down to a glowstone buried in layers that are otherwise solid and dark
+        chunk = level.getChunk(0, 0)
+        chunk.Blocks[8, 8, 11:40] = 0
+        chunk.Blocks[8, 8, 10] = level.materials.Glowstone.ID
+        chunk.chunkChanged()
+
+        level.generateLights()
+        for y in range(10, 25):
+            assert level.blockLightAt(8, y, 8) == 15 - (y - 10)
+        assert level.blockLightAt(8, 9, 8) == 0
+        assert level.blockLightAt(9, 11, 8) == 0
+        assert level.skylightAt(8, 39, 8) == 15
+        assert level.skylightAt(8, 20, 8) == 15
+        assert level.skylightAt(20, 39, 8) == 0
+
+    def testLightEdits(self):
+        def createLevel(name, dimNo):
+            temp = TempLevel(name, createFunc=lambda f: MCInfdevOldLevel(f, create=True))
+            level = temp.level.getDimension(dimNo) if dimNo else temp.level
+            level.createChunks([(cx, cz) for cx in range(-2, 3) for cz in range(-2, 3)])
+            for chunk in level.getChunks():
+                chunk.Blocks[:, :, :40] = level.materials.Stone.ID
+                chunk.Blocks[:, :, 50] = level.materials.Stone.ID
+                chunk.chunkChanged()
+            level.generateLights()
+            return temp, level
+
+        # the End has a heightmap but no sky light, and the Nether has neither
+        for dimNo in (DIM_NETHER, DIM_END, 0):
+            (temp, level), (fullTemp, fullLevel) = createLevel("LightEdits", dimNo), createLevel("LightEditsFull", dimNo)
+            fullLevel.incrementalLightingLimit = 0
+
+            def edit(*blocks):
+                for l in level, fullLevel:
+                    for x, y, z, blockID in blocks:
+                        l.setBlockAt(x, y, z, blockID)
+
+                level.generateLights()
+                for chunk in fullLevel.getChunks():
+                    chunk.chunkChanged()
+                fullLevel.generateLights()
+                for chunk in level.getChunks():
+                    fullChunk = fullLevel.getChunk(*chunk.chunkPosition)
+                    assert (chunk.BlockLight == fullChunk.BlockLight).all()
+                    assert (chunk.SkyLight == fullChunk.SkyLight).all()
+                    assert (chunk.HeightMap == fullChunk.HeightMap).all()
+
+            torch, glowstone, stone = (level.materials.Torch.ID, level.materials.Glowstone.ID, level.materials.Stone.ID)
+            edit((8, 45, 8, torch))
+            edit((8, 50, 8, 0), (9, 50, 8, 0))
+            edit((8, 50, 8, stone), (10, 50, 8, 0))
+            edit((8, 45, 8, 0), (20, 42, 8, glowstone), (-3, 45, 2, glowstone))
+            edit((20, 42, 8, stone), (-3, 45, 2, 0), (9, 50, 8, stone), (10, 50, 8, stone))
+
+        # a torch in a hollow in the stone lights only the hollow, and no neighboring chunks are relit
+        level.saveInPlace()
+        level.setBlockAt(24, 20, 24, torch)
+        level.generateLights()
+        assert level.blockLightAt(24, 20, 24) == 14
+        assert level.blockLightAt(25, 20, 24) == 0
+        assert not level.chunksNeedingLighting
+        assert not level.getChunk(0, 1).dirty
+
+    def testPackedSections(self):
+        level = self.anvilLevel.level
+        cx, cz = level.allChunks.next()
+        chunk = level.getChunk(cx, cz)
+        assert not chunk.chunkData.isUnpacked
+        len(chunk.Entities)
+        assert not chunk.chunkData.isUnpacked
+
+        packedSize = chunk.chunkData.memoryUsage()
+        cacheSize = level._loadedChunkData.byteCount
+        packedData = chunk.savedTagData()
+        blocks = numpy.array(chunk.Blocks)
+        assert chunk.chunkData.isUnpacked
+        assert chunk.chunkData.memoryUsage() > packedSize
+        # the chunk cache counts the unpacked arrays against loadedChunkBytesLimit
+        assert level._loadedChunkData.byteCount == cacheSize - packedSize + chunk.chunkData.memoryUsage()
+
+        reloaded = AnvilChunkData(level, (cx, cz), nbt.load(buf=packedData))
+        for key in 'Blocks Data SkyLight BlockLight'.split():
+            assert (getattr(reloaded, key) == getattr(chunk, key)).all()
+        assert (blocks == chunk.Blocks).all()
+
+    def testSectionDirtyTracking(self):
+        level = self.anvilLevel.level
+        cx, cz = level.allChunks.next()
+        chunk = level.getChunk(cx, cz)
+        chunkData = chunk.chunkData
+        chunk.Blocks
+        sections = dict(chunkData._sections)
+        assert len(sections) > 1
+
+        def savedSections():
+            return dict((sec["Y"].value, sec) for sec in nbt.load(buf=chunk.savedTagData())["Level"]["Sections"])
+
+        # nothing changed, so nothing is re-encoded
+        chunk.savedTagData()
+        assert all(chunkData._sections[y] is sections[y] for y in sections)
+
+        sy = min(sections)
+        x, z = cx << 4, cz << 4
+        level.setBlockAt(x, sy * 16 + 3, z, level.materials.Glass.ID)
+        saved = savedSections()
+        assert saved[sy]["Blocks"].value[3 * 256] == level.materials.Glass.ID
+        assert chunkData._sections[sy] is not sections[sy]
+        assert all(chunkData._sections[y] is sections[y] for y in sections if y != sy)
+
+        chunk.addEntity(nbt.TAG_Compound())
+        chunk.savedTagData()
+        assert all(chunkData._sections[y] is sections[y] for y in sections if y != sy)
+
+        chunk.dirty = True
+        chunk.savedTagData()
+        assert not any(chunkData._sections[y] is sections[y] for y in sections)
+
+    def testPackedSectionsSaved(self):
+        level = self.anvilLevel.level
+        chunkData = level.getChunk(*level.allChunks.next()).chunkData
+        sections = dict(chunkData._sections)
+
+        # saved from the packed sections, which are then up to date
+        chunkData.dirty = True
+        chunkData.savedTagData()
+        assert not chunkData.isUnpacked
+        chunkData.Blocks
+        chunkData.savedTagData()
+        assert all(chunkData._sections[y] is sections[y] for y in sections)
+
+    def testLightDirtySections(self):
+        level = self.anvilLevel.level
+        positions = list(level.allChunks)
+        cx, cz = positions[len(positions) // 2]
+        level.generateLights([(cx, cz)])
+        level.saveInPlace()
+
+        # relighting the same blocks leaves the neighbors' light almost as it was, so few of their sections are
+        # marked for saving
+        level.generateLights([(cx, cz)])
+        for dx, dz in itertools.product((-1, 0, 1), (-1, 0, 1)):
+            if (dx, dz) != (0, 0) and level.containsChunk(cx + dx, cz + dz):
+                chunkData = level.getChunk(cx + dx, cz + dz).chunkData
+                assert len(chunkData._dirtySections) < level.Height >> 4
+
+    def testPackedNibbleArrays(self):
+        level = self.anvilLevel.level
+        cx, cz = level.allChunks.next()
+        expected = level.getChunk(cx, cz)
+        data = expected.savedTagData()
+
+        level.packedNibbleArrays = True
+        chunkData = AnvilChunkData(level, (cx, cz), nbt.load(buf=data))
+        assert isinstance(chunkData.SkyLight, NibbleArray)
+        for key in 'Data SkyLight BlockLight'.split():
+            assert (numpy.asarray(getattr(chunkData, key)) == getattr(expected, key)).all()
+
+        chunkData.Data[0:4, 0:4, 0:16] = 3
+        chunkData.markDirty(0, 16)
+        expected.Data[0:4, 0:4, 0:16] = 3
+        reloaded = AnvilChunkData(level, (cx, cz), nbt.load(buf=chunkData.savedTagData()))
+        for key in 'Blocks Data SkyLight BlockLight'.split():
+            assert (numpy.asarray(getattr(reloaded, key)) == getattr(expected, key)).all()
+
+    def testNativeSectionOrder(self):
+        level = self.anvilLevel.level
+        cx, cz = level.allChunks.next()
+        expected = level.getChunk(cx, cz)
+        data = expected.savedTagData()
+
+        level.nativeSectionOrder = True
+        chunkData = AnvilChunkData(level, (cx, cz), nbt.load(buf=data))
+        assert chunkData.Blocks.swapaxes(0, 2).flags.c_contiguous
+        for key in 'Blocks Data SkyLight BlockLight'.split():
+            assert (getattr(chunkData, key) == getattr(expected, key)).all()
+
+        chunkData.Blocks[1, 2, 3] = 5
+        chunkData.SkyLight[3, 2, 1] = 4
+        chunkData.markDirty()
+        reloaded = AnvilChunkData(level, (cx, cz), nbt.load(buf=chunkData.savedTagData()))
+        assert reloaded.Blocks[1, 2, 3] == 5
+        assert reloaded.SkyLight[3, 2, 1] == 4
+
+    def testBlocksAt(self):
+        level = self.anvilLevel.level
+        bounds = level.bounds
+        random = numpy.random.RandomState(1)
+        count = 2000
+        xs = random.randint(bounds.minx - 32, bounds.maxx + 32, count)
+        ys = random.randint(-8, level.Height + 8, count)
+        zs = random.randint(bounds.minz - 32, bounds.maxz + 32, count)
+
+        blocks = level.getBlocksAt(xs, ys, zs)
+        assert blocks.shape == (count,)
+        assert all(blocks[i] == level.blockAt(xs[i], ys[i], zs[i]) for i in range(count))
+        assert level.getBlocksAt(xs.reshape(40, 50), ys.reshape(40, 50), zs.reshape(40, 50)).shape == (40, 50)
+
+        level.setBlocksAt(xs, ys, zs, 20, blockData=3)
+        assert all(level.blockAt(xs[i], ys[i], zs[i]) in (0, 20) for i in range(count))
+        assert (level.getBlocksAt(xs, ys, zs)[blocks != 0] == 20).all()
+        i = numpy.flatnonzero(blocks)[0]
+        assert level.blockDataAt(xs[i], ys[i], zs[i]) == 3
+        chunk = level.getChunk(xs[i] >> 4, zs[i] >> 4)
+        assert chunk.dirty and chunk.needsLighting
+
+        # values with the shape of the coordinates, as getBlocksAt returns them
+        xs, ys, zs = (a[:20].reshape(4, 5) for a in (xs, ys, zs))
+        ids = numpy.arange(20).reshape(4, 5) + 1
+        level.setBlocksAt(xs, ys, zs, ids, blockData=ids & 0xf)
+        present = blocks[:20].reshape(4, 5) != 0
+        assert (level.getBlocksAt(xs, ys, zs)[present] == ids[present]).all()
+
     def testPlayerSpawn(self):
         level = self.anvilLevel.level
 
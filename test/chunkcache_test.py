@@ -0,0 +1,76 @@
+import unittest
+from pymclevel.chunkcache import ChunkCache
+
+__author__ = 'Rio'
+
+
+class TestChunkCache(unittest.TestCase):
+    def testLRU(self):
+        cache = ChunkCache(maxChunks=3)
+        for i in range(3):
+            cache[i, 0] = i
+
+        assert cache.get((0, 0)) == 0  # now most recently used
+        cache[3, 0] = 3
+        assert (1, 0) not in cache
+        assert list(cache) == [(2, 0), (0, 0), (3, 0)]
+        assert cache.get((1, 0)) is None
+        assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+
+    def testByteLimit(self):
+        cache = ChunkCache(maxChunks=0, maxBytes=100, sizeFunc=lambda value: value)
+        cache["a"] = 60
+        cache["b"] = 30
+        assert cache.byteCount == 90
+        cache["c"] = 20
+        assert list(cache) == ["b", "c"]
+        assert cache.byteCount == 50
+
+        cache["b"] = 70  # replacing an entry replaces its size
+        assert list(cache) == ["c", "b"]
+        assert cache.byteCount == 90
+        assert cache.pop("c") == 20
+        assert cache.byteCount == 70
+
+    def testPinnedAndSpilled(self):
+        spilled = []
+
+        def onEvict(key, value):
+            spilled.append(key)
+            return value == "dirty"
+
+        pinned = set(["a"])
+        cache = ChunkCache(maxChunks=2, canEvict=lambda key, value: key not in pinned, onEvict=onEvict)
+        cache["a"] = "clean"
+        cache["b"] = "dirty"
+        cache["c"] = "clean"
+        assert spilled == ["b"]
+        assert list(cache) == ["c", "a"]  # "a" was skipped, which made it the most recently used
+        assert (cache.evictions, cache.spills) == (1, 1)
+
+        # nothing can be evicted, so the cache goes over its limit
+        pinned.update(["c", "d"])
+        cache["d"] = "clean"
+        assert len(cache) == 3
+        assert spilled == ["b"]
+
+    def testEvictError(self):
+        def onEvict(key, value):
+            raise IOError("disk full")
+
+        cache = ChunkCache(maxChunks=1, maxBytes=0, sizeFunc=lambda value: 10, onEvict=onEvict)
+        cache["a"] = "dirty"
+        self.assertRaises(IOError, cache.__setitem__, "b", "dirty")
+        assert "a" in cache and "b" in cache  # nothing was dropped without being written out
+        assert cache.byteCount == 20
+        assert cache.evictions == 0
+
+    def testResize(self):
+        sizes = {"a": 40, "b": 40}
+        cache = ChunkCache(maxChunks=0, maxBytes=100, sizeFunc=lambda value: sizes[value])
+        cache["a"] = "a"
+        cache["b"] = "b"
+        sizes["b"] = 90
+        cache.resize("b", "b")
+        assert list(cache) == ["b"]  # "a" was evicted to make room, and "b" stays though it is over the limit
+        assert cache.byteCount == 90
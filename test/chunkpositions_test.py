@@ -0,0 +1,51 @@
+import itertools
+import random
+import unittest
+from pymclevel.chunkpositions import ChunkPositionSet
+
+__author__ = 'Rio'
+
+
+class TestChunkPositionSet(unittest.TestCase):
+    def testSetOperations(self):
+        rand = random.Random(2)
+        positions = set((rand.randint(-100, 100), rand.randint(-100, 100)) for i in range(2000))
+        chunks = ChunkPositionSet(positions)
+        assert len(chunks) == len(positions)
+        assert set(chunks) == positions
+        assert all(cPos in chunks for cPos in positions)
+        assert (1000, 1000) not in chunks
+
+        removed = rand.sample(sorted(positions), 500)
+        for cPos in removed:
+            chunks.discard(cPos)
+            positions.discard(cPos)
+        chunks.discard((1000, 1000))
+        assert len(chunks) == len(positions)
+        assert set(chunks) == positions
+
+    def testIterationOrder(self):
+        chunks = ChunkPositionSet([(33, 1), (1, 1), (0, 1), (1, 0), (-1, -1)])
+        assert chunks.regions() == [(-1, -1), (0, 0), (1, 0)]
+        assert list(chunks) == [(-1, -1), (1, 0), (0, 1), (1, 1), (33, 1)]
+        assert chunks.chunksInRegion((0, 0)) == [(1, 0), (0, 1), (1, 1)]
+        assert chunks.chunksInRegion((5, 5)) == []
+
+    def testBounds(self):
+        chunks = ChunkPositionSet()
+        assert chunks.bounds is None
+        for cPos in itertools.product(range(-3, 40), range(5, 9)):
+            chunks.add(cPos)
+        assert chunks.bounds == (-3, 5, 39, 8)
+
+        chunks.discard((10, 6))  # inside, the bounds are unchanged
+        assert chunks.bounds == (-3, 5, 39, 8)
+        for cz in range(5, 9):
+            chunks.discard((39, cz))
+        assert chunks.bounds == (-3, 5, 38, 8)
+
+        for cPos in list(chunks):
+            chunks.discard(cPos)
+        assert chunks.bounds is None and len(chunks) == 0
+        chunks.add((7, 7))
+        assert chunks.bounds == (7, 7, 7, 7)
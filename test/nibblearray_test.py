@@ -0,0 +1,58 @@
+import random
+import unittest
+import numpy
+from pymclevel.infiniteworld import packNibbleArray
+from pymclevel.nibblearray import NibbleArray
+
+__author__ = 'Rio'
+
+
+class TestNibbleArray(unittest.TestCase):
+    def setUp(self):
+        self.expected = numpy.random.randint(0, 16, (16, 16, 64)).astype('uint8')
+        self.nibbles = NibbleArray.filled(64)
+        self.nibbles[:] = self.expected
+
+    def testSectionLayout(self):
+        assert (self.nibbles.unpack() == self.expected).all()
+        for y in range(0, 64, 16):
+            section = packNibbleArray(self.expected[..., y:y + 16].swapaxes(0, 2))
+            assert (self.nibbles.packed[y:y + 16] == section).all()
+
+    def testSlicesWriteThrough(self):
+        nibbles, expected = self.nibbles, self.expected
+        for i in range(200):
+            slices = tuple(slice(random.randint(0, n / 2), random.randint(n / 2, n)) for n in expected.shape)
+            view, expectedView = nibbles[slices], expected[slices]
+            assert view.shape == expectedView.shape
+            assert (numpy.asarray(view) == expectedView).all()
+
+            mask = numpy.random.random(expectedView.shape) > 0.5
+            values = numpy.random.randint(0, 16, expectedView.shape).astype('uint8')
+            view[mask] = values[mask]
+            expectedView[mask] = values[mask]
+            assert (nibbles.unpack() == expected).all()
+
+        nibbles[..., 10:20] = 5
+        expected[..., 10:20] = 5
+        assert (nibbles.unpack() == expected).all()
+
+    def testScalarsAndFancyIndexing(self):
+        nibbles, expected = self.nibbles, self.expected
+        for i in range(200):
+            x, z, y = [random.randrange(n) for n in expected.shape]
+            assert nibbles[x, z, y] == expected[x, z, y]
+            value = random.randrange(16)
+            nibbles[x, z, y] = value
+            expected[x, z, y] = value
+
+        index = numpy.array([1, 3, 15]), numpy.array([2, 2, 0]), numpy.array([5, 9, 63])
+        nibbles[index] = 11
+        expected[index] = 11
+        assert (nibbles[index] == expected[index]).all()
+
+        nibbles |= 1
+        expected |= 1
+        assert (nibbles.unpack() == expected).all()
+        assert ((nibbles == 3) == (expected == 3)).all()
+        assert (numpy.maximum(nibbles, 7) == numpy.maximum(expected, 7)).all()
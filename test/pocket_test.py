@@ -1,5 +1,6 @@
 import unittest
 import numpy
+from pymclevel.pocket import PocketWorld
 from templevel import TempLevel
 
 __author__ = 'Rio'
@@ -24,3 +25,17 @@ class TestPocket(unittest.TestCase):
 
 #        level.copyBlocksFrom(alphalevel, BoundingBox((0, 0, 0), (64, 64, 64,)), (0, 0, 0))
         # assert((level.Blocks[0:64, 0:64, 0:64] == alphalevel.Blocks[0:64, 0:64, 0:64]).all())
+
+    def testFileHandlePool(self):
+        PocketWorld.keepChunkFileOpen = True
+        try:
+            level = PocketWorld(self.level.tmpname)
+        finally:
+            PocketWorld.keepChunkFileOpen = False
+
+        for cPos in level.allChunks:
+            level.getChunk(*cPos)
+        assert level.filePool.misses == 1
+        assert len(level.filePool) == 1
+        level.close()
+        assert len(level.filePool) == 0
@@ -0,0 +1,250 @@
+import os
+import threading
+import unittest
+from pymclevel.chunkwriter import ChunkWriter
+from pymclevel.filepool import FileHandlePool
+from pymclevel.infiniteworld import AnvilWorldFolder
+from pymclevel.regionfile import MCRegionFile
+from templevel import TempLevel
+
+__author__ = 'Rio'
+
+class TestRegionFile(unittest.TestCase):
+    def setUp(self):
+        self.anvilLevel = TempLevel("AnvilWorld")
+        self.worldFolder = AnvilWorldFolder(self.anvilLevel.tmpname)
+
+    def tearDown(self):
+        self.worldFolder.closeRegions()
+
+    def testMemoryMappedRead(self):
+        chunks = self.worldFolder.listChunks()
+        for cx, cz in chunks:
+            rf = self.worldFolder.getRegionForChunk(cx, cz)
+            data = rf.readChunk(cx, cz)
+            rf.useMemoryMap = True
+            assert rf.readChunk(cx, cz) == data
+            rf.useMemoryMap = False
+
+    def testMemoryMappedGrow(self):
+        cx, cz = iter(self.worldFolder.listChunks()).next()
+        rf = self.worldFolder.getRegionForChunk(cx, cz)
+        rf.useMemoryMap = True
+        data = rf.readChunk(cx, cz)
+
+        # saving an incompressible chunk into a new slot forces the file to grow past the current mapping
+        filler = os.urandom(3 * MCRegionFile.SECTOR_BYTES)
+        sectorCount = rf.sectorCount
+        rf._saveChunk(cx + 1, cz, filler, MCRegionFile.VERSION_DEFLATE)
+        assert rf.sectorCount > sectorCount
+        assert str(rf._readChunk(cx + 1, cz)[0]) == filler
+        assert rf.readChunk(cx, cz) == data
+
+    def testDeferredHeaderWrites(self):
+        cx, cz = iter(self.worldFolder.listChunks()).next()
+        rf = self.worldFolder.getRegionForChunk(cx, cz)
+        rf.deferHeaderWrites = True
+        oldOffset = rf.getOffset(cx, cz)
+
+        with file(rf.path, "rb") as f:
+            header = f.read(2 * MCRegionFile.SECTOR_BYTES)
+
+        # too big for its old sectors, so the chunk is moved
+        filler = os.urandom(((oldOffset & 0xff) + 1) * MCRegionFile.SECTOR_BYTES)
+        rf._saveChunk(cx, cz, filler, MCRegionFile.VERSION_DEFLATE)
+        rf.setOffset(cx + 1, cz, 0)
+        with file(rf.path, "rb") as f:
+            assert f.read(2 * MCRegionFile.SECTOR_BYTES) == header
+
+        # the old sectors are still referenced by the header on disk
+        assert not any(rf.freeSectors[oldOffset >> 8:(oldOffset >> 8) + (oldOffset & 0xff)])
+
+        rf.flush()
+        assert all(rf.freeSectors[oldOffset >> 8:(oldOffset >> 8) + (oldOffset & 0xff)])
+        reopened = MCRegionFile(rf.path, rf.regionCoords)
+        assert (reopened.offsets == rf.offsets).all()
+        assert (reopened.modTimes == rf.modTimes).all()
+        assert str(reopened._readChunk(cx, cz)[0]) == filler
+
+    def testChunkIndex(self):
+        chunks = self.worldFolder.listChunks()
+
+        # backdate the region files so they are old enough to be indexed
+        for filepath in self.worldFolder.findRegionFiles():
+            os.utime(filepath, (0, 0))
+
+        worldFolder = AnvilWorldFolder(self.anvilLevel.tmpname)
+        worldFolder.useChunkIndex = True
+        assert worldFolder.listChunks() == chunks
+        assert os.path.exists(worldFolder.getFilePath(AnvilWorldFolder.CHUNK_INDEX_FILENAME))
+
+        worldFolder = AnvilWorldFolder(self.anvilLevel.tmpname)
+        worldFolder.useChunkIndex = True
+        assert worldFolder.listChunks() == chunks
+        assert len(worldFolder.regionFiles) == 0
+
+        # changed regions are rescanned
+        cx, cz = iter(chunks).next()
+        worldFolder.deleteChunk(cx, cz)
+        worldFolder.closeRegions()
+        assert worldFolder.listChunks() == chunks - set([(cx, cz)])
+        assert worldFolder.regionFiles.keys() == [(cx >> 5, cz >> 5)]
+
+    def testFileHandlePool(self):
+        chunks = self.worldFolder.listChunks()
+        expected = dict((cPos, self.worldFolder.readChunk(*cPos)) for cPos in chunks)
+
+        AnvilWorldFolder.maxOpenRegionFiles = 2
+        try:
+            worldFolder = AnvilWorldFolder(self.anvilLevel.tmpname)
+        finally:
+            AnvilWorldFolder.maxOpenRegionFiles = 0
+
+        pool = worldFolder.filePool
+        for i in range(2):
+            for cPos in sorted(chunks):
+                assert worldFolder.readChunk(*cPos) == expected[cPos]
+                assert len(pool) <= 2
+
+        assert pool.hits and pool.misses and pool.evictions
+
+        cx, cz = sorted(chunks)[0]
+        worldFolder.saveChunk(cx, cz, expected[cx, cz] * 2)
+        worldFolder.closeRegions()
+        assert len(pool) == 0
+        assert AnvilWorldFolder(self.anvilLevel.tmpname).readChunk(cx, cz) == expected[cx, cz] * 2
+
+    def testFileHandlePoolThreads(self):
+        pool = FileHandlePool(1)
+        paths = sorted(self.worldFolder.findRegionFiles())[:2]
+        opened = threading.Event()
+
+        def useOtherFile():
+            with pool.open(paths[1]):
+                opened.set()
+
+        # another file can be used while the first one is, even past maxOpen, and neither is closed under its user
+        with pool.open(paths[0]) as f:
+            thread = threading.Thread(target=useOtherFile)
+            thread.start()
+            assert opened.wait(5)
+            thread.join()
+            assert not f.closed
+
+        with pool.open(paths[1]):
+            pass
+        assert len(pool) == 1 and f.closed
+
+    def testCompact(self):
+        chunks = self.worldFolder.listChunks()
+        expected = dict((cPos, self.worldFolder.readChunk(*cPos)) for cPos in chunks)
+
+        # move some chunks to the end of their files, leaving holes behind
+        for cx, cz in sorted(chunks)[::3]:
+            rf = self.worldFolder.getRegionForChunk(cx, cz)
+            rf._saveChunk(cx, cz, os.urandom(((rf.getOffset(cx, cz) & 0xff) + 1) * MCRegionFile.SECTOR_BYTES), 2)
+            rf.saveChunk(cx, cz, expected[cx, cz])
+
+        sizeBefore = sum(os.path.getsize(f) for f in self.worldFolder.findRegionFiles())
+        reclaimed = self.worldFolder.compactWorld()
+        sizeAfter = sum(os.path.getsize(f) for f in self.worldFolder.findRegionFiles())
+        assert reclaimed > 0
+        assert sizeBefore - sizeAfter == reclaimed
+
+        for rf in self.worldFolder.regionFiles.values():
+            assert rf.sectors.freeCount == 0
+
+        worldFolder = AnvilWorldFolder(self.anvilLevel.tmpname)
+        assert worldFolder.listChunks() == chunks
+        for cPos in chunks:
+            assert worldFolder.readChunk(*cPos) == expected[cPos]
+
+    def testCompressionPolicy(self):
+        chunks = sorted(self.worldFolder.listChunks())[:8]
+        expected = dict((cPos, self.worldFolder.readChunk(*cPos)) for cPos in chunks)
+
+        self.worldFolder.compressMode = MCRegionFile.VERSION_UNCOMPRESSED
+        for cPos in chunks:
+            self.worldFolder.saveChunk(cPos[0], cPos[1], expected[cPos])
+            data, format = self.worldFolder.getRegionForChunk(*cPos)._readChunk(*cPos)
+            assert format == MCRegionFile.VERSION_UNCOMPRESSED
+            assert self.worldFolder.readChunk(*cPos) == expected[cPos]
+
+        self.worldFolder.compressMode = MCRegionFile.VERSION_DEFLATE
+        for level in (0, 1, 9):
+            self.worldFolder.compressionLevel = level
+            for cPos in chunks:
+                self.worldFolder.saveChunk(cPos[0], cPos[1], expected[cPos])
+                data, format = self.worldFolder.getRegionForChunk(*cPos)._readChunk(*cPos)
+                assert format == MCRegionFile.VERSION_DEFLATE
+                assert self.worldFolder.readChunk(*cPos) == expected[cPos]
+
+    def testUncompressedTooBig(self):
+        cx, cz = iter(self.worldFolder.listChunks()).next()
+        rf = self.worldFolder.getRegionForChunk(cx, cz)
+
+        # more than 255 sectors when stored as-is, so it must be deflated
+        data = "\0" * (256 * MCRegionFile.SECTOR_BYTES)
+        rf.saveChunk(cx, cz, data, MCRegionFile.VERSION_UNCOMPRESSED)
+        assert rf._readChunk(cx, cz)[1] == MCRegionFile.VERSION_DEFLATE
+        assert rf.readChunk(cx, cz) == data
+
+    def testReadChunks(self):
+        chunks = self.worldFolder.listChunks()
+        expected = dict((cPos, self.worldFolder.readChunk(*cPos)) for cPos in chunks)
+
+        for useMemoryMap in (False, True):
+            for rf in self.worldFolder.regionFiles.values():
+                rf.useMemoryMap = useMemoryMap
+            read = list(self.worldFolder.readChunks())
+
+            assert len(read) == len(chunks)
+            for cx, cz, data in read:
+                assert data == expected[cx, cz]
+
+        for rf in self.worldFolder.regionFiles.values():
+            sectors = [rf.getOffset(cx, cz) >> 8 for cx, cz, data in rf.readChunks()]
+            assert sectors == sorted(sectors)
+
+        some = sorted(chunks)[::5] + [(10000, 10000)]
+        assert sorted((cx, cz) for cx, cz, data in self.worldFolder.readChunks(some)) == sorted(some[:-1])
+
+    def testChunkWriter(self):
+        chunks = sorted(self.worldFolder.listChunks())
+        expected = dict((cPos, self.worldFolder.readChunk(*cPos)) for cPos in chunks)
+
+        writer = ChunkWriter(workers=3, maxPending=4)
+        self.worldFolder.chunkWriter = writer
+        try:
+            # save every chunk twice, so some saves are replaced before they are written
+            for cx, cz in chunks:
+                self.worldFolder.saveChunk(cx, cz, expected[cx, cz][::-1])
+            for cx, cz in chunks:
+                self.worldFolder.saveChunk(cx, cz, expected[cx, cz])
+                assert self.worldFolder.readChunk(cx, cz) == expected[cx, cz]
+
+            self.worldFolder.saveChunk(10000, 10000, expected[chunks[0]])
+            assert self.worldFolder.containsChunk(10000, 10000)
+
+            self.worldFolder.flush()
+            assert writer.pendingCount == 0
+            assert not self.worldFolder._pendingChunks
+        finally:
+            writer.close()
+            self.worldFolder.closeRegions()
+
+        worldFolder = AnvilWorldFolder(self.anvilLevel.tmpname)
+        assert worldFolder.listChunks() == set(chunks) | set([(10000, 10000)])
+        for cPos in chunks:
+            assert worldFolder.readChunk(*cPos) == expected[cPos]
+
+    def testChunkWriterError(self):
+        writer = ChunkWriter(workers=1)
+
+        def fail():
+            raise IOError("disk full")
+
+        writer.submit(fail)
+        self.assertRaises(IOError, writer.flush)
+        writer.flush()
+        writer.close()
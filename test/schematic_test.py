@@ -1,6 +1,7 @@
 import itertools
 import os
 import unittest
+import numpy
 from pymclevel import mclevel
 from templevel import TempLevel, mktemp
 from pymclevel.schematic import MCSchematic
@@ -44,6 +45,19 @@ class TestSchematics(unittest.TestCase):
         schematic.close()
         os.remove(temp)
 
+    def testBlocksAt(self):
+        schematic = MCSchematic(shape=(8, 8, 8), mats='Classic')
+        xs, zs = numpy.mgrid[0:4, 2:7]
+        ids = numpy.arange(20).reshape(4, 5) + 1
+        schematic.setBlocksAt(xs, 3, zs, ids, blockData=ids & 0xf)
+        assert (schematic.getBlocksAt(xs, 3, zs) == ids).all()
+        assert (schematic.Data[xs, zs, 3] == ids & 0xf).all()
+
+        # points outside the schematic are ignored
+        schematic.setBlocksAt(xs + 6, 3, zs, ids)
+        assert (schematic.getBlocksAt(xs + 6, 3, zs)[xs + 6 >= 8] == 0).all()
+        assert (schematic.getBlocksAt(xs + 6, 3, zs)[xs + 6 < 8] == ids[xs + 6 < 8]).all()
+
     def testRotate(self):
         level = self.anvilLevel.level
         schematic = level.extractSchematic(BoundingBox((0, 0, 0), (21, 11, 8)))
@@ -0,0 +1,83 @@
+import random
+import unittest
+from pymclevel.sectorallocator import SectorAllocator
+
+__author__ = 'Rio'
+
+class TestSectorAllocator(unittest.TestCase):
+    def testAllocateAndFree(self):
+        sectors = SectorAllocator(2, 2)
+        assert sectors.allocate(3) == 2
+        assert sectors.allocate(1) == 5
+        assert sectors.sectorCount == 6
+
+        sectors.free(2, 3)
+        assert sectors.freeExtents() == [(2, 3)]
+        assert sectors.allocate(2) == 2
+        assert sectors.allocate(2) == 6  # the hole at 4 is too small
+        assert sectors.freeExtents() == [(4, 1)]
+
+    def testGrowIntoTrailingSpace(self):
+        sectors = SectorAllocator(10, 2)
+        sectors.markUsed(2, 4)
+        assert sectors.allocate(6) == 6
+        assert sectors.sectorCount == 12
+        assert sectors.freeCount == 0
+
+    def testOverlap(self):
+        sectors = SectorAllocator(10, 2)
+        assert sectors.markUsed(2, 3)
+        assert not sectors.markUsed(4, 2)
+        assert not sectors.markUsed(8, 4)
+        assert not sectors.markUsed(0, 1)
+        assert sectors.freeExtents() == [(6, 2)]
+
+    def testBestFit(self):
+        for policy, expected in (None, [10, 2]), (SectorAllocator.FIRST_FIT, [2, 4]):
+            sectors = SectorAllocator(20, 0) if policy is None else SectorAllocator(20, 0, policy)
+            sectors.markUsed(0, 20)
+            sectors.free(2, 5)
+            sectors.free(10, 2)
+            assert [sectors.allocate(2), sectors.allocate(2)] == expected
+
+    def testMatchesBitmap(self):
+        rand = random.Random(1234)
+        for policy in SectorAllocator.FIRST_FIT, SectorAllocator.BEST_FIT:
+            sectors = SectorAllocator(2, 2, policy)
+            bitmap = [False, False]
+            allocations = []
+
+            for i in range(2000):
+                if allocations and rand.random() < 0.45:
+                    start, count = allocations.pop(rand.randrange(len(allocations)))
+                    sectors.free(start, count)
+                    bitmap[start:start + count] = [True] * count
+                else:
+                    count = rand.randint(1, 6)
+                    start = sectors.allocate(count)
+                    bitmap += [True] * (sectors.sectorCount - len(bitmap))
+                    assert all(bitmap[start:start + count])
+                    bitmap[start:start + count] = [False] * count
+                    allocations.append((start, count))
+
+                assert sectors.sectorCount == len(bitmap)
+                assert sectors.freeCount == sum(bitmap)
+
+            for start, count in sectors.freeExtents():
+                assert all(bitmap[start:start + count])
+                assert not bitmap[start - 1]
+                assert start + count == len(bitmap) or not bitmap[start + count]
+
+    def testMarkUsedExtents(self):
+        sectors = SectorAllocator(20, 2)
+        assert sectors.markUsedExtents([0, 5, 2, 12, 0], [0, 3, 2, 8, 0])
+        assert sectors.freeExtents() == [(4, 1), (8, 4)]
+        assert sectors.freeCount == 5
+
+        sectors = SectorAllocator(20, 2)
+        assert not sectors.markUsedExtents([5, 6, 2], [3, 1, 2])
+        assert sectors.freeExtents() == [(4, 1), (8, 12)]
+
+        sectors = SectorAllocator(20, 2)
+        assert not sectors.markUsedExtents([1, 18], [2, 4])
+        assert sectors.freeExtents() == [(3, 15)]
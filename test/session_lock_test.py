@@ -1,4 +1,10 @@
-from pymclevel.infiniteworld import SessionLockLost, MCInfdevOldLevel
+import os
+import struct
+import threading
+import time
+from pymclevel import infiniteworld
+from pymclevel.chunkwriter import ChunkWriter
+from pymclevel.infiniteworld import AnvilWorldFolder, SessionLockLost, MCInfdevOldLevel
 from templevel import TempLevel
 import unittest
 
@@ -11,3 +17,48 @@ class SessionLockTest(unittest.TestCase):
             level.saveInPlace()
         self.assertRaises(SessionLockLost, touch)
 
+    def test_session_lock_queued_write(self):
+        temp = TempLevel("AnvilWorld")
+        level = temp.level
+        cx, cz = level.allChunks.next()
+        before = level.worldFolder.readChunk(cx, cz)
+
+        # hold the writer's only thread until the lock has been taken by another level
+        writer = level.worldFolder.chunkWriter = ChunkWriter(workers=1)
+        level.worldFolder.sessionLockCheck = level.checkSessionLock
+        started = threading.Event()
+        writer.submit(started.wait)
+        level.checkSessionLock()
+        level.worldFolder.saveChunk(cx, cz, level.getChunk(cx, cz).savedTagData())
+        MCInfdevOldLevel(level.filename)
+        started.set()
+
+        self.assertRaises(SessionLockLost, writer.flush)
+        assert AnvilWorldFolder(level.worldFolder.filename, readonly=True).readChunk(cx, cz) == before
+        writer.close()
+
+    def test_session_lock_unchanged(self):
+        temp = TempLevel("AnvilWorld")
+        level = temp.level
+        lockfile = level.worldFolder.getFilePath("session.lock")
+        old = time.time() - 60
+        os.utime(lockfile, (old, old))
+        level.checkSessionLock()
+
+        reads = []
+        def countingFile(*args):
+            reads.append(args)
+            return open(*args)
+
+        infiniteworld.file = countingFile
+        try:
+            level.checkSessionLock()
+            assert not reads  # the file is unchanged, so it is not read again
+
+            with open(lockfile, "wb") as f:
+                f.write(struct.pack(">q", 1))
+            os.utime(lockfile, (old + 1, old + 1))
+            self.assertRaises(SessionLockLost, level.checkSessionLock)
+            assert reads
+        finally:
+            del infiniteworld.file
@@ -0,0 +1,41 @@
+import os
+import shutil
+from pymclevel.infiniteworld import AnvilWorldFolder
+from pymclevel.regionfile import MCRegionFile
+from timeit import timeit
+
+import templevel
+
+#import logging
+#logging.basicConfig(level=logging.INFO)
+
+settings = [("uncompressed", MCRegionFile.VERSION_UNCOMPRESSED, 0)] + \
+           [("deflate level %d" % level, MCRegionFile.VERSION_DEFLATE, level) for level in (0, 1, 2, 6, 9)]
+
+
+def save_throughput():
+    source = AnvilWorldFolder("testfiles/AnvilWorld", readonly=True)
+    chunks = dict((cPos, source.readChunk(*cPos)) for cPos in source.listChunks())
+    source.closeRegions()
+    totalBytes = sum(len(data) for data in chunks.itervalues())
+
+    for name, compressMode, compressionLevel in settings:
+        worldFolder = AnvilWorldFolder(templevel.mktemp("TimeCompression"))
+        worldFolder.compressMode = compressMode
+        worldFolder.compressionLevel = compressionLevel
+
+        def save():
+            for (cx, cz), data in chunks.iteritems():
+                worldFolder.saveChunk(cx, cz, data)
+
+        t = timeit(save, number=1)
+        worldFolder.closeRegions()
+        size = sum(os.path.getsize(f) for f in worldFolder.findRegionFiles())
+        shutil.rmtree(worldFolder.filename)
+
+        print "Save %d chunks, %s: %.02f seconds (%.02f MB/s uncompressed), %d KB on disk" % (
+            len(chunks), name, t, totalBytes / t / 1048576, size / 1024)
+
+
+if __name__ == '__main__':
+    save_throughput()
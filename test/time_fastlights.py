@@ -0,0 +1,47 @@
+import itertools
+from timeit import timeit
+
+import numpy
+
+import templevel
+
+#import logging
+#logging.basicConfig(level=logging.INFO)
+
+
+def loop_fast_lights(chunk):
+    # the column-by-column skylight fill genFastLights used before it was vectorized
+    chunk.SkyLight[:] = 0
+    blocks = chunk.Blocks
+    la = chunk.world.materials.lightAbsorption
+    skylight = chunk.SkyLight
+    heightmap = chunk.HeightMap
+
+    for x, z in itertools.product(xrange(16), xrange(16)):
+        skylight[x, z, heightmap[z, x]:] = 15
+        lv = 15
+        for y in reversed(range(heightmap[z, x])):
+            lv -= (la[blocks[x, z, y]] or 1)
+            if lv <= 0:
+                break
+            skylight[x, z, y] = lv
+
+
+def fast_lights():
+    temp = templevel.TempLevel("AnvilWorld")
+    world = temp.level
+    chunks = list(itertools.islice(world.getChunks(), 100))
+    for chunk in chunks:
+        chunk.Blocks
+
+    before = timeit(lambda: [loop_fast_lights(chunk) for chunk in chunks], number=1)
+    expected = [numpy.array(chunk.SkyLight) for chunk in chunks]
+    after = timeit(lambda: [chunk.genFastLights() for chunk in chunks], number=1)
+    assert all((chunk.SkyLight == e).all() for chunk, e in zip(chunks, expected))
+
+    print "genFastLights: %d chunks, %.02fms per chunk with the column loop, %.02fms per chunk vectorized (%.0fx)" % (
+        len(chunks), before / len(chunks) * 1000, after / len(chunks) * 1000, before / after)
+
+
+if __name__ == '__main__':
+    fast_lights()
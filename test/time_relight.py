@@ -8,7 +8,8 @@ import templevel
 #logging.basicConfig(level=logging.INFO)
 
 def natural_relight():
-    world = mclevel.fromFile("testfiles/AnvilWorld")
+    temp = templevel.TempLevel("AnvilWorld")
+    world = temp.level
     t = timeit(lambda: world.generateLights(world.allChunks), number=1)
     print "Relight natural terrain: %d chunks in %.02f seconds (%.02fms per chunk)" % (world.chunkCount, t, t / world.chunkCount * 1000)
 
@@ -17,7 +18,7 @@ def manmade_relight():
     t = templevel.TempLevel("TimeRelight", createFunc=lambda f:MCInfdevOldLevel(f, create=True))
 
     world = t.level
-    station = mclevel.fromFile("testfiles/station.schematic")
+    station = mclevel.fromFile("testfiles/Station.schematic")
 
     times = 2
 
@@ -28,9 +29,27 @@ def manmade_relight():
     t = timeit(lambda: world.generateLights(world.allChunks), number=1)
     print "Relight manmade building: %d chunks in %.02f seconds (%.02fms per chunk)" % (world.chunkCount, t, t / world.chunkCount * 1000)
 
+def torch_relight():
+    temp = templevel.TempLevel("AnvilWorld")
+    world = temp.level
+    x, z = 300, 200
+    y = world.heightMapAt(x, z)
+
+    def placeAndRemove():
+        world.setBlockAt(x, y, z, world.materials.Torch.ID)
+        world.generateLights()
+        world.setBlockAt(x, y, z, 0)
+        world.generateLights()
+
+    for limit, name in ((0, "chunks"), (world.incrementalLightingLimit, "edits")):
+        world.incrementalLightingLimit = limit
+        t = timeit(placeAndRemove, number=10)
+        print "Relight %s after placing or removing a torch: %.02fms" % (name, t / 20 * 1000)
+
 if __name__ == '__main__':
     natural_relight()
     manmade_relight()
+    torch_relight()
 
 
 